@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator of align_service.py: concurrent clients send /align requests
+built from the images and detections of a manifest, for a fixed duration,
+then throughput and latency percentiles are reported. Run it at increasing
+--concurrency to trace throughput against p99 latency.
+
+Usage:
+    python align_loadgen.py --url http://127.0.0.1:8080 \\
+        --manifest test_imgs_weidong/test_data.json --concurrency 16 --duration 30
+"""
+import argparse
+import base64
+import json
+import os.path as osp
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+import numpy as np
+
+from manifest_io import iter_manifest
+
+
+def load_request_bodies(manifest, image_root='', max_images=100, return_chips=False,
+                        lane=None):
+    """Build /align request bodies from the entries of a manifest, images
+    are sent inline (base64).
+
+    Return:
+        a list of (body, n_faces), body is JSON encoded bytes
+    """
+    bodies = []
+    for _, entry in iter_manifest(manifest):
+        uri = entry.get("uri")
+        if not uri or not entry.get("detections"):
+            continue
+        path = osp.join(image_root, uri)
+        if not osp.isfile(path):
+            continue
+
+        with open(path, 'rb') as fp:
+            image = base64.b64encode(fp.read()).decode('ascii')
+        body = {
+            "image": image,
+            "detections": entry["detections"],
+            "return_chips": return_chips
+        }
+        if lane:
+            body["lane"] = lane
+        bodies.append((json.dumps(body).encode('utf-8'), len(entry["detections"])))
+        if len(bodies) >= max_images:
+            break
+
+    return bodies
+
+
+def post_json(url, data, timeout=30.0):
+    """POST JSON encoded data to url.
+
+    Return:
+        HTTP status code, and the body
+    """
+    request = Request(url, data, {"Content-Type": "application/json"})
+    try:
+        response = urlopen(request, timeout=timeout)
+        return response.getcode(), response.read()
+    except HTTPError as err:
+        return err.code, err.read()
+
+
+class LoadGenerator(object):
+    """Send requests from concurrent client threads, see the module docstring."""
+
+    def __init__(self, url, bodies, concurrency=8, duration=10.0, timeout=30.0):
+        self.url = url.rstrip('/') + '/align'
+        self.bodies = bodies
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.n_faces = 0
+        self.status_counts = {}
+
+    def _client_loop(self, client_idx, end_time):
+        k = client_idx
+        while time.time() < end_time:
+            data, n_faces = self.bodies[k % len(self.bodies)]
+            k += self.concurrency
+
+            t0 = time.time()
+            try:
+                status, _ = post_json(self.url, data, self.timeout)
+            except (URLError, IOError):
+                status = 'connection_error'
+            latency = time.time() - t0
+
+            with self.lock:
+                self.status_counts[status] = self.status_counts.get(status, 0) + 1
+                if status == 200:
+                    self.latencies.append(latency)
+                    self.n_faces += n_faces
+
+            if status == 503:
+                # rejected by overload protection, back off a little
+                time.sleep(0.01)
+
+    def run(self):
+        """Run the load.
+
+        Return:
+            a dict of stats
+        """
+        start = time.time()
+        end_time = start + self.duration
+        threads = []
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._client_loop, args=(i, end_time))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        latencies = np.array(self.latencies) * 1000
+        stats = {
+            "concurrency": self.concurrency,
+            "elapsed": elapsed,
+            "ok": len(self.latencies),
+            "status_counts": dict((str(k), v) for k, v in self.status_counts.items()),
+            "requests_per_sec": len(self.latencies) / elapsed,
+            "faces_per_sec": self.n_faces / elapsed
+        }
+        if len(latencies):
+            for p in (50, 90, 99):
+                stats["p{}_ms".format(p)] = float(np.percentile(latencies, p))
+            stats["max_ms"] = float(latencies.max())
+
+        return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='load generator of align_service.py')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--manifest', default='test_imgs_weidong/test_data.json')
+    parser.add_argument('--image-root', default='',
+                        help='dir the image uris of the manifest are relative to')
+    parser.add_argument('--max-images', type=int, default=100)
+    parser.add_argument('--concurrency', default='8',
+                        help='number of concurrent clients, or a comma separated '
+                             'list of them to run one after another')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run each concurrency level')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--return-chips', action='store_true')
+    parser.add_argument('--lane', default=None,
+                        help='priority lane of the requests, e.g. bulk')
+    args = parser.parse_args(argv)
+
+    bodies = load_request_bodies(args.manifest, args.image_root, args.max_images,
+                                 args.return_chips, args.lane)
+    if not bodies:
+        raise ValueError('no images with detections in ' + args.manifest)
+    print('[align_loadgen] {} request bodies, {} faces'.format(
+        len(bodies), sum(n for _, n in bodies)))
+
+    for concurrency in args.concurrency.split(','):
+        loadgen = LoadGenerator(args.url, bodies, int(concurrency),
+                                args.duration, args.timeout)
+        print(json.dumps(loadgen.run(), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
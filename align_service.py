@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+HTTP face alignment service. Faces of concurrent requests are coalesced
+into network batches by a LandmarkBatcher, run on a pool of model workers.
+Overload is rejected fast (HTTP 503) by bounded in-flight requests and a
+bounded queue of pending faces.
+
+Start (binds to localhost):
+    python align_service.py --config face_aligner_config.json --port 8080 \\
+        --model-workers 2 --max-wait-ms 5
+
+POST /align, a JSON body:
+    {
+        "image": base64 encoded image file, or
+        "image_path": path of an image under --image-root,
+        "detections": [{"pts": [[x1,y1],...,[x4,y4]], "orientation": radians}, ...]
+                (the schema of test_data.json),
+        "return_chips": false,
+        "lane": "interactive" (default) or "bulk", see landmark_batcher
+    }
+returns:
+    {
+        "faces": [{"five_pts": [[x, y]]*5 in the image, "face_score": ...,
+                   "chip": base64 JPEG of the aligned chip}, ...],
+        "timing": {"decode": ms, "crop": ms, "landmarks": ms, "chips": ms}
+    }
+
+GET /stats returns the batcher stats, GET /healthz returns "ok", and with
+--metrics, GET /metrics returns the stage latencies and counters in the
+Prometheus text format (see metrics.py). With --trace-sample-rate, a
+sample of the requests is traced per face (see tracing.py) and GET /trace
+returns the buffered traces in the Chrome trace event format.
+
+Benchmark with align_loadgen.py.
+"""
+import argparse
+import base64
+import copy
+import json
+import os.path as osp
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import numpy as np
+import cv2
+
+from face_aligner_mxnet import FaceAlignerCaffe, map_crop_pts_to_image
+from detection_batch import parse_manifest_entries, get_upright_face_transforms
+from landmark_batcher import LandmarkBatcher, QueueFullError
+from metrics import MetricsRegistry, PROMETHEUS_CONTENT_TYPE, stage_timer
+from tracing import Tracer, trace_span
+
+
+class HTTPError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class AlignService(object):
+    """Request handling of the alignment service, independent of HTTP."""
+
+    def __init__(self, config_json, model_workers=1, batch_size=None,
+                 max_wait=0.005, max_pending_faces=1024, bulk_share=0.1,
+                 max_inflight=64,
+                 crop_scale=1.5, center_roi_scale=1 / 1.5 * 0.9,
+                 image_root=None, request_timeout=10.0, jpeg_quality=95,
+                 metrics=None, tracer=None):
+        """Request handling of the alignment service.
+
+            Params:
+                config_json: config of FaceAlignerCaffe
+                model_workers: number of FaceAlignerCaffe instances
+                batch_size, max_wait, max_pending_faces, bulk_share: see
+                        LandmarkBatcher
+                max_inflight: max number of requests being handled, more
+                        are rejected
+                crop_scale: scale of FaceAlignerCaffe.rotate_and_crop_faces()
+                center_roi_scale: see FaceAlignerCaffe.get_landmarks()
+                image_root: None, or the dir "image_path" of requests must
+                        be in (requests by path are rejected if None)
+                request_timeout: seconds to wait for landmarks
+                jpeg_quality: JPEG quality of returned chips
+                metrics: None or a metrics.MetricsRegistry, for the stage
+                        latencies of all requests
+                tracer: None or a tracing.Tracer, to trace a sample of the
+                        requests
+        """
+        config_json = dict(config_json)
+        config_json["verbose"] = 0
+
+        # a copy for each, MxnetFeatureExtractor rewrites its config in place
+        aligners = [FaceAlignerCaffe(copy.deepcopy(config_json))
+                    for _ in range(max(1, model_workers))]
+        self.aligner = aligners[0]
+        self.metrics = metrics
+        self.request_latency = None
+        if metrics is not None:
+            for aligner in aligners:
+                aligner.set_metrics(metrics)
+            self.request_latency = metrics.histogram(
+                'request_seconds', 'latency of /align requests')
+        self.batcher = LandmarkBatcher(aligners, batch_size, max_wait,
+                                       max_pending_faces, center_roi_scale,
+                                       bulk_share=bulk_share)
+
+        self.tracer = tracer
+        self.inflight = threading.Semaphore(max_inflight)
+        self.crop_scale = crop_scale
+        self.image_root = osp.realpath(image_root) if image_root else None
+        self.request_timeout = request_timeout
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "rejected_inflight": 0,
+            "errors": 0
+        }
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def start_trace(self, name, **args):
+        """Start the trace of a request if it is sampled, see tracing.Tracer.
+
+        Return:
+            a tracing.Trace, or None
+        """
+        if self.tracer is None:
+            return None
+        return self.tracer.start_trace(name, **args)
+
+    def _load_image(self, body):
+        if "image" in body:
+            buf = np.frombuffer(base64.b64decode(body["image"]), dtype=np.uint8)
+            img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        elif "image_path" in body:
+            if self.image_root is None:
+                raise HTTPError(403, 'requests by image_path are not enabled')
+            path = osp.realpath(osp.join(self.image_root, body["image_path"]))
+            if not path.startswith(self.image_root + osp.sep):
+                raise HTTPError(403, 'image_path is outside of the image root')
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+        else:
+            raise HTTPError(400, 'either "image" or "image_path" is required')
+
+        if img is None:
+            raise HTTPError(400, 'failed to decode the image')
+        return img
+
+    def align(self, body):
+        """Handle one /align request.
+
+        Params:
+            body: the decoded JSON body, see the module docstring
+        Return:
+            the JSON response, a dict
+        """
+        if not self.inflight.acquire(False):
+            self._count("rejected_inflight")
+            raise HTTPError(503, 'too many requests in flight')
+
+        t0 = time.time()
+        trace = self.start_trace('align_request')
+        try:
+            self._count("requests")
+            response = self._align(body, trace)
+            if self.request_latency is not None:
+                self.request_latency.observe(time.time() - t0)
+            return response
+        except HTTPError:
+            raise
+        except QueueFullError as err:
+            raise HTTPError(503, str(err))
+        except Exception as err:
+            self._count("errors")
+            raise HTTPError(500, '{}: {}'.format(type(err).__name__, err))
+        finally:
+            self.inflight.release()
+            if trace is not None:
+                trace.finish()
+
+    def align_image(self, img, detections, return_chips=False, lane=None, trace=None):
+        """Align the faces of a decoded image, independent of the transport.
+
+        Params:
+            img: the image, numpy array
+            detections: detections of img in the manifest schema
+            return_chips: whether to make the aligned chips
+            lane: priority lane of LandmarkBatcher, default is the highest
+            trace: None or a tracing.Trace of the request
+        Return:
+            faces_pts: a list of 5x2 landmarks in img
+            face_scores: numpy array, NaN if not available
+            chips: a list of aligned face chips, or None if not return_chips
+            timing: a dict of milliseconds per step
+        """
+        timing = {}
+        t0 = time.time()
+        _, faces = parse_manifest_entries([{"detections": detections}])
+        crops = self.aligner.rotate_and_crop_faces(img, faces, self.crop_scale,
+                                                   trace=trace)
+        crop_transforms = get_upright_face_transforms(
+            faces.pts, faces.angles, self.crop_scale)[0]
+        t1 = time.time()
+        timing["crop"] = (t1 - t0) * 1000
+
+        five_pts_list, face_scores = self.batcher.get_landmarks_and_scores(
+            crops, self.request_timeout, lane, trace)
+        t0 = time.time()
+        timing["landmarks"] = (t0 - t1) * 1000
+
+        faces_pts = [map_crop_pts_to_image(five_pts, M)
+                     for five_pts, M in zip(five_pts_list, crop_transforms)]
+
+        chips = None
+        if return_chips:
+            chips = []
+            if crops:
+                chips = self.aligner.get_aligned_face_chips(
+                    crops, five_pts_list,
+                    face_traces=trace and [(trace, i) for i in range(len(crops))])
+            timing["chips"] = (time.time() - t0) * 1000
+
+        return faces_pts, face_scores, chips, timing
+
+    def _align(self, body, trace=None):
+        lane = body.get("lane")
+        if lane is not None and lane not in self.batcher.lanes:
+            raise HTTPError(400, 'lane must be one of {}'.format(self.batcher.lanes))
+
+        t0 = time.time()
+        with stage_timer(self.metrics, "decode"), trace_span(trace, "decode"):
+            img = self._load_image(body)
+        decode_time = (time.time() - t0) * 1000
+        if self.metrics is not None:
+            self.metrics.images.inc()
+
+        faces_pts, face_scores, chips, timing = self.align_image(
+            img, body.get("detections", []), body.get("return_chips", False), lane,
+            trace)
+        timing["decode"] = decode_time
+
+        results = []
+        for five_pts, score in zip(faces_pts, face_scores):
+            face = {"five_pts": np.round(five_pts, 2).tolist()}
+            if not np.isnan(score):
+                face["face_score"] = float(score)
+            results.append(face)
+
+        with trace_span(trace, "encode_chips"):
+            for face, chip in zip(results, chips or []):
+                ok, buf = cv2.imencode('.jpg', chip, self.encode_params)
+                face["chip"] = base64.b64encode(buf.tobytes()).decode('ascii')
+
+        return {"faces": results, "timing": timing}
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["batcher"] = self.batcher.get_stats()
+        if self.metrics is not None:
+            stats["metrics"] = self.metrics.get_stats()
+        if self.tracer is not None:
+            stats["tracer"] = self.tracer.get_stats()
+        return stats
+
+    def close(self):
+        self.batcher.close()
+        self.aligner.close()
+
+
+class AlignRequestHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    service = None
+
+    def _send_text(self, code, text, content_type):
+        data = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, code, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if code == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            self._send_json(200, "ok")
+        elif self.path == '/stats':
+            self._send_json(200, self.service.get_stats())
+        elif self.path == '/metrics' and self.service.metrics is not None:
+            self._send_text(200, self.service.metrics.to_prometheus(),
+                            PROMETHEUS_CONTENT_TYPE)
+        elif self.path == '/trace' and self.service.tracer is not None:
+            self._send_json(200, self.service.tracer.to_chrome_trace())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != '/align':
+            self._send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                raise HTTPError(400, 'invalid JSON body')
+            self._send_json(200, self.service.align(body))
+        except HTTPError as err:
+            self._send_json(err.code, {"error": str(err)})
+
+    def log_message(self, format, *args):
+        # no log line per request
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(service, host='127.0.0.1', port=8080):
+    """Make the HTTP server of service, call serve_forever() on it."""
+    handler = type('BoundAlignRequestHandler', (AlignRequestHandler,),
+                   {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HTTP face alignment service')
+    parser.add_argument('--config', default='face_aligner_config.json',
+                        help='config of FaceAlignerCaffe')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model-workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='max faces per network batch, 0 for the config batch_size')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help='max milliseconds to wait for a batch to fill')
+    parser.add_argument('--max-pending-faces', type=int, default=1024,
+                        help='max pending faces per priority lane')
+    parser.add_argument('--bulk-share', type=float, default=0.1,
+                        help='share of each batch reserved for bulk faces')
+    parser.add_argument('--max-inflight', type=int, default=64)
+    parser.add_argument('--image-root', default=None,
+                        help='allow requests by image_path under this dir')
+    parser.add_argument('--metrics', action='store_true',
+                        help='time the stages of all requests, served on /metrics')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.0,
+                        help='fraction of requests traced per face, served on /trace')
+    parser.add_argument('--shm-address', default=None,
+                        help='also serve co-located producers over shared memory '
+                             'on this unix socket path, see shm_transport')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as fp:
+        config_json = json.load(fp)
+
+    service = AlignService(config_json, model_workers=args.model_workers,
+                           batch_size=args.batch_size or None,
+                           max_wait=args.max_wait_ms / 1000.0,
+                           max_pending_faces=args.max_pending_faces,
+                           bulk_share=args.bulk_share,
+                           max_inflight=args.max_inflight,
+                           image_root=args.image_root,
+                           metrics=MetricsRegistry() if args.metrics else None,
+                           tracer=Tracer(args.trace_sample_rate)
+                           if args.trace_sample_rate > 0 else None)
+    server = make_server(service, args.host, args.port)
+    shm_server = None
+    if args.shm_address:
+        from shm_transport import ShmAlignServer
+        shm_server = ShmAlignServer(service, args.shm_address)
+        shm_server.start()
+        print('[align_service] listening on unix:{}'.format(args.shm_address))
+
+    print('[align_service] listening on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if shm_server is not None:
+            shm_server.close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asynchronous image writer: images are encoded and written on a bounded pool
+of threads (cv2.imencode() and file I/O release the GIL), so that output I/O
+overlaps with alignment instead of adding to it. Files are written
+atomically (into a temp file, then renamed), and submit() blocks when too
+many images are pending, which bounds the memory held by the queue.
+"""
+import os
+import os.path as osp
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import cv2
+
+
+def write_image_atomic(path, img, encode_params=None):
+    """Encode img by the extension of path and write it atomically: readers
+    never see a partially written file.
+
+    Return:
+        number of bytes written
+    """
+    ext = osp.splitext(path)[1]
+    ok, buf = cv2.imencode(ext, img, encode_params or [])
+    if not ok:
+        raise IOError('failed to encode image for ' + path)
+
+    return write_file_atomic(path, buf.tobytes())
+
+
+def write_file_atomic(path, data):
+    """Write data into a temp file next to path, then rename it to path.
+
+    Return:
+        number of bytes written
+    """
+    tmp_path = '{}.tmp.{}.{}'.format(path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        # do not leave a partial temp file behind, e.g. on a full disk
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return len(data)
+
+
+class AsyncImageWriter(object):
+    """Encode and write images on a bounded thread pool.
+
+    The images passed to submit() are referenced until they are written,
+    they must not be modified in place in the meantime.
+    """
+
+    def __init__(self, n_threads=4, max_pending=64, encode_params=None,
+                 make_dirs=True):
+        """Encode and write images on a bounded thread pool.
+
+            Params:
+                n_threads: number of encode/write threads
+                max_pending: max number of queued images, submit() blocks
+                        when it is reached
+                encode_params: default params of cv2.imencode(), e.g.
+                        [cv2.IMWRITE_JPEG_QUALITY, 95]
+                make_dirs: whether to create missing output dirs
+        """
+        self.encode_params = encode_params or []
+        self.make_dirs = make_dirs
+
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.lock = threading.Lock()
+        self.errors = []
+        self.created_dirs = set()
+
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "failed": 0,
+            "bytes": 0,
+            "encode_time": 0.0,
+            "write_time": 0.0,
+            "blocked_time": 0.0
+        }
+        self.start_time = time.time()
+
+        self.threads = []
+        for i in range(max(1, n_threads)):
+            thread = threading.Thread(target=self._loop,
+                                      name='AsyncImageWriter-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, img, path, encode_params=None):
+        """Queue an image to be written into path, the format is given by
+        the extension of path. Blocks while max_pending images are queued.
+        """
+        if not self.threads:
+            raise RuntimeError('AsyncImageWriter is closed')
+
+        t0 = time.time()
+        self.queue.put((img, path, encode_params))
+        blocked = time.time() - t0
+
+        with self.lock:
+            self.stats["submitted"] += 1
+            self.stats["blocked_time"] += blocked
+
+    def _make_dir(self, path):
+        out_dir = osp.dirname(path)
+        if not out_dir or out_dir in self.created_dirs:
+            return
+
+        if not osp.isdir(out_dir):
+            try:
+                os.makedirs(out_dir)
+            except OSError:
+                # created by another thread
+                pass
+        with self.lock:
+            self.created_dirs.add(out_dir)
+
+    def _write(self, img, path, encode_params):
+        if self.make_dirs:
+            self._make_dir(path)
+
+        t0 = time.time()
+        ok, buf = cv2.imencode(osp.splitext(path)[1], img,
+                               self.encode_params if encode_params is None else encode_params)
+        if not ok:
+            raise IOError('failed to encode image for ' + path)
+        t1 = time.time()
+        nbytes = write_file_atomic(path, buf.tobytes())
+        t2 = time.time()
+
+        with self.lock:
+            self.stats["written"] += 1
+            self.stats["bytes"] += nbytes
+            self.stats["encode_time"] += t1 - t0
+            self.stats["write_time"] += t2 - t1
+
+    def _loop(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                self._write(*task)
+            except Exception as err:
+                with self.lock:
+                    self.stats["failed"] += 1
+                    self.errors.append((task[1], '{}: {}'.format(type(err).__name__, err)))
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """Wait until all submitted images are written."""
+        self.queue.join()
+
+    def close(self):
+        """Write all submitted images and stop the threads."""
+        if not self.threads:
+            return
+
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def get_errors(self):
+        """Get (path, error) of the failed writes so far."""
+        with self.lock:
+            return list(self.errors)
+
+    def get_stats(self):
+        """Get counters, plus throughput of images/s and MB/s since start,
+        and encode/write throughput per busy second."""
+        with self.lock:
+            stats = dict(self.stats)
+
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        stats["images_per_sec"] = stats["written"] / elapsed
+        stats["mb_per_sec"] = stats["bytes"] / elapsed / (1024.0 * 1024.0)
+        stats["encodes_per_busy_sec"] = stats["written"] / max(stats["encode_time"], 1e-9)
+        stats["write_mb_per_busy_sec"] = (stats["bytes"] / (1024.0 * 1024.0) /
+                                          max(stats["write_time"], 1e-9))
+        return stats
@@ -0,0 +1,843 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batch face alignment over a detection manifest.
+
+Images flow through a pipeline (see pipeline.py) of three stages with
+bounded queues: decode workers decode images and crop their faces, inference
+workers (one FaceAlignerCaffe each) infer landmarks of batches of images,
+and warp workers warp and write face chips. Bad images are recorded and
+skipped. Progress is checkpointed after every chunk, so a killed job resumes
+where it stopped by running the same command again.
+
+Memory is bounded by the pipeline queues, and by a memory budget on the
+images, faces and crop bytes in flight (--memory-budget-mb,
+--max-inflight-images, --max-inflight-faces). Peak bytes by stage and RSS
+are reported at the end, see memory_monitor.py; --memory-debug adds
+tracemalloc snapshots of each stage.
+
+Latency histograms of each stage, counters and the batch fill ratio are
+served in the Prometheus text format on http://127.0.0.1:<--metrics-port>/metrics,
+see metrics.py.
+
+With --decode-min-face-side, each image is decoded at the smallest reduced
+resolution (cv2.IMREAD_REDUCED_*) which keeps that many pixels on the
+shorter side of every face rect, see decode_planner.py; landmarks are
+mapped back into full resolution pixels.
+
+Images are read through a DecodedImageCache (see image_cache.py) scheduled
+with the uris of each chunk, so an image repeated in the manifest is
+decoded once and the next images are decoded ahead of the decode workers
+(--image-cache-mb). Images decoded as planned by --decode-min-face-side are
+not cached.
+
+With --trace-sample-rate, a sample of the images is traced per face
+through crop, landmark batches and warp (see tracing.py), saved in the
+Chrome trace event format in trace.json of the output dir.
+
+Usage:
+    python batch_align.py --manifest test_imgs_weidong/test_data.json \\
+        --config face_aligner_config.json --output-dir rlt_batch \\
+        --decode-workers 8 --infer-workers 1 --warp-workers 4
+
+Outputs in --output-dir:
+    results.jsonl: one record per face (landmarks in the source image, face
+            score, chip path), or per failed image ("error")
+    chips/<shard>/<line>_<face>.jpg: aligned face chips, --shard-size
+            manifest lines per shard directory
+    or chips/chips-<shard>.rec/.idx/.meta.jsonl: aligned face chips packed
+            in RecordIO shards (--output-format rec), see chip_recordio
+    checkpoint.json: progress of the job
+"""
+import argparse
+import copy
+import json
+import os
+import os.path as osp
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import numpy as np
+import cv2
+
+from face_aligner_mxnet import FaceAlignerCaffe, map_crop_pts_to_image
+from detection_batch import DetectionBatch, get_upright_face_transforms
+from decode_planner import load_image_for_faces, map_pts_to_full_resolution
+from manifest_io import iter_detection_batches, ResultWriter
+from chip_recordio import ChipRecordWriter
+from async_writer import write_image_atomic
+from pipeline import Pipeline, Stage
+from image_cache import DecodedImageCache
+from memory_monitor import MemoryBudget, MemoryTracker, get_nbytes, MB
+from metrics import MetricsRegistry, MetricsServer, stage_timer
+from tracing import Tracer, trace_span
+
+STAGES = ("decode", "crop", "infer", "warp", "write")
+
+
+class StageTimer(object):
+    """Thread-safe busy time and item counts of pipeline stages."""
+
+    def __init__(self, stages=STAGES):
+        self.lock = threading.Lock()
+        self.busy = dict((stage, 0.0) for stage in stages)
+        self.counts = dict((stage, 0) for stage in stages)
+
+    def add(self, stage, seconds, count=1):
+        with self.lock:
+            self.busy[stage] += seconds
+            self.counts[stage] += count
+
+    def get_utilization(self, elapsed, workers):
+        """Get busy time / (elapsed time * number of workers) of each stage.
+
+        Params:
+            elapsed: wall time, in seconds
+            workers: dict of stage -> number of workers
+        """
+        with self.lock:
+            return dict((stage, busy / max(elapsed * workers.get(stage, 1), 1e-9))
+                        for stage, busy in self.busy.items())
+
+
+def load_checkpoint(path):
+    """Load a checkpoint saved by save_checkpoint(), None if there is none."""
+    if not osp.isfile(path):
+        return None
+
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_checkpoint(path, state):
+    """Save checkpoint state, atomically."""
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(state, fp, indent=2)
+    os.rename(tmp_path, path)
+
+
+def get_chip_path(line_idx, face_idx, shard_size, ext='.jpg'):
+    """Get the path of a face chip, relative to the output dir."""
+    return osp.join('chips', '{:06d}'.format(line_idx // shard_size),
+                    '{:09d}_{:03d}{}'.format(line_idx, face_idx, ext))
+
+
+class BatchAligner(object):
+    """Align all faces of a detection manifest, see the module docstring."""
+
+    def __init__(self, config_json, output_dir, decode_workers=4, infer_workers=1,
+                 warp_workers=4, chunk_size=64, crop_scale=1.5,
+                 center_roi_scale=1 / 1.5 * 0.9, skip_quality=('small',),
+                 output_format='dir', shard_size=1000, chip_ext='.jpg',
+                 jpeg_quality=95, image_root='', progress_interval=10.0,
+                 rec_shard_size=100000, rec_encoding='jpg', memory_budget_mb=0,
+                 max_inflight_images=0, max_inflight_faces=0, memory_debug=False,
+                 metrics=None, metrics_port=0, trace_sample_rate=0.0,
+                 decode_min_face_side=0, decode_region=False, image_cache_mb=512):
+        """Align all faces of a detection manifest.
+
+            Params:
+                config_json: config of FaceAlignerCaffe
+                output_dir: output dir, also holds the checkpoint
+                decode_workers: number of threads to decode images and crop faces
+                infer_workers: number of FaceAlignerCaffe instances
+                warp_workers: number of threads to warp and write face chips
+                chunk_size: number of manifest lines per chunk (and checkpoint),
+                        also the max number of images per inference batch
+                crop_scale: scale of FaceAlignerCaffe.rotate_and_crop_faces()
+                center_roi_scale: center_roi_scale of FaceAlignerCaffe.get_landmarks()
+                skip_quality: faces with these "quality" labels are skipped
+                output_format: 'dir' to write chips into sharded dirs,
+                        'rec' to pack them into RecordIO shards,
+                        'none' to write only landmarks
+                shard_size: number of manifest lines per chip shard dir
+                chip_ext: image format of chips, '.jpg' or '.png'
+                jpeg_quality: JPEG quality of chips
+                image_root: dir of relative image uris
+                progress_interval: seconds between progress reports, 0 for none
+                rec_shard_size: number of chips per RecordIO shard
+                rec_encoding: 'jpg', 'png' or 'raw', chip encoding in RecordIO shards
+                memory_budget_mb: max MB of face crops in flight, 0 for no limit
+                max_inflight_images: max images in flight, 0 for no limit
+                max_inflight_faces: max faces in flight, 0 for no limit
+                memory_debug: whether to trace allocations with tracemalloc
+                metrics: None or a metrics.MetricsRegistry to time the stages
+                        into, one is created if metrics_port is set
+                metrics_port: port to serve the metrics on (localhost),
+                        0 for no metrics server
+                trace_sample_rate: fraction of images traced into trace.json
+                        of the output dir, 0 for no tracing
+                decode_min_face_side: if > 0, decode each image at the smallest
+                        reduced resolution which keeps this min side of its
+                        face rects, see decode_planner.plan_decode(); 0 to
+                        decode at full resolution
+                decode_region: with decode_min_face_side, decode only the
+                        region around the faces (JPEG, needs PyTurboJPEG)
+                image_cache_mb: max MB of decoded images cached for the
+                        manifest's next reads, 0 to read with cv2.imread()
+        """
+        config_json = dict(config_json)
+        config_json["verbose"] = 0
+        # chips are warped on the warp workers, not in each aligner
+        config_json["warp_threads"] = 0
+
+        # a copy for each, MxnetFeatureExtractor rewrites its config in place
+        self.aligners = [FaceAlignerCaffe(copy.deepcopy(config_json))
+                         for _ in range(max(1, infer_workers))]
+        # aligners not in use by an inference worker
+        self.free_aligners = queue.Queue()
+        for aligner in self.aligners:
+            self.free_aligners.put(aligner)
+
+        self.chunk_size = chunk_size
+        self.crop_scale = crop_scale
+        self.center_roi_scale = center_roi_scale
+        self.skip_quality = list(skip_quality)
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.chip_ext = chip_ext
+        self.jpeg_quality = jpeg_quality
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+        self.rec_shard_size = rec_shard_size
+        self.rec_encoding = rec_encoding
+        self.rec_writer = None
+        self.image_root = image_root
+        self.progress_interval = progress_interval
+        self.decode_min_face_side = decode_min_face_side
+        self.decode_region = decode_region
+        self.image_cache_bytes = int(image_cache_mb * MB)
+        # created by each run(), None if image_cache_mb is 0
+        self.image_cache = None
+
+        self.workers = {
+            "decode": decode_workers,
+            "crop": decode_workers,
+            "infer": len(self.aligners),
+            "warp": warp_workers,
+            "write": warp_workers
+        }
+        self.pipeline = None
+
+        self.memory_budget = MemoryBudget(int(memory_budget_mb * MB),
+                                          max_inflight_images, max_inflight_faces)
+        self.memory_tracker = MemoryTracker(debug=memory_debug)
+        for aligner in self.aligners:
+            aligner.memory_tracker = self.memory_tracker
+
+        if metrics is None and metrics_port:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+        if metrics is not None:
+            for aligner in self.aligners:
+                aligner.set_metrics(metrics)
+        self.tracer = Tracer(trace_sample_rate) if trace_sample_rate > 0 else None
+
+        self.metrics_server = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(metrics, port=metrics_port)
+            self.metrics_server.start()
+
+        self.timer = StageTimer()
+        self.output_dir = None
+        self.checkpoint_path = None
+        self.results_path = None
+        self.set_output_dir(output_dir)
+        self.stop_event = threading.Event()
+        self.abort_event = threading.Event()
+        self.writer = None
+        self.state = None
+        self.start_time = None
+        self.start_faces = 0
+        self.last_report = 0
+
+    def set_output_dir(self, output_dir):
+        """Set the output dir (and checkpoint) of the next run()."""
+        self.output_dir = output_dir
+        self.checkpoint_path = osp.join(output_dir, 'checkpoint.json')
+        self.results_path = osp.join(output_dir, 'results.jsonl')
+        self.trace_path = osp.join(output_dir, 'trace.json')
+
+    def stop(self):
+        """Stop run() after the chunks in flight, thread-safe."""
+        self.stop_event.set()
+
+    def abort(self):
+        """Stop run() without writing the chunks in flight, e.g. when the
+        output dir is no longer ours, thread-safe."""
+        self.abort_event.set()
+        self.stop_event.set()
+
+    def _get_image_path(self, uri):
+        if self.image_root and not osp.isabs(uri):
+            return osp.join(self.image_root, uri)
+        return uri
+
+    def _decode(self, item, faces):
+        """Decode the image of an item, as planned for its faces if
+        decode_min_face_side, through the image cache if _iter_items()
+        scheduled its read.
+
+        Return:
+            img: numpy array, or None if it cannot be read
+            faces: the faces in the decoded image's pixels
+            plan: the decode plan (see decode_planner), None if decoded at
+                    full resolution
+        """
+        path = self._get_image_path(item["uri"])
+        if not self.decode_min_face_side:
+            if item.pop("cached_read", False):
+                return self.image_cache.get_image(path), faces, None
+            return cv2.imread(path), faces, None
+
+        img, pts_with_angles, plan = load_image_for_faces(
+            path, faces.to_pts_with_angles(), self.decode_min_face_side,
+            self.crop_scale, self.decode_region)
+        decoded_faces = DetectionBatch(
+            [pt_angle[0] for pt_angle in pts_with_angles], faces.angles,
+            faces.scores, faces.quality, faces.q_scores, faces.image_idx)
+        return img, decoded_faces, plan
+
+    def _decode_and_crop(self, item):
+        """Decode one image and crop its faces, on a decode worker."""
+        item["crops"] = []
+        faces = item["faces"]
+        trace = None
+        if self.tracer is not None:
+            # finished by _warp_stage()
+            trace = item["trace"] = self.tracer.start_trace(
+                'image', line=item["line"], uri=item["uri"], n_faces=len(faces))
+        # released by _warp_stage()
+        with trace_span(trace, "memory_budget"):
+            self.memory_budget.acquire(1, len(faces))
+        if not len(faces):
+            self._release_cached_read(item)
+            return item
+
+        tracker = self.memory_tracker
+        img_bytes = 0
+        try:
+            if not item["uri"]:
+                raise ValueError('no uri')
+
+            t0 = time.time()
+            with tracker.trace("decode"), stage_timer(self.metrics, "decode"), \
+                    trace_span(trace, "decode"):
+                img, faces, item["decode_plan"] = self._decode(item, faces)
+            self.timer.add("decode", time.time() - t0)
+            if img is None:
+                raise IOError('failed to read image')
+            if self.metrics is not None:
+                self.metrics.images.inc()
+            img_bytes = img.nbytes
+            tracker.add("decode", img_bytes)
+
+            t0 = time.time()
+            with tracker.trace("crops"):
+                crops = self.aligners[0].rotate_and_crop_faces(
+                    img, faces, self.crop_scale, trace=trace)
+                # copy crops that are views, they would keep img alive
+                item["crops"] = [crop if crop.base is None else crop.copy()
+                                 for crop in crops]
+            item["crop_transforms"] = get_upright_face_transforms(
+                faces.pts, faces.angles, self.crop_scale)[0]
+            self.timer.add("crop", time.time() - t0, len(faces))
+
+            item["crop_bytes"] = get_nbytes(item["crops"])
+            tracker.add("crops", item["crop_bytes"])
+            self.memory_budget.charge(item["crop_bytes"])
+        except Exception as err:
+            item["error"] = '{}: {}'.format(type(err).__name__, err)
+            item["crops"] = []
+            self._release_cached_read(item)
+        finally:
+            tracker.sub("decode", img_bytes)
+
+        return item
+
+    def _release_cached_read(self, item):
+        """Count the scheduled read of an item which was not done."""
+        if item.pop("cached_read", False):
+            self.image_cache.release(self._get_image_path(item["uri"]))
+
+    def _infer_items(self, items):
+        """Infer landmarks of all faces of a batch of images, on an
+        inference worker."""
+        crops = [crop for item in items for crop in item["crops"]]
+        if not crops:
+            return items
+
+        face_traces = None
+        if any(item.get("trace") is not None for item in items):
+            face_traces = [(item.get("trace"), i) for item in items
+                           for i in range(len(item["crops"]))]
+
+        aligner = self.free_aligners.get()
+        try:
+            t0 = time.time()
+            five_pts_list, face_scores = aligner.get_landmarks_and_scores(
+                crops, self.center_roi_scale, face_traces=face_traces)
+            self.timer.add("infer", time.time() - t0, len(crops))
+
+            keep = None
+            if aligner.gate_config["enabled"]:
+                keep, reasons = aligner.gate_faces(
+                    crops, five_pts_list, face_scores, self.center_roi_scale)
+        finally:
+            self.free_aligners.put(aligner)
+
+        k = 0
+        for item in items:
+            n_faces = len(item["crops"])
+            item["five_pts"] = five_pts_list[k:k + n_faces]
+            item["face_scores"] = face_scores[k:k + n_faces]
+            if keep is not None:
+                item["reject_reasons"] = [None if keep[i] else reasons[i]
+                                          for i in range(k, k + n_faces)]
+            k += n_faces
+
+        return items
+
+    def _warp_and_write(self, item):
+        """Warp the face chips of one image and write them, on a warp worker.
+
+        Return:
+            a list of result records
+        """
+        if item.get("error"):
+            return [{"line": item["line"], "uri": item["uri"], "error": item["error"]}]
+
+        records = []
+        try:
+            n_faces = len(item["crops"])
+            image_pts_list = [map_crop_pts_to_image(
+                item["five_pts"][i], item["crop_transforms"][i]) for i in range(n_faces)]
+            if item.get("decode_plan") is not None:
+                image_pts_list = [map_pts_to_full_resolution(pts, item["decode_plan"])
+                                  for pts in image_pts_list]
+            chip_idx = [i for i in range(n_faces)
+                        if not item.get("reject_reasons") or
+                        item["reject_reasons"][i] is None]
+
+            chips = {}
+            trace = item.get("trace")
+            if self.output_format != 'none' and chip_idx:
+                t0 = time.time()
+                with self.memory_tracker.trace("chips"):
+                    face_chips = self.aligners[0].get_aligned_face_chips(
+                        [item["crops"][i] for i in chip_idx],
+                        [item["five_pts"][i] for i in chip_idx],
+                        face_traces=trace and [(trace, i) for i in chip_idx])
+                self.timer.add("warp", time.time() - t0, len(chip_idx))
+                chip_bytes = get_nbytes(face_chips)
+                self.memory_tracker.add("chips", chip_bytes)
+
+                t0 = time.time()
+                try:
+                    with trace_span(trace, "write_chips", n_faces=len(chip_idx)):
+                        for i, chip in zip(chip_idx, face_chips):
+                            chips[i] = self._write_chip(item, i, chip, image_pts_list[i])
+                finally:
+                    self.memory_tracker.sub("chips", chip_bytes)
+                self.timer.add("write", time.time() - t0, len(chip_idx))
+
+            for i in range(n_faces):
+                record = {
+                    "line": item["line"],
+                    "uri": item["uri"],
+                    "face_idx": int(item["face_idx"][i]),
+                    "five_pts": np.round(image_pts_list[i], 2)
+                }
+                score = float(item["face_scores"][i])
+                if not np.isnan(score):
+                    record["face_score"] = score
+                if item.get("reject_reasons") and item["reject_reasons"][i]:
+                    record["rejected"] = item["reject_reasons"][i]
+                if i in chips:
+                    record["chip"] = chips[i]
+                records.append(record)
+        except Exception as err:
+            records = [{"line": item["line"], "uri": item["uri"],
+                        "error": '{}: {}'.format(type(err).__name__, err)}]
+
+        return records
+
+    def _warp_stage(self, item):
+        """Return: the line indices of the chunk if item is its last image
+        (else None), and the result records of item."""
+        try:
+            return item.get("chunk_lines"), self._warp_and_write(item)
+        finally:
+            crop_bytes = item.get("crop_bytes", 0)
+            item["crops"] = []
+            self.memory_tracker.sub("crops", crop_bytes)
+            self.memory_budget.release(1, len(item["faces"]), crop_bytes)
+            if item.get("trace") is not None:
+                item["trace"].finish()
+
+    def _write_chip(self, item, i, chip, image_pts):
+        """Write the chip of the i-th face of item, return its reference."""
+        face_idx = int(item["face_idx"][i])
+
+        if self.output_format == 'rec':
+            ref = self.rec_writer.write_chip(
+                chip, image_pts, item["faces"].pts[i],
+                meta={"uri": item["uri"], "line": item["line"], "face_idx": face_idx},
+                payload=self.rec_writer.encode_chip(chip))
+            return osp.join('chips', ref)
+
+        chip_path = get_chip_path(item["line"], face_idx,
+                                  self.shard_size, self.chip_ext)
+        full_path = osp.join(self.output_dir, chip_path)
+        chip_dir = osp.dirname(full_path)
+        if not osp.isdir(chip_dir):
+            try:
+                os.makedirs(chip_dir)
+            except OSError:
+                # created by another worker
+                pass
+        write_image_atomic(full_path, chip, self.encode_params)
+
+        return chip_path
+
+    def _make_items(self, line_indices, uris, detections):
+        """Split a chunk of the manifest into per-image work items."""
+        # image_idx is sorted, faces are indexed in their manifest entry
+        # before any filtering
+        first_idx = np.searchsorted(detections.image_idx, detections.image_idx)
+        face_idx = np.arange(len(detections)) - first_idx
+
+        keep = ~detections.has_quality(self.skip_quality)
+        faces = detections.select(keep)
+        face_idx = face_idx[keep]
+        bounds = np.searchsorted(faces.image_idx, np.arange(len(uris) + 1))
+
+        items = []
+        for i, (line_idx, uri) in enumerate(zip(line_indices, uris)):
+            items.append({
+                "line": line_idx,
+                "uri": uri,
+                "faces": faces.select(slice(bounds[i], bounds[i + 1])),
+                "face_idx": face_idx[bounds[i]:bounds[i + 1]]
+            })
+
+        return items
+
+    def _iter_items(self, manifest):
+        """Iterate over the work items of manifest from the checkpoint, the
+        last item of each chunk holds the line indices of the chunk."""
+        chunks = iter_detection_batches(
+            manifest, self.chunk_size, self.state["next_line"])
+        for line_indices, uris, detections in chunks:
+            if self.stop_event.is_set():
+                return
+
+            items = self._make_items(line_indices, uris, detections)
+            items[-1]["chunk_lines"] = line_indices
+            if self.image_cache is not None and not self.decode_min_face_side:
+                # each read is done by _decode() or released
+                paths = []
+                for item in items:
+                    if item["uri"] and len(item["faces"]):
+                        item["cached_read"] = True
+                        paths.append(self._get_image_path(item["uri"]))
+                self.image_cache.start_prefetch(paths)
+            for item in items:
+                yield item
+
+    def _make_pipeline(self):
+        n_decode = self.workers["decode"]
+        n_infer = self.workers["infer"]
+        n_warp = self.workers["warp"]
+        return Pipeline([
+            Stage("decode", self._decode_and_crop, n_decode,
+                  queue_size=max(self.chunk_size, 2 * n_decode)),
+            Stage("infer", self._infer_items, n_infer,
+                  queue_size=2 * self.chunk_size, batch_size=self.chunk_size,
+                  max_wait=0.02, batched=True),
+            Stage("warp", self._warp_stage, n_warp,
+                  queue_size=max(self.chunk_size, 2 * n_warp))
+        ])
+
+    def _commit(self, line_indices, records_list):
+        """Write the results of a chunk and checkpoint it."""
+        n_faces = 0
+        n_failed = 0
+        for records in records_list:
+            for record in records:
+                self.writer.write(record)
+                if "error" in record:
+                    n_failed += 1
+                else:
+                    n_faces += 1
+        self.writer.flush()
+        if self.rec_writer is not None:
+            self.rec_writer.flush()
+
+        self.state["next_line"] = line_indices[-1] + 1
+        self.state["results_bytes"] = osp.getsize(self.results_path)
+        self.state["images"] += len(records_list)
+        self.state["faces"] += n_faces
+        self.state["failed_images"] += n_failed
+        save_checkpoint(self.checkpoint_path, self.state)
+
+        self._report_progress()
+
+    def _report_progress(self, force=False):
+        now = time.time()
+        if not force and (not self.progress_interval or
+                          now - self.last_report < self.progress_interval):
+            return
+        self.last_report = now
+
+        elapsed = max(now - self.start_time, 1e-9)
+        utilization = self.timer.get_utilization(elapsed, self.workers)
+        print('[batch_align] lines={} images={} faces={} failed={} '
+              'faces/s={:.1f} rss={:.0f}MB util: {} bottleneck: {}'.format(
+                  self.state["next_line"], self.state["images"],
+                  self.state["faces"], self.state["failed_images"],
+                  (self.state["faces"] - self.start_faces) / elapsed,
+                  self.memory_tracker.get_stats()["rss_bytes"] / MB,
+                  ' '.join('{}={:.0%}'.format(stage, utilization[stage])
+                           for stage in STAGES),
+                  self.pipeline.get_bottleneck() if self.pipeline else None))
+        sys.stdout.flush()
+
+    def _start(self, manifest, resume=True):
+        """Load or create the checkpoint, and open the results file."""
+        if not osp.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        state = load_checkpoint(self.checkpoint_path) if resume else None
+        if state is not None and state["manifest"] != osp.abspath(manifest):
+            raise ValueError('checkpoint {} is for manifest {}, use --restart '
+                             'or another --output-dir'.format(
+                                 self.checkpoint_path, state["manifest"]))
+
+        if state is None:
+            state = {
+                "manifest": osp.abspath(manifest),
+                "next_line": 0,
+                "results_bytes": 0,
+                "images": 0,
+                "faces": 0,
+                "failed_images": 0,
+                "done": False
+            }
+            open(self.results_path, 'w').close()
+        else:
+            # drop results written after the last checkpoint
+            with open(self.results_path, 'r+') as fp:
+                fp.truncate(state["results_bytes"])
+            print('[batch_align] resuming from line {}'.format(state["next_line"]))
+
+        self.state = state
+        self.writer = ResultWriter(self.results_path, flush_every=10000, append=True)
+        if self.output_format == 'rec':
+            self.rec_writer = ChipRecordWriter(
+                osp.join(self.output_dir, 'chips'), shard_size=self.rec_shard_size,
+                encoding=self.rec_encoding, jpeg_quality=self.jpeg_quality)
+        # utilization is of this run, as elapsed is
+        self.timer = StageTimer()
+        self.start_time = time.time()
+        self.start_faces = state["faces"]
+        self.last_report = self.start_time
+
+    def run(self, manifest, resume=True):
+        """Align all faces of manifest (.json or .jsonl), resuming from the
+        checkpoint in output_dir if there is one and resume is True.
+        A run stopped by stop() or abort() returns with state["done"] False.
+
+        Return:
+            the final checkpoint state, a dict
+        """
+        self._start(manifest, resume)
+        if self.state["done"]:
+            self._finish()
+            return self.state
+        self.stop_event.clear()
+        self.abort_event.clear()
+
+        self.pipeline = self._make_pipeline()
+        if self.image_cache_bytes > 0:
+            # a new one, reads scheduled by a stopped run are never done
+            self.image_cache = DecodedImageCache(
+                self.image_cache_bytes, lookahead=2 * self.workers["decode"])
+        self.memory_budget.reset()
+        self.memory_tracker.start()
+        try:
+            self.pipeline.feed(self._iter_items(manifest))
+            records_list = []
+            for chunk_lines, records in self.pipeline:
+                if self.abort_event.is_set():
+                    break
+                records_list.append(records)
+                if chunk_lines is not None:
+                    self._commit(chunk_lines, records_list)
+                    records_list = []
+
+            if not self.stop_event.is_set():
+                self.state["done"] = True
+                save_checkpoint(self.checkpoint_path, self.state)
+        finally:
+            # wakes up decode workers waiting for the budget
+            self.memory_budget.close()
+            self.pipeline.stop()
+            if self.image_cache is not None:
+                self.image_cache.stop_prefetch()
+            self.memory_tracker.stop()
+            self._finish()
+            if self.tracer is not None:
+                self.tracer.save(self.trace_path)
+                self.tracer.clear()
+
+        self._report_progress(force=True)
+        if self.progress_interval:
+            print(self.pipeline.format_stats())
+            print('[batch_align] memory {}'.format(self.memory_tracker.format_stats()))
+            if self.memory_budget.is_limited():
+                print('[batch_align] memory budget: {}'.format(
+                    self.memory_budget.get_stats()))
+            if self.image_cache is not None:
+                print('[batch_align] image cache: {}'.format(
+                    self.image_cache.get_stats()))
+            if self.metrics is not None:
+                print('[batch_align] metrics {}'.format(self.metrics.format_stats()))
+        return self.state
+
+    def _finish(self):
+        self.writer.close()
+        if self.rec_writer is not None:
+            self.rec_writer.close()
+            self.rec_writer = None
+
+    def close(self):
+        if self.image_cache is not None:
+            self.image_cache.stop_prefetch()
+        for aligner in self.aligners:
+            aligner.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+
+def add_batch_args(parser):
+    """Add the options of BatchAligner to an argparse parser."""
+    parser.add_argument('--image-root', default='',
+                        help='dir of relative image uris')
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--infer-workers', type=int, default=1)
+    parser.add_argument('--warp-workers', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=64,
+                        help='manifest lines per chunk and checkpoint')
+    parser.add_argument('--crop-scale', type=float, default=1.5)
+    parser.add_argument('--center-roi-scale', type=float, default=1 / 1.5 * 0.9)
+    parser.add_argument('--skip-quality', default='small',
+                        help='comma separated quality labels of faces to skip')
+    parser.add_argument('--output-format', choices=['dir', 'rec', 'none'], default='dir',
+                        help='dir: chips in sharded dirs, rec: chips in RecordIO '
+                        'shards, none: only landmarks')
+    parser.add_argument('--shard-size', type=int, default=1000,
+                        help='manifest lines per chip shard dir')
+    parser.add_argument('--chip-ext', choices=['.jpg', '.png'], default='.jpg')
+    parser.add_argument('--jpeg-quality', type=int, default=95)
+    parser.add_argument('--rec-shard-size', type=int, default=100000,
+                        help='chips per RecordIO shard')
+    parser.add_argument('--rec-encoding', choices=['jpg', 'png', 'raw'], default='jpg',
+                        help='chip encoding in RecordIO shards')
+    parser.add_argument('--progress-interval', type=float, default=10.0,
+                        help='seconds between progress reports')
+    parser.add_argument('--memory-budget-mb', type=float, default=0,
+                        help='max MB of face crops in flight, 0 for no limit')
+    parser.add_argument('--max-inflight-images', type=int, default=0,
+                        help='max images in flight, 0 for no limit')
+    parser.add_argument('--max-inflight-faces', type=int, default=0,
+                        help='max faces in flight, 0 for no limit')
+    parser.add_argument('--memory-debug', action='store_true',
+                        help='trace allocations of each stage with tracemalloc (slow)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve Prometheus metrics on this port of localhost, '
+                             '0 for none')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.0,
+                        help='fraction of images traced per face into trace.json '
+                             'of the output dir, 0 for none')
+    parser.add_argument('--decode-min-face-side', type=int, default=0,
+                        help='decode images at the smallest reduced resolution which '
+                             'keeps this min side of the face rects, 0 for full '
+                             'resolution')
+    parser.add_argument('--decode-region', action='store_true',
+                        help='with --decode-min-face-side, decode only the region '
+                             'around the faces (JPEG, needs PyTurboJPEG)')
+    parser.add_argument('--image-cache-mb', type=float, default=512,
+                        help='max MB of decoded images cached for the next reads '
+                             'of the manifest, 0 for none')
+
+
+def get_batch_kwargs(args):
+    """Get the keyword args of BatchAligner from the options of add_batch_args()."""
+    return {
+        "decode_workers": args.decode_workers,
+        "infer_workers": args.infer_workers,
+        "warp_workers": args.warp_workers,
+        "chunk_size": args.chunk_size,
+        "crop_scale": args.crop_scale,
+        "center_roi_scale": args.center_roi_scale,
+        "skip_quality": [label.strip() for label in args.skip_quality.split(',')
+                         if label.strip()],
+        "output_format": args.output_format,
+        "shard_size": args.shard_size,
+        "chip_ext": args.chip_ext,
+        "jpeg_quality": args.jpeg_quality,
+        "rec_shard_size": args.rec_shard_size,
+        "rec_encoding": args.rec_encoding,
+        "image_root": args.image_root,
+        "progress_interval": args.progress_interval,
+        "memory_budget_mb": args.memory_budget_mb,
+        "max_inflight_images": args.max_inflight_images,
+        "max_inflight_faces": args.max_inflight_faces,
+        "memory_debug": args.memory_debug,
+        "metrics_port": args.metrics_port,
+        "trace_sample_rate": args.trace_sample_rate,
+        "decode_min_face_side": args.decode_min_face_side,
+        "decode_region": args.decode_region,
+        "image_cache_mb": args.image_cache_mb
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Align all faces of a detection manifest')
+    parser.add_argument('--manifest', required=True,
+                        help='detection manifest, .json (as test_data.json) or .jsonl')
+    parser.add_argument('--config', default='face_aligner_config.json',
+                        help='config of FaceAlignerCaffe')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint and start over')
+    add_batch_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    with open(args.config, 'r') as fp:
+        config_json = json.load(fp)
+
+    batch_aligner = BatchAligner(config_json, args.output_dir,
+                                 **get_batch_kwargs(args))
+    try:
+        batch_aligner.run(args.manifest, resume=not args.restart)
+    finally:
+        batch_aligner.close()
+
+
+if __name__ == '__main__':
+    main()
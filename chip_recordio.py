@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Packed output of aligned face chips: shards of MXNet indexed RecordIO files
+(.rec + .idx, the format of mx.recordio.MXIndexedRecordIO), written
+sequentially and read back by index, so that millions of chips do not
+become millions of files.
+
+Each record is packed as by mx.recordio.pack_img(): an IRHeader whose label
+is a float32 array, followed by the JPEG (or PNG) encoded chip, so the shards
+can be fed into mx.io.ImageRecordIter (label_width=18) directly. The label
+layout is:
+
+    label[0:10]: 5 landmarks in the source image, [x1, y1, ..., x5, y5]
+    label[10:18]: face rect in the source image, [x1, y1, ..., x4, y4]
+
+Chips can also be stored raw (encoding='raw'), then records hold the chip
+pixels, and their shapes are in the side file. Each shard also has a
+.meta.jsonl side file with one line per record (id, source uri and more),
+for lookups without unpacking the records.
+
+mxnet is not needed to write or read the shards.
+"""
+import json
+import os
+import os.path as osp
+import re
+import struct
+import threading
+
+import numpy as np
+import cv2
+
+# see dmlc-core/include/dmlc/recordio.h
+RECORDIO_MAGIC = 0xced7230a
+MAX_RECORD_LENGTH = (1 << 29) - 1
+
+# see mx.recordio.IRHeader: flag, label, id, id2
+IR_FORMAT = '<IfQQ'
+IR_SIZE = struct.calcsize(IR_FORMAT)
+
+LABEL_WIDTH = 18
+
+
+def pack_record(label, data, record_id=0, record_id2=0):
+    """Pack a record as mx.recordio.pack().
+
+    Params:
+        label: a float or a float array
+        data: record payload, bytes
+    Return:
+        bytes
+    """
+    label = np.asarray(label, dtype=np.float32).ravel()
+    if label.size == 1:
+        header = struct.pack(IR_FORMAT, 0, float(label[0]), record_id, record_id2)
+        return header + data
+
+    header = struct.pack(IR_FORMAT, label.size, 0.0, record_id, record_id2)
+    return header + label.tobytes() + data
+
+
+def unpack_record(buf):
+    """Unpack a record packed by pack_record() (or mx.recordio.pack()).
+
+    Return:
+        (label, record_id, record_id2), data; label is a float or a
+        float32 array
+    """
+    flag, label, record_id, record_id2 = struct.unpack(IR_FORMAT, buf[:IR_SIZE])
+    buf = buf[IR_SIZE:]
+    if flag > 0:
+        label = np.frombuffer(buf[:flag * 4], dtype=np.float32)
+        buf = buf[flag * 4:]
+
+    return (label, record_id, record_id2), buf
+
+
+class IndexedRecordWriter(object):
+    """Sequential writer of one .rec/.idx pair, as mx.recordio.MXIndexedRecordIO
+    in 'w' mode."""
+
+    def __init__(self, rec_path, idx_path):
+        self.rec_path = rec_path
+        self.idx_path = idx_path
+        self.frec = open(rec_path, 'wb')
+        self.fidx = open(idx_path, 'w')
+
+    def write(self, key, buf):
+        length = len(buf)
+        if length > MAX_RECORD_LENGTH:
+            raise ValueError('record of {} bytes is too large'.format(length))
+
+        pos = self.frec.tell()
+        # cflag = 0: a whole record
+        self.frec.write(struct.pack('<II', RECORDIO_MAGIC, length))
+        self.frec.write(buf)
+        pad = (4 - length % 4) % 4
+        if pad:
+            self.frec.write(b'\x00' * pad)
+
+        self.fidx.write('{}\t{}\n'.format(key, pos))
+
+    def tell(self):
+        return self.frec.tell()
+
+    def flush(self):
+        self.frec.flush()
+        self.fidx.flush()
+
+    def close(self):
+        if self.frec is not None:
+            self.frec.close()
+            self.fidx.close()
+            self.frec = None
+            self.fidx = None
+
+
+class IndexedRecordReader(object):
+    """Random-access reader of one .rec/.idx pair, thread-safe."""
+
+    def __init__(self, rec_path, idx_path=None):
+        if idx_path is None:
+            idx_path = osp.splitext(rec_path)[0] + '.idx'
+
+        self.rec_path = rec_path
+        self.index = {}
+        self.keys = []
+        with open(idx_path, 'r') as fp:
+            for line in fp:
+                line = line.strip().split('\t')
+                if len(line) < 2:
+                    continue
+                key = int(line[0])
+                self.index[key] = int(line[1])
+                self.keys.append(key)
+
+        self.frec = open(rec_path, 'rb')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read_idx(self, key):
+        """Read the record of key, bytes."""
+        pos = self.index[key]
+        with self.lock:
+            self.frec.seek(pos)
+            magic, lrecord = struct.unpack('<II', self.frec.read(8))
+            if magic != RECORDIO_MAGIC:
+                raise IOError('invalid record at {} of {}'.format(pos, self.rec_path))
+            if lrecord >> 29:
+                raise IOError('multi-part records are not supported')
+            return self.frec.read(lrecord & MAX_RECORD_LENGTH)
+
+    def close(self):
+        if self.frec is not None:
+            self.frec.close()
+            self.frec = None
+
+
+def make_chip_label(five_pts, box_pts):
+    """Make the label of a chip record, see the module docstring."""
+    label = np.zeros(LABEL_WIDTH, dtype=np.float32)
+    label[0:10] = np.reshape(np.float32(five_pts), -1)[:10]
+    if box_pts is not None:
+        label[10:18] = np.reshape(np.float32(box_pts), -1)[:8]
+    return label
+
+
+class ChipRecordWriter(object):
+    """Thread-safe writer of face chips into RecordIO shards
+    <prefix>-<shard>.rec/.idx/.meta.jsonl in output_dir, a new shard is
+    started every shard_size chips.
+
+    Shards are never appended to: a new writer on the same output_dir starts
+    after the last existing shard (e.g. when a batch job resumes), records
+    written after the last checkpoint of a killed job stay unreferenced.
+    """
+
+    def __init__(self, output_dir, prefix='chips', shard_size=100000,
+                 encoding='jpg', jpeg_quality=95):
+        """Thread-safe writer of face chips into RecordIO shards.
+
+            Params:
+                output_dir: output dir of the shards
+                prefix: file name prefix of the shards
+                shard_size: number of chips per shard
+                encoding: 'jpg', 'png' or 'raw'
+                jpeg_quality: JPEG quality if encoding is 'jpg'
+        """
+        if encoding not in ('jpg', 'png', 'raw'):
+            raise ValueError('encoding must be one of "jpg", "png" or "raw"')
+
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.encoding = encoding
+        self.encode_params = []
+        if encoding == 'jpg':
+            self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+
+        if not osp.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        self.lock = threading.Lock()
+        self.shard_idx = len(list_shards(output_dir, prefix)) - 1
+        self.writer = None
+        self.meta_fp = None
+        self.n_in_shard = 0
+        self.n_written = 0
+
+    def _open_shard(self):
+        self._close_shard()
+        self.shard_idx += 1
+        base = osp.join(self.output_dir, '{}-{:05d}'.format(self.prefix, self.shard_idx))
+        self.writer = IndexedRecordWriter(base + '.rec', base + '.idx')
+        self.meta_fp = open(base + '.meta.jsonl', 'w')
+        self.n_in_shard = 0
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.meta_fp.close()
+            self.writer = None
+            self.meta_fp = None
+
+    def encode_chip(self, chip):
+        """Encode a chip into the record payload, bytes."""
+        if self.encoding == 'raw':
+            return np.ascontiguousarray(chip).tobytes()
+
+        ok, buf = cv2.imencode('.' + self.encoding, chip, self.encode_params)
+        if not ok:
+            raise IOError('failed to encode chip')
+        return buf.tobytes()
+
+    def write_chip(self, chip, five_pts, box_pts=None, meta=None, payload=None):
+        """Write one face chip.
+
+        Params:
+            chip: aligned face chip, numpy array
+            five_pts: 5 landmarks in the source image
+            box_pts: None or the face rect in the source image, 4 pts
+            meta: None or a dict of JSON types for the .meta.jsonl side
+                    file, e.g. {"uri": ..., "face_idx": ...}
+            payload: None or the already encoded chip from encode_chip(),
+                    to encode outside of the writer's lock
+        Return:
+            reference of the record, '<shard file name>#<id>', see
+            ChipRecordReader.read_ref()
+        """
+        if payload is None:
+            payload = self.encode_chip(chip)
+        label = make_chip_label(five_pts, box_pts)
+
+        meta = dict(meta or {})
+        if self.encoding == 'raw':
+            meta["shape"] = list(chip.shape)
+            meta["dtype"] = chip.dtype.str
+
+        with self.lock:
+            if self.writer is None or self.n_in_shard >= self.shard_size:
+                self._open_shard()
+
+            record_id = self.n_in_shard
+            self.writer.write(record_id, pack_record(label, payload, record_id))
+            meta["id"] = record_id
+            self.meta_fp.write(json.dumps(meta, separators=(',', ':')) + '\n')
+            self.n_in_shard += 1
+            self.n_written += 1
+
+            return '{}#{}'.format(osp.basename(self.writer.rec_path), record_id)
+
+    def flush(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.flush()
+                self.meta_fp.flush()
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+
+
+def list_shards(output_dir, prefix='chips'):
+    """List the .rec shards of prefix in output_dir, sorted."""
+    if not osp.isdir(output_dir):
+        return []
+
+    pattern = re.compile(r'^{}-\d+\.rec$'.format(re.escape(prefix)))
+    return sorted(name for name in os.listdir(output_dir) if pattern.match(name))
+
+
+class ChipRecordReader(object):
+    """Random-access reader of the shards written by ChipRecordWriter."""
+
+    def __init__(self, output_dir, prefix='chips'):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.readers = {}
+        self.metas = {}
+        self.lock = threading.Lock()
+
+    def get_shards(self):
+        return list_shards(self.output_dir, self.prefix)
+
+    def _get_reader(self, shard_name):
+        with self.lock:
+            reader = self.readers.get(shard_name)
+            if reader is None:
+                reader = IndexedRecordReader(osp.join(self.output_dir, shard_name))
+                self.readers[shard_name] = reader
+            return reader
+
+    def get_meta(self, shard_name):
+        """Get the side file records of a shard, a dict of id -> meta."""
+        with self.lock:
+            metas = self.metas.get(shard_name)
+        if metas is None:
+            metas = {}
+            meta_path = osp.join(self.output_dir,
+                                 osp.splitext(shard_name)[0] + '.meta.jsonl')
+            if osp.isfile(meta_path):
+                with open(meta_path, 'r') as fp:
+                    for line in fp:
+                        if line.strip():
+                            meta = json.loads(line)
+                            metas[meta["id"]] = meta
+            with self.lock:
+                self.metas[shard_name] = metas
+        return metas
+
+    def read(self, shard_name, record_id, decode=True):
+        """Read one chip.
+
+        Params:
+            shard_name: file name of the .rec shard
+            record_id: id of the record in the shard
+            decode: whether to decode the chip, or return its payload
+        Return:
+            chip: numpy array, or the payload bytes if not decode
+            label: float32 array, see the module docstring
+            meta: the side file record of the chip
+        """
+        buf = self._get_reader(shard_name).read_idx(record_id)
+        (label, _, _), payload = unpack_record(buf)
+        meta = self.get_meta(shard_name).get(record_id, {})
+
+        if not decode:
+            return payload, label, meta
+
+        if "shape" in meta:
+            chip = np.frombuffer(payload, dtype=np.dtype(meta.get("dtype", '|u1')))
+            chip = chip.reshape(meta["shape"])
+        else:
+            chip = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8),
+                                cv2.IMREAD_UNCHANGED)
+
+        return chip, label, meta
+
+    def read_ref(self, ref, decode=True):
+        """Read a chip by its reference from ChipRecordWriter.write_chip(),
+        a leading dir of the reference is ignored."""
+        shard_name, record_id = ref.rsplit('#', 1)
+        return self.read(osp.basename(shard_name), int(record_id), decode)
+
+    def iter_shard(self, shard_name, decode=True):
+        """Iterate over the chips of a shard in record order.
+
+        Return:
+            an iterator of (record_id, chip, label, meta)
+        """
+        for record_id in self._get_reader(shard_name).keys:
+            chip, label, meta = self.read(shard_name, record_id, decode)
+            yield record_id, chip, label, meta
+
+    def close(self):
+        with self.lock:
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {}
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Decode planner: read the face rects of an image first, then decode the image
+at the smallest resolution (cv2.IMREAD_REDUCED_*) which still has enough
+pixels for every face, and optionally only the region around the faces.
+
+Region-only decoding needs PyTurboJPEG (pip install PyTurboJPEG), it is
+only used for JPEG files; without it the whole (reduced) image is decoded.
+"""
+import math
+
+import numpy as np
+import cv2
+
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+# (reduce factor, color flag, grey flag)
+REDUCED_DECODE_FLAGS = [
+    (1, cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE),
+    (2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    (4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (8, cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+]
+
+# JPEG MCU size is at most 16x16, region crops are aligned to it
+JPEG_MCU_SIZE = 16
+
+_turbo_jpeg = None
+
+
+def get_turbo_jpeg():
+    """Get the shared TurboJPEG decoder, or None if PyTurboJPEG is missing."""
+    global _turbo_jpeg
+    if _turbo_jpeg is None and TurboJPEG is not None:
+        _turbo_jpeg = TurboJPEG()
+    return _turbo_jpeg
+
+
+def get_face_side(pts):
+    """Get the shorter side length of a face rect.
+
+    Params:
+        pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+    Return:
+        float
+    """
+    pts = np.asarray(pts, dtype=np.float32)
+    sides = np.hypot(*(np.roll(pts, -1, axis=0) - pts).T)
+    return float(sides.min())
+
+
+def get_faces_region(pts_with_angles, crop_scale=1.0):
+    """Get the bounding region of all faces, large enough to hold the crops
+    of FaceAlignerCaffe.rotate_and_crop_faces(scale=crop_scale).
+
+    Return:
+        [x1, y1, x2, y2], ints
+    """
+    x1 = y1 = float('inf')
+    x2 = y2 = -float('inf')
+
+    for pt_angle in pts_with_angles:
+        pts = np.asarray(pt_angle[0], dtype=np.float32)
+        center = (pts.min(axis=0) + pts.max(axis=0)) * 0.5
+        wh = pts.max(axis=0) - pts.min(axis=0)
+        # crops are rotated squares of side scale * diagonal, this circle
+        # covers them at any angle
+        radius = math.sqrt(float(wh[0] ** 2 + wh[1] ** 2)) * crop_scale * 0.5 * math.sqrt(2.0)
+
+        x1 = min(x1, center[0] - radius)
+        y1 = min(y1, center[1] - radius)
+        x2 = max(x2, center[0] + radius)
+        y2 = max(y2, center[1] + radius)
+
+    return [int(math.floor(x1)), int(math.floor(y1)),
+            int(math.ceil(x2)), int(math.ceil(y2))]
+
+
+def plan_decode(pts_with_angles, min_face_side=112, crop_scale=1.5,
+                use_region=False, max_reduce_factor=8):
+    """Plan how to decode an image for its faces.
+
+    Params:
+        pts_with_angles: a list of (pts, angle) pairs, see
+                FaceAlignerCaffe.rotate_and_crop_faces()
+        min_face_side: min side length (in pixels) of each face rect in the
+                decoded image, e.g. 112 for 112x112 face chips
+        crop_scale: scale for FaceAlignerCaffe.rotate_and_crop_faces()
+        use_region: whether to decode only the region around the faces
+        max_reduce_factor: max reduce factor, one of 1, 2, 4, 8
+    Return:
+        a dict: {
+            "reduce_factor": 1, 2, 4 or 8,
+            "color_flag", "grey_flag": flags for cv2.imread(),
+            "region": None or [x1, y1, x2, y2] in full resolution pixels
+        }
+    """
+    min_side = min([get_face_side(pt_angle[0]) for pt_angle in pts_with_angles] or
+                   [float('inf')])
+
+    plan = None
+    for factor, color_flag, grey_flag in REDUCED_DECODE_FLAGS:
+        if factor > max_reduce_factor:
+            break
+        if plan is None or min_side / factor >= min_face_side:
+            plan = {
+                "reduce_factor": factor,
+                "color_flag": color_flag,
+                "grey_flag": grey_flag,
+                "region": None
+            }
+
+    if use_region and pts_with_angles:
+        plan["region"] = get_faces_region(pts_with_angles, crop_scale)
+
+    return plan
+
+
+def _is_jpeg(path):
+    with open(path, 'rb') as fp:
+        return fp.read(3) == b'\xff\xd8\xff'
+
+
+def decode_image(path, plan, as_grey=False):
+    """Decode an image as planned by plan_decode().
+
+    Return:
+        img: decoded image, numpy array, or None if it cannot be read
+        offset: (x, y) of the decoded image's top-left pixel, in full
+                resolution pixels
+    """
+    factor = plan["reduce_factor"]
+    region = plan["region"]
+    turbo_jpeg = get_turbo_jpeg()
+
+    if region is not None and turbo_jpeg is not None and _is_jpeg(path):
+        with open(path, 'rb') as fp:
+            jpeg_buf = fp.read()
+
+        width, height = turbo_jpeg.decode_header(jpeg_buf)[:2]
+        x1 = max(0, region[0])
+        y1 = max(0, region[1])
+        x1 -= x1 % JPEG_MCU_SIZE
+        y1 -= y1 % JPEG_MCU_SIZE
+        x2 = min(width, region[2])
+        y2 = min(height, region[3])
+
+        if x2 > x1 and y2 > y1:
+            if (x1, y1, x2, y2) != (0, 0, width, height):
+                jpeg_buf = turbo_jpeg.crop(jpeg_buf, x1, y1, x2 - x1, y2 - y1)
+
+            kwargs = {}
+            if factor > 1:
+                kwargs["scaling_factor"] = (1, factor)
+            if as_grey:
+                from turbojpeg import TJPF_GRAY
+                kwargs["pixel_format"] = TJPF_GRAY
+            img = turbo_jpeg.decode(jpeg_buf, **kwargs)
+            if as_grey and img.ndim == 3:
+                img = img[:, :, 0]
+            return img, (x1, y1)
+
+    img = cv2.imread(path, plan["grey_flag"] if as_grey else plan["color_flag"])
+    return img, (0, 0)
+
+
+def rescale_faces(pts_with_angles, plan, offset=(0, 0)):
+    """Map face rects from full resolution pixels into the decoded image.
+
+    Return:
+        a list of (pts, angle) pairs with integer pts
+    """
+    factor = float(plan["reduce_factor"])
+    new_pts_with_angles = []
+
+    for pt_angle in pts_with_angles:
+        pts = (np.asarray(pt_angle[0], dtype=np.float64) -
+               np.asarray(offset, dtype=np.float64)) / factor
+        new_pts_with_angles.append(
+            [np.round(pts).astype(int).tolist(), pt_angle[1]])
+
+    return new_pts_with_angles
+
+
+def map_pts_to_full_resolution(pts, plan):
+    """Map points (e.g. landmarks) from the decoded image back into full
+    resolution pixels, the inverse of rescale_faces().
+
+    Params:
+        pts: points in the decoded image's pixels, (N, 2) or flat
+                [x1, y1, x2, y2, ...] as landmarks
+        plan: the plan from load_image_for_faces(), with "offset"
+    Return:
+        numpy array of the shape of pts, float64
+    """
+    pts = np.asarray(pts, dtype=np.float64)
+    offset = np.asarray(plan.get("offset") or (0, 0), dtype=np.float64)
+
+    full_pts = pts.reshape((-1, 2)) * plan["reduce_factor"] + offset
+    return full_pts.reshape(pts.shape)
+
+
+def load_image_for_faces(path, pts_with_angles, min_face_side=112,
+                         crop_scale=1.5, use_region=False, as_grey=False):
+    """Plan and decode an image for its faces, and map the faces into it.
+
+    Return:
+        img: decoded image, numpy array, or None if it cannot be read
+        pts_with_angles: the faces in the decoded image's pixels
+        plan: the plan from plan_decode(), plus "offset"
+    """
+    plan = plan_decode(pts_with_angles, min_face_side, crop_scale, use_region)
+    img, offset = decode_image(path, plan, as_grey)
+    plan["offset"] = offset
+
+    return img, rescale_faces(pts_with_angles, plan, offset), plan
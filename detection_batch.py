@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed representation of face detections, so that angle
+conversion, filtering and crop-matrix construction run as numpy array
+operations instead of per-face Python code.
+"""
+import json
+import math
+
+import numpy as np
+
+# known values of "quality" in detection manifests, index is the code
+QUALITY_LABELS = ('unknown', 'clear', 'blur', 'small', 'pose', 'cover', 'neg')
+
+
+def get_quality_code(label):
+    """Get the code of a quality label, 0 ('unknown') for None and labels
+    not in QUALITY_LABELS."""
+    try:
+        return QUALITY_LABELS.index(label)
+    except ValueError:
+        return 0
+
+
+class DetectionBatch(object):
+    """Face detections of one or many images, as columns of numpy arrays:
+
+        pts: (N, 4, 2) float32, face rect, 4 pts [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+        angles: (N,) float32, in degree (not radian)
+        scores: (N,) float32, detection scores
+        quality: (N,) int16, codes of quality labels, see QUALITY_LABELS
+        q_scores: (N, len(QUALITY_LABELS)) float32, quality scores, NaN if unknown
+        image_idx: (N,) int32, index of the image each face belongs to
+    """
+
+    def __init__(self, pts, angles, scores=None, quality=None,
+                 q_scores=None, image_idx=None):
+        self.pts = np.asarray(pts, dtype=np.float32).reshape((-1, 4, 2))
+        n_faces = self.pts.shape[0]
+
+        self.angles = np.asarray(angles, dtype=np.float32).reshape(n_faces)
+
+        if scores is None:
+            scores = np.ones(n_faces, dtype=np.float32)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(n_faces)
+
+        if quality is None:
+            quality = np.zeros(n_faces, dtype=np.int16)
+        self.quality = np.asarray(quality, dtype=np.int16).reshape(n_faces)
+
+        if q_scores is None:
+            q_scores = np.full((n_faces, len(QUALITY_LABELS)), np.nan, dtype=np.float32)
+        self.q_scores = np.asarray(q_scores, dtype=np.float32).reshape(
+            (n_faces, np.shape(q_scores)[-1]))
+
+        if image_idx is None:
+            image_idx = np.zeros(n_faces, dtype=np.int32)
+        self.image_idx = np.asarray(image_idx, dtype=np.int32).reshape(n_faces)
+
+    def __len__(self):
+        return self.pts.shape[0]
+
+    @classmethod
+    def from_pts_with_angles(cls, pts_with_angles, image_idx=0):
+        """Build from a list of (pts, angle) pairs, angle in degree."""
+        n_faces = len(pts_with_angles)
+        pts = np.float32([pt_angle[0] for pt_angle in pts_with_angles])
+        angles = np.float32([pt_angle[1] for pt_angle in pts_with_angles])
+
+        return cls(pts.reshape((n_faces, 4, 2)), angles,
+                   image_idx=np.full(n_faces, image_idx, dtype=np.int32))
+
+    def to_pts_with_angles(self):
+        """Convert into a list of (pts, angle) pairs, angle in degree."""
+        return [[pts, float(angle)] for pts, angle in
+                zip(self.pts.tolist(), self.angles.tolist())]
+
+    def select(self, index):
+        """Get a sub batch by a bool mask or an index array."""
+        return DetectionBatch(self.pts[index], self.angles[index],
+                              self.scores[index], self.quality[index],
+                              self.q_scores[index], self.image_idx[index])
+
+    def get_quality_labels(self):
+        """Get the quality label of each face, a list of str."""
+        return [QUALITY_LABELS[code] for code in self.quality]
+
+    def has_quality(self, labels):
+        """Get a bool mask of faces whose quality label is one of labels."""
+        codes = [QUALITY_LABELS.index(label) for label in labels
+                 if label in QUALITY_LABELS]
+        return np.isin(self.quality, codes)
+
+    def filter_quality(self, exclude=('small',)):
+        """Drop faces whose quality label is one of exclude."""
+        return self.select(~self.has_quality(exclude))
+
+    def filter_score(self, min_score):
+        """Drop faces with detection score < min_score."""
+        return self.select(self.scores >= min_score)
+
+    def for_image(self, image_idx):
+        """Get the faces of one image."""
+        return self.select(self.image_idx == image_idx)
+
+    def split_by_image(self, n_images=None):
+        """Split into one batch per image.
+
+        Params:
+            n_images: None or the number of images, to include images
+                    without faces
+        Return:
+            a list of DetectionBatch, index is the image index
+        """
+        if n_images is None:
+            n_images = int(self.image_idx.max()) + 1 if len(self) else 0
+
+        order = np.argsort(self.image_idx, kind='mergesort')
+        sorted_idx = self.image_idx[order]
+        bounds = np.searchsorted(sorted_idx, np.arange(n_images + 1))
+
+        return [self.select(order[bounds[i]:bounds[i + 1]])
+                for i in range(n_images)]
+
+    def get_bounding_rects(self):
+        """Get the axis-aligned bounding rect of each face, (N, 4) array of
+        [x1, y1, x2, y2]."""
+        return np.concatenate((self.pts.min(axis=1), self.pts.max(axis=1)), axis=1)
+
+
+def load_detection_manifest(manifest):
+    """Load a detection manifest (the format of test_imgs_weidong/test_data.json).
+
+    Params:
+        manifest: path to a manifest .json file, or its already loaded list
+    Return:
+        uris: a list of image uris (None if an entry has no "uri")
+        detections: a DetectionBatch of all faces, image_idx indexes uris
+    """
+    if not isinstance(manifest, list):
+        with open(manifest, 'r') as fp:
+            manifest = json.load(fp)
+
+    return parse_manifest_entries(manifest)
+
+
+def parse_manifest_entries(entries):
+    """Parse manifest entries ({"uri": ..., "detections": [...]} dicts).
+
+    Params:
+        entries: an iterable of manifest entries
+    Return:
+        uris, detections: see load_detection_manifest(), image_idx indexes
+                the entries in this call
+    """
+    uris = []
+    pts, radians, scores, quality, q_scores, image_idx = [], [], [], [], [], []
+
+    for idx, body in enumerate(entries):
+        uris.append(body.get('uri'))
+
+        for data in body.get('detections', []):
+            if 'pts' not in data:
+                continue
+            pts.append(data['pts'])
+            radians.append(data.get('orientation', 0.0))
+            scores.append(data.get('score', 1.0))
+            quality.append(get_quality_code(data.get('quality')))
+            q_scores.append(data.get('q_score') or {})
+            image_idx.append(idx)
+
+    n_faces = len(pts)
+    q_score_arr = np.full((n_faces, len(QUALITY_LABELS)), np.nan, dtype=np.float32)
+    for i, q_score in enumerate(q_scores):
+        for label, value in q_score.items():
+            # scores of unknown labels are dropped
+            if label in QUALITY_LABELS:
+                q_score_arr[i, QUALITY_LABELS.index(label)] = value
+
+    detections = DetectionBatch(
+        np.float32(pts).reshape((n_faces, 4, 2)),
+        # convert radians into degrees
+        np.float32(radians) * np.float32(180.0 / math.pi),
+        scores, quality, q_score_arr, image_idx)
+
+    return uris, detections
+
+
+def get_upright_face_transforms(pts, angles, scale=1.0):
+    """Vectorized get_upright_face_transform() of face_aligner_mxnet.
+
+    Params:
+        pts: (N, 4, 2) face rects
+        angles: (N,) angles, in degree
+        scale: output size = scale * sqrt(w*w+h*h), w,h is the size of ROI
+    Return:
+        M: (N, 2, 3) affine transform matrices from image to upright faces
+        crop_sizes: (N,) int, size of the upright face images
+        roi_rects: (N, 4) [x1, y1, x2, y2] of the ROIs to crop for faces
+                with angle < 1 degree (M is a translation for them)
+        use_roi: (N,) bool, whether angle < 1 degree
+    """
+    pts = np.asarray(pts, dtype=np.float64).reshape((-1, 4, 2))
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1)
+    n_faces = pts.shape[0]
+
+    x1, y1 = pts[:, 0, 0], pts[:, 0, 1]
+    w = pts[:, 2, 0] - 1 - x1
+    h = pts[:, 2, 1] - 1 - y1
+
+    w_max = np.floor(np.sqrt(w * w + h * h))
+    crop_sizes = np.floor(w_max * scale).astype(np.int64)
+    # floor divisions, as get_upright_face_transform()
+    half = crop_sizes // 2
+
+    center_x = x1 + np.floor(w / 2.0)
+    center_y = y1 + np.floor(h / 2.0)
+
+    use_roi = angles < 1.0
+
+    roi_rects = np.stack((center_x - half, center_y - half,
+                          center_x + half, center_y + half), axis=1)
+
+    # corners (-, -), (-, +), (+, +) rotated around the center, truncated
+    # to int as rotate_point() does
+    theta = -angles * math.pi / 180
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    offsets = np.stack((np.stack((-half, -half), axis=1),
+                        np.stack((-half, half), axis=1),
+                        np.stack((half, half), axis=1)), axis=1)
+    src = np.empty((n_faces, 3, 2))
+    src[:, :, 0] = np.trunc(center_x[:, None] + offsets[:, :, 0] * cos_t[:, None] -
+                            offsets[:, :, 1] * sin_t[:, None])
+    src[:, :, 1] = np.trunc(center_y[:, None] + offsets[:, :, 0] * sin_t[:, None] +
+                            offsets[:, :, 1] * cos_t[:, None])
+
+    # solve A * [s3-s2, s2-s1] = crop_size * I, t = -A * s1
+    uv = np.stack((src[:, 2] - src[:, 1], src[:, 1] - src[:, 0]), axis=2)
+    det = uv[:, 0, 0] * uv[:, 1, 1] - uv[:, 0, 1] * uv[:, 1, 0]
+    det[np.abs(det) < 1e-12] = 1e-12
+    inv_uv = np.empty_like(uv)
+    inv_uv[:, 0, 0] = uv[:, 1, 1]
+    inv_uv[:, 0, 1] = -uv[:, 0, 1]
+    inv_uv[:, 1, 0] = -uv[:, 1, 0]
+    inv_uv[:, 1, 1] = uv[:, 0, 0]
+    A = inv_uv * (crop_sizes / det)[:, None, None]
+
+    M = np.empty((n_faces, 2, 3))
+    M[:, :, 0:2] = A
+    M[:, :, 2] = -np.einsum('nij,nj->ni', A, src[:, 0])
+
+    # pure translations for faces cropped as ROIs, to the integer origin the
+    # ROIs are cropped at (see RoiExtractor)
+    M[use_roi, :, 0:2] = np.eye(2)
+    M[use_roi, 0, 2] = -np.floor(roi_rects[use_roi, 0])
+    M[use_roi, 1, 2] = -np.floor(roi_rects[use_roi, 1])
+
+    return M, crop_sizes, roi_rects, use_roi
@@ -9,9 +9,20 @@ import os.path as osp
 import cv2
 import math
 import numpy as np
+import threading
+import weakref
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from mxnet_feature_extractor import MxnetFeatureExtractor
-from fx_warp_and_crop_face import warp_and_crop_face, get_reference_facial_points
+from fx_warp_and_crop_face import get_reference_facial_points
+from matlab_cp2tform import get_similarity_transforms_for_cv2
+from landmark_cache import LandmarkCache
+from image_cache import DecodedImageCache
+from async_writer import AsyncImageWriter
+from detection_batch import DetectionBatch, load_detection_manifest, get_upright_face_transforms
+from metrics import stage_timer
+from tracing import trace_span, trace_face_span, trace_batch_span, get_sampled_faces
 
 
 def convert_to_squares(pts, scale=1.0):
@@ -28,51 +39,162 @@ def convert_to_squares(pts, scale=1.0):
     return int(x), int(y), int(max_side)
 
 
-def get_roi_img(img, pts):
-    """Get ROI region from input image. Part of the ROI can be outside of the image.
+def _get_roi_rect(pts):
+    """Integer [x1, y1, x2, y2] of ROI pts [[x1, y1], [x2, y2]]."""
+    return [int(math.floor(pts[0][0])), int(math.floor(pts[0][1])),
+            int(math.floor(pts[1][0])), int(math.floor(pts[1][1]))]
+
+
+def get_roi_border(img_shape, pts_list):
+    """Get the border size needed to pad an image so that all ROIs are inside it.
 
     Params:
-        img: input image, numpy array.
-        pts: top-left and bottom-right points of ROI, [[x1, y1], [x2, y2]]
+        img_shape: shape of the input image
+        pts_list: a list of ROI pts, [[x1, y1], [x2, y2]]
     Return:
-        ROI image, numpy array
+        border size in pixels, int, 0 if all ROIs are inside the image
+    """
+    border = 0
+    for pts in pts_list:
+        x1, y1, x2, y2 = _get_roi_rect(pts)
+        border = max(border, -x1, -y1,
+                     x2 - img_shape[1], y2 - img_shape[0])
+    return border
+
+
+class BufferPool(object):
+    """Pool of reusable numpy arrays, keyed by shape and dtype."""
+
+    def __init__(self, max_buffers_per_shape=4):
+        self.max_buffers_per_shape = max_buffers_per_shape
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        """Get an (uninitialized) array of shape and dtype."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            free = self.buffers.get(key)
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buf):
+        """Give an array back to the pool, it must not be used anymore."""
+        key = (buf.shape, buf.dtype.str)
+        with self.lock:
+            free = self.buffers.setdefault(key, [])
+            if len(free) < self.max_buffers_per_shape:
+                free.append(buf)
+
+
+class RoiExtractor(object):
+    """Crop many ROIs out of one image without copying pixels.
+
+    ROIs inside the image are returned as views of the image. For ROIs which
+    are partly outside of it, the image is zero-padded once, with a border
+    large enough for all ROIs, and they are returned as views of the padded
+    image. The returned ROIs must not be modified in place.
     """
-    x1 = pts[0][0]
-    y1 = pts[0][1]
-    x2 = pts[1][0]
-    y2 = pts[1][1]
-    w, h = x2-x1, y2-y1
 
-    img_shape = img.shape
-    roi_shape = (h, w)
-    if len(img_shape) > 2:
-        roi_shape = (h, w, img_shape[2])
+    def __init__(self, img, pts_list=None, buffer_pool=None):
+        """Crop many ROIs out of one image without copying pixels.
 
-    img_roi = np.zeros(roi_shape, dtype=img.dtype)
+            Params:
+                img: input image, numpy array
+                pts_list: None or a list of all ROI pts [[x1, y1], [x2, y2]]
+                        which will be cropped, to size the border
+                buffer_pool: None or a BufferPool for the padded image
+        """
+        self.img = img
+        self.buffer_pool = buffer_pool
+        self.padded_img = None
+        # padded images replaced by a larger one, ROIs may still view them
+        self.old_padded_imgs = []
+        self.border = 0
+
+        if pts_list:
+            border = get_roi_border(img.shape, pts_list)
+            if border > 0:
+                self._pad(border)
+
+    def _pad(self, border):
+        if self.padded_img is not None:
+            self.old_padded_imgs.append(self.padded_img)
+
+        shape = ((self.img.shape[0] + 2 * border,
+                  self.img.shape[1] + 2 * border) + self.img.shape[2:])
+        if self.buffer_pool is not None:
+            padded_img = self.buffer_pool.acquire(shape, self.img.dtype)
+        else:
+            padded_img = np.empty(shape, dtype=self.img.dtype)
+
+        self.padded_img = cv2.copyMakeBorder(
+            self.img, border, border, border, border,
+            cv2.BORDER_CONSTANT, dst=padded_img, value=0)
+        self.border = border
+
+    def get_roi(self, pts):
+        """Get ROI region, part of the ROI can be outside of the image.
+
+        Params:
+            pts: top-left and bottom-right points of ROI, [[x1, y1], [x2, y2]]
+        Return:
+            ROI image, numpy array (a view)
+        """
+        x1, y1, x2, y2 = _get_roi_rect(pts)
+        img_shape = self.img.shape
 
-    dst_x1 = 0
-    dst_y1 = 0
-    src_x1 = x1
-    src_y1 = y1
+        if x1 >= 0 and y1 >= 0 and x2 <= img_shape[1] and y2 <= img_shape[0]:
+            return self.img[y1:y2, x1:x2]
 
-    if x1 < 0:
-        dst_x1 = -x1-1
-        w += x1
-        src_x1 -= x1
+        border = get_roi_border(img_shape, [pts])
+        if border > self.border:
+            self._pad(border)
 
-    if y1 < 0:
-        dst_y1 = -y1-1
-        h += y1
-        src_y1 -= y1
+        b = self.border
+        return self.padded_img[y1 + b:y2 + b, x1 + b:x2 + b]
 
-    if x2 > img_shape[1] - 1:
-        w -= x2 - img_shape[1] + 1
+    def release(self):
+        """Give the padded image back to the buffer pool, all ROIs returned by
+        get_roi() must not be used anymore."""
+        if self.padded_img is not None:
+            self.old_padded_imgs.append(self.padded_img)
+        if self.buffer_pool is not None:
+            for padded_img in self.old_padded_imgs:
+                self.buffer_pool.release(padded_img)
+        self.old_padded_imgs = []
+        self.padded_img = None
+        self.border = 0
 
-    if y2 > img_shape[0] - 1:
-        h -= y2 - img_shape[0] + 1
 
-    img_roi[dst_y1: dst_y1+h, dst_x1: dst_x1 +
-            w] = img[src_y1:src_y1+h, src_x1:src_x1+w]
+def get_roi_img(img, pts):
+    """Get ROI region from input image. Part of the ROI can be outside of the image,
+    which is filled with zeros.
+
+    Params:
+        img: input image, numpy array.
+        pts: top-left and bottom-right points of ROI, [[x1, y1], [x2, y2]]
+    Return:
+        ROI image, numpy array, a view of img (do not modify it in place)
+        if the ROI lies inside img
+    """
+    x1, y1, x2, y2 = _get_roi_rect(pts)
+    img_shape = img.shape
+
+    if x1 >= 0 and y1 >= 0 and x2 <= img_shape[1] and y2 <= img_shape[0]:
+        return img[y1:y2, x1:x2]
+
+    w, h = x2-x1, y2-y1
+    roi_shape = (h, w) + img_shape[2:]
+    img_roi = np.zeros(roi_shape, dtype=img.dtype)
+
+    src_x1, src_y1 = max(x1, 0), max(y1, 0)
+    src_x2, src_y2 = min(x2, img_shape[1]), min(y2, img_shape[0])
+
+    if src_x2 > src_x1 and src_y2 > src_y1:
+        img_roi[src_y1-y1:src_y2-y1, src_x1-x1:src_x2-x1] = \
+            img[src_y1:src_y2, src_x1:src_x2]
 
     return img_roi
 
@@ -84,7 +206,7 @@ def get_center_roi(img, scale):
         img: input image, numpy array.
         scale: ratio of center roi size to image size
     Return:
-        ROI image, numpy array
+        ROI image, numpy array, a view of img (do not modify it in place)
     """
     img_shape = img.shape
     h, w = img_shape[0], img_shape[1]
@@ -92,8 +214,8 @@ def get_center_roi(img, scale):
     new_h = int(h * scale)
     new_w = int(w * scale)
 
-    x1 = (h-new_h) // 2
-    y1 = (w-new_w) // 2
+    x1 = (w-new_w) // 2
+    y1 = (h-new_h) // 2
 
     pts = [[x1, y1], [x1+new_w, y1+new_h]]
 
@@ -126,16 +248,18 @@ def rotate_point(x, y, centerX, centerY, angle):
     return [rx, ry]
 
 
-def get_upright_face(img, pts, angle, scale=1.0):
-    """Rotate face to upright position.
+def get_upright_face_transform(pts, angle, scale=1.0):
+    """Get the transform which rotates a face to upright position.
 
     Params:
-        img: input image, numpy array
         pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
         angle: float, in degree [-180, 180] not radian
         scale: output size = scale * sqrt(w*w+h*h), w,h is the size of ROI
     Return:
-        rotated and cropped upright face image, numpy array
+        M: 2x3 affine transform matrix from image to the upright face image
+        crop_size: size of the upright face image
+        roi_pts: [[x1, y1], [x2, y2]] of the ROI to crop if angle < 1 degree
+                (M is a translation then), otherwise None
     """
     x1, y1 = pts[0][0], pts[0][1]
     x2, y2 = pts[2][0]-1, pts[2][1]-1
@@ -143,18 +267,23 @@ def get_upright_face(img, pts, angle, scale=1.0):
 
     w_max = int(math.sqrt(w*w+h*h))
     crop_size = int(w_max*scale)
-    half_crop_size = crop_size/2
+    # floor divisions, as python 2 did on the int pts of detection
+    # manifests; get_upright_face_transforms() of detection_batch matches
+    half_crop_size = crop_size//2
 
-    center_x = (x1+w/2)
-    center_y = (y1+h/2)
+    center_x = (x1+w//2)
+    center_y = (y1+h//2)
 
     if angle < 1.0:  # skip angle < 1 degree
-        new_pts = [
+        roi_pts = [
             [center_x - half_crop_size, center_y - half_crop_size],
             [center_x + half_crop_size, center_y + half_crop_size]
         ]
-        face_img = get_roi_img(img, new_pts)
+        # the ROI is cropped at its floored corner, see get_roi_img()
+        M = np.float64([[1, 0, -math.floor(roi_pts[0][0])],
+                        [0, 1, -math.floor(roi_pts[0][1])]])
     else:
+        roi_pts = None
         src1 = rotate_point(center_x-half_crop_size, center_y -
                             half_crop_size, center_x, center_y, angle)
         src2 = rotate_point(center_x-half_crop_size, center_y +
@@ -170,11 +299,136 @@ def get_upright_face(img, pts, angle, scale=1.0):
         pts2 = np.float32([dst1, dst2, dst3])
 
         M = cv2.getAffineTransform(pts1, pts2)
+
+    return M, crop_size, roi_pts
+
+
+def get_upright_face(img, pts, angle, scale=1.0, roi_extractor=None):
+    """Rotate face to upright position.
+
+    Params:
+        img: input image, numpy array
+        pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+        angle: float, in degree [-180, 180] not radian
+        scale: output size = scale * sqrt(w*w+h*h), w,h is the size of ROI
+        roi_extractor: None or a RoiExtractor of img, to crop faces
+                with angle < 1 degree
+    Return:
+        rotated and cropped upright face image, numpy array
+        (a view of img if angle < 1 degree, do not modify it in place)
+    """
+    M, crop_size, roi_pts = get_upright_face_transform(pts, angle, scale)
+
+    if roi_pts is not None:
+        if roi_extractor is not None:
+            face_img = roi_extractor.get_roi(roi_pts)
+        else:
+            face_img = get_roi_img(img, roi_pts)
+    else:
         face_img = cv2.warpAffine(img, M, (crop_size, crop_size))
 
     return face_img
 
 
+def get_bgr_uint8_image(img):
+    """Get a 3-channel uint8 image, as cv2.warpAffine() into a (H, W, 3)
+    uint8 dst needs; otherwise it would silently allocate a new output.
+
+    Params:
+        img: uint8 image, BGR or grayscale ((H, W) or (H, W, 1))
+    Return:
+        img, or its BGR conversion if grayscale
+    """
+    if img.dtype != np.uint8:
+        raise ValueError('expected a uint8 image, got {}'.format(img.dtype))
+    if img.ndim == 2 or img.shape[2] == 1:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] != 3:
+        raise ValueError('expected a BGR or grayscale image, got {} channels'.format(
+            img.shape[2]))
+    return img
+
+
+def get_face_size(pts):
+    """Get the diagonal length of a face rect.
+
+    Params:
+        pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+    Return:
+        float
+    """
+    w = pts[2][0] - pts[0][0]
+    h = pts[2][1] - pts[0][1]
+    return math.sqrt(w*w + h*h)
+
+
+def scale_affine_transform(M, factor):
+    """Make an affine transform for images which are 1/factor of the size.
+
+    Params:
+        M: 2x3 affine transform matrix on full size images
+        factor: size ratio, e.g. 2**level of an ImagePyramid level
+    Return:
+        2x3 affine transform matrix for the downsized images
+    """
+    M = np.array(M, dtype=np.float64)
+    M[:, 0:2] *= factor
+    return M
+
+
+def map_crop_pts_to_image(five_pts, crop_transform):
+    """Map landmarks from a cropped face image back to the source image.
+
+    Params:
+        five_pts: Kx2 landmarks in the cropped face image
+        crop_transform: 2x3 affine transform matrix from the source image
+                to the cropped face image
+    Return:
+        Kx2 landmarks in the source image, numpy array
+    """
+    M_inv = cv2.invertAffineTransform(np.float64(crop_transform))
+    five_pts = np.reshape(np.float64(five_pts), (-1, 2))
+    return np.dot(five_pts, M_inv[:, 0:2].T) + M_inv[:, 2]
+
+
+# reject reasons of FaceAlignerCaffe.gate_faces(), in the order of checks
+GATE_REJECT_REASONS = ("low_score", "small_eye_dist",
+                       "nose_offset", "yaw", "roll")
+
+
+# warp pool size of each FaceAlignerCaffe with a pool; OpenCV's thread count
+# is process-global, so it is set from the pools of all of them.
+# owner -> (pool size, weakref to owner calling _update_cv2_threads())
+_warp_pool_sizes = weakref.WeakKeyDictionary()
+# reentrant, an owner may be collected while its thread holds the lock
+_warp_pool_lock = threading.RLock()
+
+
+def _update_cv2_threads(ref=None):
+    """Set OpenCV's thread count to cpu_count / the threads of all warp
+    pools, also called when an owner of a pool is garbage collected."""
+    with _warp_pool_lock:
+        # items() skips the owners already collected
+        total = sum(n_threads for _, (n_threads, _) in list(_warp_pool_sizes.items()))
+        if total:
+            cv2.setNumThreads(max(1, cpu_count() // total))
+        else:
+            # -1 restores OpenCV's default thread count, once no pool is left
+            cv2.setNumThreads(-1)
+
+
+def _set_warp_pool_size(owner, n_threads):
+    """Record the warp pool size of owner (0 or 1 for no pool) and update
+    OpenCV's thread count, see _update_cv2_threads()."""
+    with _warp_pool_lock:
+        if n_threads > 1:
+            _warp_pool_sizes[owner] = (
+                n_threads, weakref.ref(owner, _update_cv2_threads))
+        else:
+            _warp_pool_sizes.pop(owner, None)
+        _update_cv2_threads()
+
+
 def mark_img_with_pts(im, pts):
     """draw landmarks onto image.
 
@@ -203,6 +457,114 @@ class FaceAlignerCaffe(object):
         self.feature_layers = self.net_handle.feature_layers
         self.net_output_layer = self.net_handle.get_feature_layers()[0]
 
+        # quality gate on face score and landmark geometry, see gate_faces()
+        self.gate_config = {
+            "enabled": 0,
+            # O-Net face classification layer, 2 logits (non-face, face)
+            "score_layer": "conv6_1_output",
+            "min_face_score": 0.5,
+            # eye distance / width of the ROI fed into the network
+            "min_eye_dist": 0.1,
+            # distance from nose to the eye line / eye distance
+            "min_nose_offset": 0.2,
+            "max_nose_offset": 1.5,
+            # in degree
+            "max_yaw": 50.0,
+            "max_roll": 30.0
+        }
+        self.gate_config.update(config_json.get("quality_gate", {}))
+        self.face_score_layer = None
+        self.reset_gate_stats()
+
+        if self.gate_config["enabled"]:
+            self.face_score_layer = self.gate_config["score_layer"]
+            if self.face_score_layer not in self.feature_layers:
+                self.net_handle.set_feature_layers(
+                    self.feature_layers + [self.face_score_layer])
+                self.feature_layers = self.net_handle.feature_layers
+
+        # 0 to turn off the per-face prints
+        self.verbose = config_json.get("verbose", 1)
+
+        # reference 5 pts of face chips, by output size
+        self.reference_5pts = {}
+
+        # optional memory_monitor.MemoryTracker, accounts the network input
+        # blob and outputs
+        self.memory_tracker = None
+
+        # optional metrics.MetricsRegistry, see set_metrics()
+        self.metrics = None
+
+        # number of threads to crop/warp faces, 0 or 1 means no thread pool
+        self.warp_threads = 0
+        self.warp_pool = None
+        self.set_warp_threads(config_json.get("warp_threads", 0))
+
+        # reusable output buffers for get_aligned_face_chips_arena()
+        self.chip_arena = None
+        self.tensor_arena = None
+
+        # optional cache of landmarks, see get_landmarks_and_scores()
+        self.landmark_cache = None
+        cache_config = config_json.get("landmark_cache", {})
+        if cache_config.get("enabled", 0):
+            self.landmark_cache = LandmarkCache(
+                cache_config.get("max_entries", 100000),
+                cache_config.get("max_bytes", 64 * 1024 * 1024),
+                cache_config.get("persist_path") or None)
+        # landmarks (and scores) depend on the model and on its output layers
+        self.cache_namespace = '{}|{}|'.format(
+            config_json["network_model"], ','.join(self.feature_layers))
+
+    def set_warp_threads(self, n_threads):
+        """Set the size of the thread pool used by rotate_and_crop_faces() and
+        get_aligned_face_chips(). cv2.warpAffine() releases the GIL, so faces
+        are warped in parallel. OpenCV's own (process-global) thread count is
+        lowered to cpu_count / the warp threads of all aligners of the
+        process, so that together they do not oversubscribe cores.
+
+        Params:
+            n_threads: number of threads, 0 or 1 to warp faces one by one
+        """
+        n_threads = int(n_threads)
+        if n_threads == self.warp_threads:
+            return
+
+        if self.warp_pool is not None:
+            self.warp_pool.close()
+            self.warp_pool.join()
+            self.warp_pool = None
+
+        self.warp_threads = n_threads
+        if n_threads > 1:
+            self.warp_pool = ThreadPool(n_threads)
+        _set_warp_pool_size(self, n_threads)
+
+    def set_metrics(self, metrics):
+        """Time crop, transform_solve and warp, and count network batches,
+        into a metrics.MetricsRegistry; the extractor times preprocess,
+        forward and harvest into it. None to turn it off.
+        """
+        self.metrics = metrics
+        self.net_handle.set_metrics(metrics)
+
+    def close(self):
+        """Release the warp thread pool, and save the landmark cache if it
+        has a persist_path."""
+        self.set_warp_threads(0)
+        if self.landmark_cache is not None:
+            self.landmark_cache.save()
+
+    def _map_faces(self, func, args_list):
+        """Apply func to each item of args_list, in the warp thread pool if
+        there is one, and return the results in the order of args_list.
+        """
+        if self.warp_pool is not None and len(args_list) > 1:
+            return self.warp_pool.map(func, args_list)
+
+        return [func(args) for args in args_list]
+
     def get_landmarks(self, im_list, center_roi_scale=1.0):
         """Get landmarks for every image in a image list.
 
@@ -212,37 +574,117 @@ class FaceAlignerCaffe(object):
         Return:
             a list of face landmarks, has the same length of input im_list
         """
+        five_pts_list, _ = self.get_landmarks_and_scores(
+            im_list, center_roi_scale)
+
+        return five_pts_list
+
+    def get_landmarks_and_scores(self, im_list, center_roi_scale=1.0, cache_keys=None,
+                                 face_traces=None):
+        """Get landmarks and face scores for every image in a image list.
+
+        Params:
+            img: a list of images, each one is a numpy array
+            center_roi_scale: only use center roi to do net inference
+            cache_keys: None or a list of landmark cache keys, one for each image,
+                    e.g. from LandmarkCache.make_face_key(); if None and the
+                    landmark cache is enabled, the keys are hashes of the images
+            face_traces: None or a list of (tracing.Trace or None, face_idx), one
+                    for each image, to trace the network batches of the sampled
+                    faces, linked to them
+        Return:
+            five_pts_list: a list of face landmarks, has the same length of input im_list
+            face_scores: numpy array of face probabilities from the network,
+                    has the same length of input im_list,
+                    all NaN if the quality gate is not enabled
+        """
+        if self.landmark_cache is None:
+            return self._infer_landmarks_and_scores(im_list, center_roi_scale,
+                                                    face_traces)
+
+        size = len(im_list)
+        if cache_keys is None:
+            cache_keys = [LandmarkCache.make_crop_key(im, center_roi_scale)
+                          for im in im_list]
+
+        five_pts_list = [None] * size
+        face_scores = np.full(size, np.nan, dtype=np.float32)
+        miss_idx = []
+
+        for i, key in enumerate(cache_keys):
+            cached = self.landmark_cache.get(self.cache_namespace + key)
+            if cached is None:
+                miss_idx.append(i)
+            else:
+                five_pts_list[i] = cached[0].copy()
+                face_scores[i] = cached[1]
+
+        if miss_idx:
+            infer_pts, infer_scores = self._infer_landmarks_and_scores(
+                [im_list[i] for i in miss_idx], center_roi_scale,
+                [face_traces[i] for i in miss_idx] if face_traces else None)
+
+            for i, five_pts, score in zip(miss_idx, infer_pts, infer_scores):
+                five_pts_list[i] = five_pts
+                face_scores[i] = score
+                self.landmark_cache.put(self.cache_namespace + cache_keys[i],
+                                        (five_pts.copy(), float(score)))
+
+        return five_pts_list, face_scores
+
+    def _infer_landmarks_and_scores(self, im_list, center_roi_scale=1.0, face_traces=None):
+        """get_landmarks_and_scores() without the landmark cache."""
         five_pts_list = []
+        face_scores = np.full(len(im_list), np.nan, dtype=np.float32)
         size = len(im_list)
 
-        im_list2 = []
         if center_roi_scale > 1.0:
             raise Exception("scale must be <= 1.0")
-        elif center_roi_scale < 0.99:
-            for i in range(size):
-                center_roi = get_center_roi(im_list[i], center_roi_scale)
-                im_list2.append(center_roi)
-        else:
-            im_list2 = im_list
 
         for k in range(0, size, self.batch_size):
             infer_batch = self.batch_size
             if k + self.batch_size > size:
                 infer_batch = size - k
 
-            infer_res = self.net_handle.extract_features_batch(
-                im_list2[k:k + infer_batch])
+            batch_span = trace_batch_span(
+                "landmark_batch", face_traces and face_traces[k:k + infer_batch],
+                n_faces=infer_batch, batch_size=self.batch_size)
+            with batch_span:
+                with batch_span.span("assemble_batch"):
+                    batch_ims = im_list[k:k + infer_batch]
+                    if center_roi_scale < 0.99:
+                        batch_ims = [get_center_roi(im, center_roi_scale)
+                                     for im in batch_ims]
+
+                with batch_span.span("extract_features_batch"):
+                    infer_res = self._extract_features_batch(batch_ims)
+
+            if self.metrics is not None:
+                self.metrics.observe_batch(infer_batch, self.batch_size)
+            tracker = self.memory_tracker
+            if tracker is not None:
+                output_bytes = sum(np.asarray(res).nbytes for res in infer_res.values())
+                tracker.add("outputs", output_bytes)
+
+            if self.face_score_layer is not None:
+                logits = np.reshape(
+                    infer_res[self.face_score_layer], (infer_batch, -1))
+                logits = logits - logits.max(axis=1, keepdims=True)
+                probs = np.exp(logits)
+                probs /= probs.sum(axis=1, keepdims=True)
+                face_scores[k:k + infer_batch] = probs[:, 1]
 
             for j in range(infer_batch):
                 five_pts = infer_res[self.net_output_layer][j]
                 # five_pts = infer_res[j]
 
-                img_shape = im_list2[k + j].shape
+                img_shape = batch_ims[j].shape
                 # print('---> image shape: ', img_shape)
                 img_ht = img_shape[0]
                 img_wd = img_shape[1]
 
-                five_pts = np.reshape(five_pts, (2, -1)).T
+                # a copy, a view would keep the whole output array alive
+                five_pts = np.reshape(five_pts, (2, -1)).T.copy()
                 five_pts[:, 1] = five_pts[:, 1] * img_ht
                 five_pts[:, 0] = five_pts[:, 0] * img_wd
                 # five_pts[:, 0] = five_pts[:, 0] * img_wd / self.net_input_width
@@ -261,44 +703,281 @@ class FaceAlignerCaffe(object):
 
                 five_pts_list.append(five_pts)
 
-        return five_pts_list
+            if tracker is not None:
+                tracker.sub("outputs", output_bytes)
+
+        return five_pts_list, face_scores
+
+    def _extract_features_batch(self, batch_ims):
+        """Run the network on one batch, accounted by the memory tracker."""
+        tracker = self.memory_tracker
+        if tracker is None:
+            return self.net_handle.extract_features_batch(batch_ims)
+
+        # preprocessed into the input blob of the extractor
+        blob_bytes = (len(batch_ims) * 3 * self.net_input_height *
+                      self.net_input_width * 4)
+        tracker.add("input_blob", blob_bytes)
+        try:
+            with tracker.trace("input_blob"):
+                return self.net_handle.extract_features_batch(batch_ims)
+        finally:
+            tracker.sub("input_blob", blob_bytes)
+
+    def reset_gate_stats(self):
+        """Reset the counters of gate_faces()."""
+        self.gate_stats = {
+            "total": 0,
+            "passed": 0,
+            "rejected": dict((reason, 0) for reason in GATE_REJECT_REASONS)
+        }
+
+    def gate_faces(self, im_list, five_pts_list, face_scores=None, center_roi_scale=1.0):
+        """Quality gate before face alignment: reject non-faces by the network's
+        face score, and bad faces (too small, extreme pose, broken landmarks) by
+        the geometry of their 5 landmarks. All checks are vectorized.
+
+        Thresholds are in self.gate_config (config_json["quality_gate"]),
+        rejected faces are counted by reason in self.gate_stats, each face
+        is counted for the first check it fails in GATE_REJECT_REASONS.
+
+        Params:
+            im_list: the list of images passed to get_landmarks_and_scores()
+            five_pts_list: a list of face landmarks from get_landmarks_and_scores()
+            face_scores: face scores from get_landmarks_and_scores(), or None
+                    to only check geometry
+            center_roi_scale: the center_roi_scale passed to get_landmarks_and_scores()
+        Return:
+            keep: numpy bool array, has the same length of input im_list
+            reasons: a list of reject reasons (None for kept faces),
+                    has the same length of input im_list
+        """
+        cfg = self.gate_config
+        n_faces = len(five_pts_list)
+        if not n_faces:
+            return np.zeros(0, dtype=bool), []
+
+        pts = np.float32([np.reshape(p, (5, -1)) for p in five_pts_list])
+        roi_wd = np.float32([im.shape[1] for im in im_list]) * center_roi_scale
+
+        eye_vec = pts[:, 1] - pts[:, 0]
+        eye_dist = np.maximum(np.hypot(eye_vec[:, 0], eye_vec[:, 1]), 1e-6)
+        eye_dir = eye_vec / eye_dist[:, np.newaxis]
+        nose_vec = pts[:, 2] - (pts[:, 0] + pts[:, 1]) * 0.5
+
+        # nose position in the eye frame, normalized by eye distance
+        nose_along = (nose_vec * eye_dir).sum(axis=1) / eye_dist
+        nose_below = (nose_vec[:, 1] * eye_dir[:, 0] -
+                      nose_vec[:, 0] * eye_dir[:, 1]) / eye_dist
+
+        # nose shifts towards one eye (half eye distance) at 90 degree yaw
+        yaw = np.degrees(np.arcsin(np.clip(nose_along * 2, -1.0, 1.0)))
+        roll = np.degrees(np.arctan2(eye_vec[:, 1], eye_vec[:, 0]))
+
+        checks = [
+            ("low_score", np.zeros(n_faces, dtype=bool) if face_scores is None
+             else np.asarray(face_scores) < cfg["min_face_score"]),
+            ("small_eye_dist", eye_dist < cfg["min_eye_dist"] * roi_wd),
+            ("nose_offset", (nose_below < cfg["min_nose_offset"]) |
+             (nose_below > cfg["max_nose_offset"])),
+            ("yaw", np.abs(yaw) > cfg["max_yaw"]),
+            ("roll", np.abs(roll) > cfg["max_roll"])
+        ]
+
+        keep = np.ones(n_faces, dtype=bool)
+        reasons = [None] * n_faces
+
+        for reason, failed in checks:
+            failed = failed & keep
+            for i in np.flatnonzero(failed):
+                reasons[i] = reason
+            self.gate_stats["rejected"][reason] += int(failed.sum())
+            keep &= ~failed
+
+        self.gate_stats["total"] += n_faces
+        self.gate_stats["passed"] += int(keep.sum())
+
+        return keep, reasons
 
     # pts_with_angles list of [[[1,2],[3,4],[5,6],[7,8]],1(angle)]
-    def rotate_and_crop_faces(self, img, pts_with_angles, scale=1.0):
+    def rotate_and_crop_faces(self, img, pts_with_angles, scale=1.0, roi_extractor=None,
+                              trace=None):
         """Rotate face rects into upright position and crop them out.
 
         Params:
             img: input image, numpy array
-            pts_with_angles: a list of (pts, angle) pairs,
+            pts_with_angles: a list of (pts, angle) pairs, or a DetectionBatch
+                    of the faces of img,
                     pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
                     angle: float, in degree [-180, 180] not radian
             scale: output size = scale * sqrt(w*w+h*h), w,h is the size of ROI
                     use scale>1.0 (i.e. 1.5) to avoid "black triangles" when doing face alignment
+            roi_extractor: None or a RoiExtractor of img (e.g. with a BufferPool),
+                    by default one is created, which pads img at most once
+            trace: None or a tracing.Trace of img, to trace the crop of each face
         Return:
             a list of rotated and cropped face roi images (eacho one is a numpy array),
-            the output list has the same length of input pts_with_angles
+            the output list has the same length of input pts_with_angles;
+            faces with angle < 1 degree are views of img (or of its padded
+            copy), do not modify them in place
         """
-        img_cropped_list = []
-
-        for pt_angle in pts_with_angles:
-            pts, angle = pt_angle[0], pt_angle[1]
-            print('pts={}'.format(pts))
-            print('angle={}'.format(angle))
+        with stage_timer(self.metrics, "crop"), trace_span(
+                trace, "rotate_and_crop_faces", n_faces=len(pts_with_angles)):
+            if isinstance(pts_with_angles, DetectionBatch):
+                return self._rotate_and_crop_detections(
+                    img, pts_with_angles, scale, roi_extractor, trace)
+
+            return self._rotate_and_crop_pts(
+                img, pts_with_angles, scale, roi_extractor, trace)
+
+    def _rotate_and_crop_pts(self, img, pts_with_angles, scale=1.0, roi_extractor=None,
+                             trace=None):
+        """rotate_and_crop_faces() for a list of (pts, angle) pairs."""
+        if roi_extractor is None:
+            roi_pts_list = []
+            for pt_angle in pts_with_angles:
+                _, _, roi_pts = get_upright_face_transform(
+                    pt_angle[0], float(pt_angle[1]), scale)
+                if roi_pts is not None:
+                    roi_pts_list.append(roi_pts)
+            roi_extractor = RoiExtractor(img, roi_pts_list)
+
+        def crop_face(idx):
+            pts, angle = pts_with_angles[idx][0], pts_with_angles[idx][1]
 
             if not isinstance(angle, float):
                 angle = (float)(angle)
-            img_cropped = get_upright_face(img, pts, angle, scale)
-            img_cropped_list.append(img_cropped)
+            with trace_face_span(trace, "crop_face", idx):
+                return get_upright_face(img, pts, angle, scale, roi_extractor)
+
+        if self.verbose:
+            for pt_angle in pts_with_angles:
+                print('pts={}'.format(pt_angle[0]))
+                print('angle={}'.format(pt_angle[1]))
+
+        img_cropped_list = self._map_faces(crop_face, list(range(len(pts_with_angles))))
 
         return img_cropped_list
 
-    def get_aligned_face_chips(self, img_list, facial_points_list, output_square=True):
+    def _rotate_and_crop_detections(self, img, detections, scale=1.0, roi_extractor=None,
+                                    trace=None):
+        """rotate_and_crop_faces() for a DetectionBatch, the crop transforms
+        of all faces are computed at once.
+        """
+        M, crop_sizes, roi_rects, use_roi = get_upright_face_transforms(
+            detections.pts, detections.angles, scale)
+        roi_rects = roi_rects.reshape((-1, 2, 2))
+
+        if roi_extractor is None:
+            roi_extractor = RoiExtractor(img, roi_rects[use_roi].tolist())
+
+        def crop_face(idx):
+            with trace_face_span(trace, "crop_face", idx):
+                if use_roi[idx]:
+                    return roi_extractor.get_roi(roi_rects[idx])
+
+                crop_size = int(crop_sizes[idx])
+                return cv2.warpAffine(img, M[idx], (crop_size, crop_size))
+
+        return self._map_faces(crop_face, list(range(len(detections))))
+
+    def rotate_and_crop_faces_from_pyramid(self, pyramid, pts_with_angles, scale=1.0,
+                                           min_crop_size=None):
+        """Rotate face rects into upright position and crop them out, each one from
+        the pyramid level closest to (but not below) min_crop_size.
+
+        Params:
+            pyramid: an ImagePyramid of the input image
+            pts_with_angles: a list of (pts, angle) pairs or a DetectionBatch,
+                    pts in the input image, see rotate_and_crop_faces()
+            scale: see rotate_and_crop_faces()
+            min_crop_size: min size of the cropped face images, e.g.
+                    net_input_width / center_roi_scale, the default is net_input_width
+        Return:
+            img_cropped_list: a list of rotated and cropped face roi images
+            crop_transforms: a list of 2x3 affine transforms from the input image
+                    to each cropped face image, to map landmarks back into the
+                    input image by map_crop_pts_to_image()
+        """
+        if min_crop_size is None:
+            min_crop_size = self.net_input_width
+        if isinstance(pts_with_angles, DetectionBatch):
+            pts_with_angles = pts_with_angles.to_pts_with_angles()
+
+        def crop_face(pt_angle):
+            pts, angle = pt_angle[0], float(pt_angle[1])
+            level = pyramid.select_level(
+                get_face_size(pts) * scale, min_crop_size)
+            level_img, level = pyramid.get_level(level)
+
+            factor = 2 ** level
+            level_pts = np.round(np.float64(pts) / factor).astype(int).tolist()
+            M, _, _ = get_upright_face_transform(level_pts, angle, scale)
+            img_cropped = get_upright_face(level_img, level_pts, angle, scale)
+
+            return img_cropped, scale_affine_transform(M, 1.0 / factor)
+
+        with stage_timer(self.metrics, "crop"):
+            results = self._map_faces(crop_face, pts_with_angles)
+
+        img_cropped_list = [res[0] for res in results]
+        crop_transforms = [res[1] for res in results]
+
+        return img_cropped_list, crop_transforms
+
+    def get_aligned_face_chips_from_pyramid(self, pyramid, facial_points_list,
+                                            output_square=True):
+        """Get aligned face chips from one image, each chip warped from the pyramid
+        level closest to (but not below) the chip's scale.
+
+        Params:
+            pyramid: an ImagePyramid of the input image, e.g. the one used by
+                    rotate_and_crop_faces_from_pyramid()
+            facial_points_list: a list of face landmarks in the input image,
+                    e.g. mapped back by map_crop_pts_to_image()
+            output_square: whether to output square face chips
+        Return:
+            a list of aligned face roi chips (eacho one is a numpy array),
+            the output list has the same length of input facial_points_list
+        """
+        output_size = (96, 112)  # (w, h) not (h,w)
+
+        if output_square:
+            output_size = (112, 112)
+        reference_5pts = self._get_reference_5pts(output_size)
+
+        if not len(facial_points_list):
+            return []
+
+        with stage_timer(self.metrics, "transform_solve"):
+            facial_5pts = np.float32([np.reshape(facial_points, (5, -1))
+                                      for facial_points in facial_points_list])
+            tfms = get_similarity_transforms_for_cv2(
+                facial_5pts, np.float32(reference_5pts))
+
+        def warp_face(tfm):
+            # source pixels per chip pixel
+            src_per_dst = 1.0 / math.sqrt(abs(np.linalg.det(tfm[:, 0:2])))
+            level_img, level = pyramid.get_level(
+                pyramid.select_level(src_per_dst, 1.0))
+            level_tfm = scale_affine_transform(tfm, 2 ** level)
+
+            return cv2.warpAffine(level_img, level_tfm, output_size)
+
+        with stage_timer(self.metrics, "warp"):
+            return self._map_faces(warp_face, list(tfms))
+
+    def get_aligned_face_chips(self, img_list, facial_points_list, output_square=True,
+                               face_traces=None):
         """Get aligned face chips in a image list.
 
         Params:
             img_list: a list of input images, each image is a numpy array
             facial_points_list: a list of face landmarks, has the same length as img_list, each one is for one image
             output_square: whether to output square face chips
+            face_traces: None or a list of (tracing.Trace or None, face_idx), one
+                    for each image, to trace the warp of the sampled faces (the
+                    similarity solve is traced in the first sampled one)
         Return:
             a list of aligned face roi chips (eacho one is a numpy array),
             the output list has the same length of input pts_with_angles
@@ -308,16 +987,122 @@ class FaceAlignerCaffe(object):
 
         if output_square:
             output_size = (112, 112)
-            reference_5pts = get_reference_facial_points(output_size)
+        reference_5pts = self._get_reference_5pts(output_size)
+
+        if not len(img_list):
+            return face_chips
+
+        sampled_faces = get_sampled_faces(face_traces)
+        solve_trace = sampled_faces[0][0] if sampled_faces else None
 
-        for img, facial_points in zip(img_list, facial_points_list):
-            facial_5pts = np.reshape(facial_points, (5, -1))
-            dst_img = warp_and_crop_face(
-                img, facial_5pts, reference_5pts, output_size)
-            face_chips.append(dst_img)
+        # solve all similarity transforms at once against the fixed template
+        with stage_timer(self.metrics, "transform_solve"), trace_span(
+                solve_trace, "similarity_solve", n_faces=len(img_list)):
+            facial_5pts = np.float32([np.reshape(facial_points, (5, -1))
+                                      for facial_points in facial_points_list])
+            tfms = get_similarity_transforms_for_cv2(
+                facial_5pts, np.float32(reference_5pts))
+
+        def warp_face(idx):
+            trace, face_idx = (face_traces and face_traces[idx]) or (None, idx)
+            with trace_face_span(trace, "warp_and_crop_face", face_idx):
+                return cv2.warpAffine(img_list[idx], tfms[idx], output_size)
+
+        with stage_timer(self.metrics, "warp"):
+            face_chips = self._map_faces(warp_face, list(range(len(img_list))))
 
         return face_chips
 
+    def _get_reference_5pts(self, output_size):
+        """get_reference_facial_points(output_size), computed once."""
+        reference_5pts = self.reference_5pts.get(output_size)
+        if reference_5pts is None:
+            reference_5pts = get_reference_facial_points(output_size)
+            self.reference_5pts[output_size] = reference_5pts
+
+        return reference_5pts
+
+    def _get_arena(self, arena, shape, dtype):
+        """Return a buffer with at least shape[0] items of shape[1:], reusing
+        arena if it is large enough, growing it (x2) otherwise.
+        """
+        if (arena is None or arena.shape[1:] != shape[1:]
+                or arena.shape[0] < shape[0]):
+            n_alloc = shape[0]
+            if arena is not None and arena.shape[1:] == shape[1:]:
+                n_alloc = max(n_alloc, arena.shape[0] * 2)
+            arena = np.empty((n_alloc,) + tuple(shape[1:]), dtype=dtype)
+
+        return arena
+
+    def get_aligned_face_chips_arena(self, img_list, facial_points_list,
+                                     output_square=True, tensor_extractor=None,
+                                     face_traces=None):
+        """Get aligned face chips in a image list, written by cv2.warpAffine()
+        directly into one contiguous (N, H, W, 3) uint8 buffer.
+
+        The buffer (and the tensor buffer) is owned by the aligner and reused
+        by the next call, copy the outputs if they must be kept longer.
+
+        Params:
+            img_list: a list of input images, each image is a uint8 numpy
+                    array, BGR or grayscale
+            facial_points_list: a list of face landmarks, has the same length as img_list, each one is for one image
+            output_square: whether to output square face chips
+            tensor_extractor: None or a MxnetFeatureExtractor (e.g. the face
+                    recognition net), if set, also output the chips as a
+                    normalized NCHW float32 batch for that extractor,
+                    see MxnetFeatureExtractor.preprocess_batch()
+            face_traces: see get_aligned_face_chips()
+        Return:
+            face_chips: (N, H, W, 3) uint8 numpy array, N = len(img_list)
+            chips_tensor: (N, 3, H', W') float32 numpy array, or None if
+                    tensor_extractor is None
+        """
+        output_size = (96, 112)  # (w, h) not (h,w)
+
+        if output_square:
+            output_size = (112, 112)
+        reference_5pts = self._get_reference_5pts(output_size)
+
+        n_faces = len(img_list)
+        self.chip_arena = self._get_arena(
+            self.chip_arena, (n_faces, output_size[1], output_size[0], 3), np.uint8)
+        face_chips = self.chip_arena[:n_faces]
+
+        if n_faces:
+            sampled_faces = get_sampled_faces(face_traces)
+            solve_trace = sampled_faces[0][0] if sampled_faces else None
+
+            with stage_timer(self.metrics, "transform_solve"), trace_span(
+                    solve_trace, "similarity_solve", n_faces=n_faces):
+                facial_5pts = np.float32([np.reshape(facial_points, (5, -1))
+                                          for facial_points in facial_points_list])
+                tfms = get_similarity_transforms_for_cv2(
+                    facial_5pts, np.float32(reference_5pts))
+
+            def warp_face(idx):
+                trace, face_idx = (face_traces and face_traces[idx]) or (None, idx)
+                with trace_face_span(trace, "warp_and_crop_face", face_idx):
+                    img = get_bgr_uint8_image(img_list[idx])
+                    cv2.warpAffine(img, tfms[idx], output_size, dst=face_chips[idx])
+
+            with stage_timer(self.metrics, "warp"):
+                self._map_faces(warp_face, list(range(n_faces)))
+
+        if tensor_extractor is None:
+            return face_chips, None
+
+        tensor_shape = (n_faces, 3,
+                        tensor_extractor.config['input_height'],
+                        tensor_extractor.config['input_width'])
+        self.tensor_arena = self._get_arena(
+            self.tensor_arena, tensor_shape, np.float32)
+        chips_tensor = tensor_extractor.preprocess_batch(
+            face_chips, out=self.tensor_arena[:n_faces])
+
+        return face_chips, chips_tensor
+
 
 if __name__ == '__main__':
     import json
@@ -333,85 +1118,95 @@ if __name__ == '__main__':
         json_str = json.load(fout)
 
     face_aligner = FaceAlignerCaffe(json_str)
-
-    with open(test_file, 'r') as fout:
-        json_str = json.load(fout)
-      #  total_pts_list = []
-        total_img_cropped_list = []
-        aligned_faces_list = []
-        five_pts_list = []
-
-        for idx, body in enumerate(json_str):
-            pts_with_angles = []
-            img_cropped_list = []
-            if 'uri' in body:
-                uri = body["uri"]
-
-            if 'detections' in body:
-                data_list = body['detections']
-                for data in data_list:
-                    if 'pts' in data:
-                        pts = data['pts']
-                    if 'quality' in data and data['quality'] == 'small':
-                        continue
-                    if 'orientation' in data:
-                        angle = data['orientation']
-                    # convert radians into degrees
-                    pts_with_angles.append([pts, angle*180/math.pi])
-
-                size = len(pts_with_angles)
-
-                print('uri={}'.format(uri))
-                if not size:
-                    print("No faces found")
-                    continue
-
-                img = cv2.imread(uri)
-
-                img_cropped_list = face_aligner.rotate_and_crop_faces(
-                    img, pts_with_angles, scale=1.5)  # use scale>1.0 to avoid "black triangles" in face chips
-                total_img_cropped_list.extend(img_cropped_list)
-
-            print('total_img_cropped_list size={}'.format(
-                len(total_img_cropped_list)))
-
-        if save_res_imgs:
-            sub_dir = save_dir + '/cropped'
-            if not osp.exists(sub_dir):
-                os.mkdir(sub_dir)
-
-            for idx, img_cropped in enumerate(total_img_cropped_list):
-                file_name = str(idx+1)+'.jpg'
-                file_name = osp.join(sub_dir, file_name)
-                cv2.imwrite(file_name, img_cropped)
-
-        five_pts_list = face_aligner.get_landmarks(
-            total_img_cropped_list, 1/1.5*0.9)
-
-        if save_res_imgs:
-            sub_dir = save_dir + '/cropped_with_landmarks'
-
-            if not osp.exists(sub_dir):
-                os.mkdir(sub_dir)
-
-            for idx, img_cropped in enumerate(total_img_cropped_list):
-                five_pts = five_pts_list[idx]
-                print('---> five_pts={}'.format(five_pts))
-                mark_img_with_pts(img_cropped, five_pts)
-
-                file_name = str(idx+1)+'.jpg'
-                file_name = osp.join(sub_dir, file_name)
-                cv2.imwrite(file_name, img_cropped)
-
-        aligned_faces_list = face_aligner.get_aligned_face_chips(
-            total_img_cropped_list, five_pts_list)
-
-        if save_res_imgs:
-            sub_dir = save_dir + '/aligned_faces'
-            if not osp.exists(sub_dir):
-                os.mkdir(sub_dir)
-
-            for idx, face_chip in enumerate(aligned_faces_list):
-                file_name = str(idx+1)+'.jpg'
-                file_name = osp.join(sub_dir, file_name)
-                cv2.imwrite(file_name, face_chip)
+    image_cache = DecodedImageCache()
+    # encode and write result images in the background
+    image_writer = AsyncImageWriter(n_threads=4, max_pending=256)
+
+    uris, detections = load_detection_manifest(test_file)
+    detections = detections.filter_quality(exclude=['small'])
+    faces_per_image = detections.split_by_image(len(uris))
+
+    # decode each image once, ahead of the loop below
+    image_cache.start_prefetch(
+        [uri for uri in uris if uri is not None])
+    #  total_pts_list = []
+    total_img_cropped_list = []
+    aligned_faces_list = []
+    five_pts_list = []
+
+    for uri, faces in zip(uris, faces_per_image):
+        if uri is None:
+            continue
+
+        print('uri={}'.format(uri))
+        if not len(faces):
+            print("No faces found")
+            image_cache.release(uri)
+            continue
+
+        img = image_cache.get_image(uri)
+
+        img_cropped_list = face_aligner.rotate_and_crop_faces(
+            img, faces, scale=1.5)  # use scale>1.0 to avoid "black triangles" in face chips
+        total_img_cropped_list.extend(img_cropped_list)
+
+        print('total_img_cropped_list size={}'.format(
+            len(total_img_cropped_list)))
+
+    image_cache.stop_prefetch()
+    print('image cache: {}'.format(image_cache.get_stats()))
+
+    if save_res_imgs:
+        sub_dir = save_dir + '/cropped'
+        if not osp.exists(sub_dir):
+            os.mkdir(sub_dir)
+
+        for idx, img_cropped in enumerate(total_img_cropped_list):
+            file_name = str(idx+1)+'.jpg'
+            file_name = osp.join(sub_dir, file_name)
+            image_writer.submit(img_cropped, file_name)
+
+    center_roi_scale = 1/1.5*0.9
+    five_pts_list, face_scores = face_aligner.get_landmarks_and_scores(
+        total_img_cropped_list, center_roi_scale)
+
+    if save_res_imgs:
+        sub_dir = save_dir + '/cropped_with_landmarks'
+
+        if not osp.exists(sub_dir):
+            os.mkdir(sub_dir)
+
+        for idx, img_cropped in enumerate(total_img_cropped_list):
+            five_pts = five_pts_list[idx]
+            print('---> five_pts={}'.format(five_pts))
+            # crops can be views of the source images, draw on a copy
+            img_cropped = mark_img_with_pts(img_cropped.copy(), five_pts)
+
+            file_name = str(idx+1)+'.jpg'
+            file_name = osp.join(sub_dir, file_name)
+            image_writer.submit(img_cropped, file_name)
+
+    if face_aligner.gate_config["enabled"]:
+        keep, _ = face_aligner.gate_faces(
+            total_img_cropped_list, five_pts_list, face_scores, center_roi_scale)
+        total_img_cropped_list = [img_cropped for img_cropped, k in zip(
+            total_img_cropped_list, keep) if k]
+        five_pts_list = [five_pts for five_pts, k in zip(
+            five_pts_list, keep) if k]
+        print('quality gate: {}'.format(face_aligner.gate_stats))
+
+    aligned_faces_list = face_aligner.get_aligned_face_chips(
+        total_img_cropped_list, five_pts_list)
+
+    if save_res_imgs:
+        sub_dir = save_dir + '/aligned_faces'
+        if not osp.exists(sub_dir):
+            os.mkdir(sub_dir)
+
+        for idx, face_chip in enumerate(aligned_faces_list):
+            file_name = str(idx+1)+'.jpg'
+            file_name = osp.join(sub_dir, file_name)
+            image_writer.submit(face_chip, file_name)
+
+    image_writer.close()
+    print('image writer: {}'.format(image_writer.get_stats()))
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Temporal tracking mode for video streams: associate face detections across
+frames by IoU, and reuse (smoothed) landmarks of faces which hardly moved,
+instead of running the landmark network on every face of every frame.
+"""
+import numpy as np
+
+from detection_batch import DetectionBatch
+
+
+def get_bounding_rect(pts):
+    """Get axis-aligned bounding rect of a face rect.
+
+    Params:
+        pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+    Return:
+        [x1, y1, x2, y2], numpy array
+    """
+    pts = np.asarray(pts, dtype=np.float32)
+    return np.float32([pts[:, 0].min(), pts[:, 1].min(),
+                       pts[:, 0].max(), pts[:, 1].max()])
+
+
+def get_iou_matrix(rects1, rects2):
+    """Get IoU between every pair of rects in rects1 and rects2.
+
+    Params:
+        rects1: Mx4 numpy array, each row is [x1, y1, x2, y2]
+        rects2: Nx4 numpy array, each row is [x1, y1, x2, y2]
+    Return:
+        MxN numpy array of IoU
+    """
+    rects1 = np.reshape(rects1, (-1, 4))
+    rects2 = np.reshape(rects2, (-1, 4))
+
+    ix1 = np.maximum(rects1[:, np.newaxis, 0], rects2[np.newaxis, :, 0])
+    iy1 = np.maximum(rects1[:, np.newaxis, 1], rects2[np.newaxis, :, 1])
+    ix2 = np.minimum(rects1[:, np.newaxis, 2], rects2[np.newaxis, :, 2])
+    iy2 = np.minimum(rects1[:, np.newaxis, 3], rects2[np.newaxis, :, 3])
+    inter = np.maximum(ix2 - ix1, 0) * np.maximum(iy2 - iy1, 0)
+
+    area1 = (rects1[:, 2] - rects1[:, 0]) * (rects1[:, 3] - rects1[:, 1])
+    area2 = (rects2[:, 2] - rects2[:, 0]) * (rects2[:, 3] - rects2[:, 1])
+    union = area1[:, np.newaxis] + area2[np.newaxis, :] - inter
+
+    return inter / np.maximum(union, 1e-6)
+
+
+class FaceTrack(object):
+    """State of one tracked face."""
+
+    def __init__(self, track_id, rect, angle, frame_idx):
+        self.track_id = track_id
+        self.rect = rect
+        self.angle = angle
+        # landmarks normalized by the size of the cropped face image
+        self.norm_pts = None
+        self.last_infer_frame = frame_idx
+        self.last_seen_frame = frame_idx
+
+
+class FaceLandmarkTracker(object):
+    """Stateful video mode on top of FaceAlignerCaffe.
+
+    Detections of each frame are matched to the faces of previous frames
+    by IoU. A matched face which moved less than move_threshold reuses its
+    previous landmarks, the landmark network is only re-run for new faces,
+    faces that moved significantly and faces whose landmarks are older than
+    keyframe_interval frames. Re-run landmarks of a face that did not move
+    much are smoothed with its previous landmarks.
+    """
+
+    def __init__(self, face_aligner,
+                 iou_threshold=0.3,
+                 move_threshold=0.05,
+                 keyframe_interval=10,
+                 smooth_factor=0.5,
+                 max_missed_frames=5,
+                 crop_scale=1.5,
+                 center_roi_scale=1/1.5*0.9):
+        """Stateful video mode on top of FaceAlignerCaffe.
+
+            Params:
+                face_aligner: a FaceAlignerCaffe
+                iou_threshold: min IoU to associate a detection with a track
+                move_threshold: max movement (center shift and size change,
+                        relative to the face size) to reuse landmarks
+                keyframe_interval: re-run landmarks of a face at least every
+                        keyframe_interval frames, 1 to run them on every frame
+                smooth_factor: weight of the new landmarks when smoothing
+                        with the previous ones, 1.0 means no smoothing
+                max_missed_frames: drop a track after it has not been
+                        detected for more than max_missed_frames frames
+                crop_scale: scale for FaceAlignerCaffe.rotate_and_crop_faces()
+                center_roi_scale: center_roi_scale for FaceAlignerCaffe.get_landmarks()
+        """
+        self.face_aligner = face_aligner
+        self.iou_threshold = iou_threshold
+        self.move_threshold = move_threshold
+        self.keyframe_interval = max(1, int(keyframe_interval))
+        self.smooth_factor = smooth_factor
+        self.max_missed_frames = max_missed_frames
+        self.crop_scale = crop_scale
+        self.center_roi_scale = center_roi_scale
+
+        self.reset()
+
+    def reset(self):
+        """Drop all tracks and stats, e.g. at a scene cut or a new stream."""
+        self.tracks = []
+        self.next_track_id = 0
+        self.frame_idx = -1
+        self.stats = {
+            "frames": 0,
+            "faces": 0,
+            "inferred_faces": 0,
+            "reused_faces": 0
+        }
+
+    def get_stats(self):
+        """Get tracking stats.
+
+        Return:
+            a dict of counters, plus "inference_rate" (ratio of faces
+            that went through the landmark network) and "savings"
+            (ratio of faces that reused landmarks)
+        """
+        stats = dict(self.stats)
+        n_faces = max(stats["faces"], 1)
+        stats["inference_rate"] = stats["inferred_faces"] / float(n_faces)
+        stats["savings"] = stats["reused_faces"] / float(n_faces)
+        return stats
+
+    def _has_moved(self, track, rect, angle):
+        size = max(track.rect[2] - track.rect[0], track.rect[3] - track.rect[1], 1.0)
+        shift = np.abs(rect - track.rect).max() / size
+        # 1 degree of rotation ~ 1.7% of the face size at its border
+        rotate = abs(angle - track.angle) * np.pi / 180.0
+        return max(shift, rotate) > self.move_threshold
+
+    def _associate(self, rects):
+        """Greedily match rects to tracks by IoU.
+
+        Return:
+            a list of the matched track (or None), one for each rect
+        """
+        matches = [None] * len(rects)
+        if not self.tracks or not len(rects):
+            return matches
+
+        track_rects = np.float32([t.rect for t in self.tracks])
+        iou = get_iou_matrix(rects, track_rects)
+
+        for flat_idx in np.argsort(-iou, axis=None):
+            i, j = np.unravel_index(flat_idx, iou.shape)
+            # also skips pairs of an already matched rect or track
+            if iou[i, j] < self.iou_threshold:
+                continue
+
+            matches[i] = self.tracks[j]
+            iou[i, :] = -1
+            iou[:, j] = -1
+
+        return matches
+
+    def process_frame(self, img, pts_with_angles):
+        """Get upright face crops and their landmarks for one video frame.
+
+        Params:
+            img: input frame, numpy array
+            pts_with_angles: a list of (pts, angle) pairs or a DetectionBatch
+                    of this frame, see FaceAlignerCaffe.rotate_and_crop_faces()
+        Return:
+            img_cropped_list: a list of rotated and cropped face roi images
+            five_pts_list: a list of face landmarks, one for each cropped
+                    face image, as from FaceAlignerCaffe.get_landmarks()
+            track_ids: a list of track ids, one for each face
+            (all have the same length of input pts_with_angles, feed the
+            first two into FaceAlignerCaffe.get_aligned_face_chips())
+        """
+        self.frame_idx += 1
+        self.stats["frames"] += 1
+
+        img_cropped_list = self.face_aligner.rotate_and_crop_faces(
+            img, pts_with_angles, scale=self.crop_scale)
+
+        n_faces = len(pts_with_angles)
+        if isinstance(pts_with_angles, DetectionBatch):
+            rects = pts_with_angles.get_bounding_rects()
+            angles = pts_with_angles.angles.tolist()
+        else:
+            rects = np.float32([get_bounding_rect(pt_angle[0])
+                                for pt_angle in pts_with_angles]).reshape((-1, 4))
+            angles = [float(pt_angle[1]) for pt_angle in pts_with_angles]
+        matches = self._associate(rects)
+
+        face_tracks = []
+        infer_idx = []
+        smooth_flags = []
+
+        for i in range(n_faces):
+            track = matches[i]
+            moved = True
+
+            if track is None:
+                track = FaceTrack(self.next_track_id, rects[i], angles[i],
+                                  self.frame_idx)
+                self.next_track_id += 1
+                self.tracks.append(track)
+            else:
+                moved = self._has_moved(track, rects[i], angles[i])
+
+            keyframe = (self.frame_idx - track.last_infer_frame >=
+                        self.keyframe_interval)
+
+            if track.norm_pts is None or moved or keyframe:
+                infer_idx.append(i)
+                smooth_flags.append(track.norm_pts is not None and not moved)
+
+            if moved or track.norm_pts is None:
+                # keep the reference position of a still face, so that slow
+                # drifts add up and get re-inferred
+                track.rect = rects[i]
+                track.angle = angles[i]
+            track.last_seen_frame = self.frame_idx
+            face_tracks.append(track)
+
+        if infer_idx:
+            infer_pts = self.face_aligner.get_landmarks(
+                [img_cropped_list[i] for i in infer_idx], self.center_roi_scale)
+
+            for i, five_pts, smooth in zip(infer_idx, infer_pts, smooth_flags):
+                track = face_tracks[i]
+                crop_ht, crop_wd = img_cropped_list[i].shape[:2]
+                norm_pts = five_pts / np.float32([crop_wd, crop_ht])
+
+                if smooth:
+                    norm_pts = (self.smooth_factor * norm_pts +
+                                (1.0 - self.smooth_factor) * track.norm_pts)
+
+                track.norm_pts = norm_pts
+                track.last_infer_frame = self.frame_idx
+
+        five_pts_list = []
+        for img_cropped, track in zip(img_cropped_list, face_tracks):
+            crop_ht, crop_wd = img_cropped.shape[:2]
+            five_pts_list.append(track.norm_pts * np.float32([crop_wd, crop_ht]))
+
+        self.stats["faces"] += n_faces
+        self.stats["inferred_faces"] += len(infer_idx)
+        self.stats["reused_faces"] += n_faces - len(infer_idx)
+
+        self.tracks = [t for t in self.tracks
+                       if self.frame_idx - t.last_seen_frame <= self.max_missed_frames]
+
+        track_ids = [track.track_id for track in face_tracks]
+
+        return img_cropped_list, five_pts_list, track_ids
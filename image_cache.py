@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory-bounded cache of decoded images, shared by the manifest runner and
+MxnetFeatureExtractor.read_image(), so that an image listed many times in a
+detection manifest is decoded (at most) once while it is still needed.
+"""
+import threading
+
+import cv2
+
+from landmark_cache import LRUCache
+
+
+class DecodedImageCache(object):
+    """Byte-budgeted LRU cache of images decoded by cv2.imread().
+
+    When the order in which images will be read is known (e.g. the uri list
+    of a manifest), start_prefetch() decodes the next images on a background
+    thread ahead of the consumer, and each image is dropped from the cache
+    right after its last scheduled use.
+
+    The returned images are shared with the cache, they must not be
+    modified in place.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, lookahead=4):
+        """Byte-budgeted LRU cache of decoded images.
+
+            Params:
+                max_bytes: max total bytes of decoded images
+                lookahead: max number of scheduled reads to prefetch ahead
+                        of the consumer
+        """
+        self.cache = LRUCache(0, max_bytes)
+        self.lookahead = lookahead
+
+        self.lock = threading.Condition()
+        self.loading = {}  # key -> (event, [img])
+        self.remaining_uses = {}  # key -> number of scheduled reads left
+        self.n_consumed = 0  # number of scheduled reads done
+
+        self.prefetch_thread = None
+        self.stopped = False
+
+        self.stats = {
+            "reads": 0,
+            "decodes": 0,
+            "prefetched": 0,
+            "failed": 0
+        }
+
+    @staticmethod
+    def _get_key(path, flags):
+        return '{}|{}'.format(flags, path)
+
+    def _load(self, key, path, flags):
+        """Get the image from the cache, or decode it, once even if several
+        threads ask for it at the same time."""
+        img = self.cache.get(key)
+        if img is not None:
+            return img, False
+
+        with self.lock:
+            loading = self.loading.get(key)
+            owner = loading is None
+            if owner:
+                loading = (threading.Event(), [None])
+                self.loading[key] = loading
+            scheduled = key in self.remaining_uses
+
+        event, holder = loading
+        if not owner:
+            event.wait()
+            return holder[0], False
+
+        try:
+            img = cv2.imread(path, flags)
+            holder[0] = img
+            with self.lock:
+                self.stats["decodes"] += 1
+                if img is None:
+                    self.stats["failed"] += 1
+                # do not cache images whose last scheduled read is done,
+                # under the lock so _consume() cannot drop it before the put
+                if img is not None and (not scheduled or key in self.remaining_uses):
+                    self.cache.put(key, img)
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+        return img, True
+
+    def _consume(self, key):
+        """Count one scheduled read of key, drop it after its last one."""
+        with self.lock:
+            self.stats["reads"] += 1
+            if key not in self.remaining_uses:
+                return
+
+            self.n_consumed += 1
+            self.remaining_uses[key] -= 1
+            if self.remaining_uses[key] <= 0:
+                del self.remaining_uses[key]
+                self.cache.pop(key)
+            self.lock.notify_all()
+
+    def get_image(self, path, flags=cv2.IMREAD_COLOR):
+        """Read an image, same as cv2.imread(path, flags).
+
+        Return:
+            image, numpy array, or None if it cannot be read
+        """
+        key = self._get_key(path, flags)
+        img, _ = self._load(key, path, flags)
+        self._consume(key)
+
+        return img
+
+    def release(self, path, flags=cv2.IMREAD_COLOR):
+        """Count a scheduled read of path which was skipped."""
+        self._consume(self._get_key(path, flags))
+
+    def start_prefetch(self, paths, flags=cv2.IMREAD_COLOR):
+        """Schedule the reads of paths (in this order) and start decoding
+        them on a background thread, at most `lookahead` reads ahead of the
+        consumer. Every scheduled read must be done by get_image() or
+        skipped by release().
+        """
+        paths = list(paths)
+        with self.lock:
+            for path in paths:
+                key = self._get_key(path, flags)
+                self.remaining_uses[key] = self.remaining_uses.get(key, 0) + 1
+            start = self.n_consumed
+
+        self.stop_prefetch()
+        self.stopped = False
+        self.prefetch_thread = threading.Thread(
+            target=self._prefetch_loop, args=(paths, flags, start),
+            name='DecodedImageCache-prefetch')
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+
+    def stop_prefetch(self):
+        if self.prefetch_thread is not None:
+            with self.lock:
+                self.stopped = True
+                self.lock.notify_all()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+    def _prefetch_loop(self, paths, flags, start):
+        for idx, path in enumerate(paths):
+            key = self._get_key(path, flags)
+
+            with self.lock:
+                while (not self.stopped and
+                       start + idx >= self.n_consumed + self.lookahead):
+                    self.lock.wait(0.5)
+                if self.stopped:
+                    return
+                if key not in self.remaining_uses or key in self.loading:
+                    continue
+
+            if key in self.cache:
+                continue
+
+            _, decoded = self._load(key, path, flags)
+            if decoded:
+                with self.lock:
+                    self.stats["prefetched"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update(("cache_" + k, v) for k, v in self.cache.get_stats().items())
+        return stats
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-image Gaussian pyramid, built lazily and shared by all faces of one
+image: each face crop/warp reads from the level closest to its target scale,
+instead of sampling (and aliasing) from the full resolution image.
+"""
+import math
+import threading
+
+import cv2
+
+
+class ImagePyramid(object):
+    """Lazily built Gaussian pyramid of one image, level 0 is the image,
+    level l is 1/2**l of its size (by cv2.pyrDown()). Thread-safe.
+    """
+
+    def __init__(self, img, max_level=6):
+        """Lazily built Gaussian pyramid of one image.
+
+            Params:
+                img: input image, numpy array
+                max_level: max level to build
+        """
+        self.levels = [img]
+        self.max_level = max_level
+        self.lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def get_level(self, level):
+        """Get pyramid level, build it (and the levels before) if needed.
+
+        Return:
+            (level image, actual level), the actual level can be lower than
+            level if the image gets too small or level > max_level
+        """
+        level = max(0, min(int(level), self.max_level))
+
+        with self.lock:
+            while len(self.levels) <= level:
+                prev = self.levels[-1]
+                if min(prev.shape[0], prev.shape[1]) < 4:
+                    break
+                self.levels.append(cv2.pyrDown(prev))
+
+            level = min(level, len(self.levels) - 1)
+            return self.levels[level], level
+
+    def select_level(self, src_size, dst_size):
+        """Select the highest level which still has at least dst_size pixels
+        for a region of src_size pixels at level 0.
+
+        Params:
+            src_size: size of a region in level-0 pixels
+            dst_size: size the region is going to be resized to
+        Return:
+            level, int
+        """
+        if dst_size <= 0 or src_size <= dst_size * 2:
+            return 0
+
+        return min(int(math.floor(math.log(float(src_size) / dst_size, 2))),
+                   self.max_level)
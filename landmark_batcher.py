@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dynamic micro-batching of landmark inference: faces submitted by many
+concurrent callers are coalesced into network batches of up to batch_size
+faces, waiting at most max_wait seconds (the linger time) for a batch to
+fill, and run on a pool of model workers (one FaceAlignerCaffe each).
+
+Requests go into priority lanes, by default "interactive" and "bulk". Each
+batch is filled from the highest priority lane first, so interactive faces
+go into the next forward ahead of queued bulk work: a large bulk request is
+split at batch boundaries and does not block interactive ones for longer
+than one forward. While lower lanes have pending faces, bulk_share of each
+batch is reserved for each of them, so they are never starved.
+
+When a batch fails, the faces of each of its requests are run again on
+their own, so a bad crop fails only its own request; the pending faces of
+a failed request are dropped.
+
+Usage from threads, each with a few faces:
+    batcher = LandmarkBatcher([FaceAlignerCaffe(config_json)], max_wait=0.002)
+    five_pts_list, face_scores = batcher.get_landmarks_and_scores(crops)
+or with a future:
+    request = batcher.submit(crops)
+    request.add_done_callback(on_done)
+    five_pts_list, face_scores = request.result(timeout=1.0)
+or from asyncio coroutines (python 3):
+    five_pts_list, face_scores = await batcher.submit(crops)
+Bulk work, blocking while its lane is full:
+    request = batcher.submit(crops, lane='bulk', block=True)
+"""
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+try:
+    import asyncio
+except ImportError:  # python 2
+    asyncio = None
+
+LANES = ("interactive", "bulk")
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class QueueFullError(Exception):
+    """The batcher has too many pending faces, the request is rejected."""
+    pass
+
+
+class LatencyHistogram(object):
+    """Latency histogram of fixed buckets, not thread-safe."""
+
+    def __init__(self, bounds_ms=LATENCY_BUCKETS_MS):
+        self.bounds_ms = list(bounds_ms)
+        # the last bucket is above the last bound
+        self.counts = [0] * (len(self.bounds_ms) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        k = 0
+        while k < len(self.bounds_ms) and ms > self.bounds_ms[k]:
+            k += 1
+        self.counts[k] += 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def get_percentile(self, percent):
+        """Get the upper bound of the bucket of a percentile, in ms (the max
+        for the last bucket)."""
+        if not self.count:
+            return 0.0
+
+        rank = self.count * percent / 100.0
+        n = 0
+        for k, count in enumerate(self.counts):
+            n += count
+            if n >= rank and count:
+                if k < len(self.bounds_ms):
+                    return min(float(self.bounds_ms[k]), self.max_ms)
+                break
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.sum_ms / max(self.count, 1),
+            "max_ms": self.max_ms,
+            "p50_ms": self.get_percentile(50),
+            "p90_ms": self.get_percentile(90),
+            "p99_ms": self.get_percentile(99),
+            "bounds_ms": self.bounds_ms,
+            "counts": list(self.counts)
+        }
+
+
+class FaceBatchRequest(object):
+    """Pending landmarks of the faces of one submit() call, a future: wait
+    with result(), or add_done_callback(). It is also awaitable in asyncio
+    coroutines.
+    """
+
+    def __init__(self, crops, lane=LANES[0], trace=None):
+        self.crops = crops
+        self.lane = lane
+        # a tracing.Trace of the image of crops, or None
+        self.trace = trace
+        self.n_faces = len(crops)
+        self.five_pts_list = [None] * self.n_faces
+        self.face_scores = np.full(self.n_faces, np.nan, dtype=np.float32)
+        self.n_done = 0
+        self.error = None
+        self.submit_time = time.time()
+        self.done_event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def _set_results(self, start, five_pts_list, face_scores):
+        """Called by model workers, under the batcher's lock.
+
+        Return:
+            True if the request is done by these results, then the caller
+            must call _run_callbacks() once it released its lock
+        """
+        n_faces = len(five_pts_list)
+        self.five_pts_list[start:start + n_faces] = five_pts_list
+        self.face_scores[start:start + n_faces] = face_scores
+        self.n_done += n_faces
+        return self.n_done >= self.n_faces and self._set_done()
+
+    def _set_error(self, error):
+        """See _set_results(), the first error wins."""
+        if self.done_event.is_set():
+            return False
+        self.error = error
+        return self._set_done()
+
+    def _set_done(self):
+        with self.lock:
+            if self.done_event.is_set():
+                return False
+            self.done_event.set()
+            return True
+
+    def _run_callbacks(self):
+        with self.lock:
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self.done_event.is_set()
+
+    def add_done_callback(self, callback):
+        """Call callback(request) once the request is done, on the model
+        worker thread that completes it (or at once if it is done already).
+        Callbacks must be quick and must not block.
+        """
+        with self.lock:
+            if not self.done_event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        """Wait for the request, and get its error or None."""
+        if not self.done_event.wait(timeout):
+            raise RuntimeError('timeout waiting for landmarks')
+        return self.error
+
+    def result(self, timeout=None):
+        """Wait for the landmarks of all faces.
+
+        Return:
+            five_pts_list, face_scores: as from
+                    FaceAlignerCaffe.get_landmarks_and_scores()
+        """
+        if not self.done_event.wait(timeout):
+            raise RuntimeError('timeout waiting for landmarks')
+        if self.error is not None:
+            raise self.error
+
+        return self.five_pts_list, self.face_scores
+
+    def to_asyncio_future(self, loop=None):
+        """Get an asyncio.Future of the request, resolved on loop (default
+        is the current event loop). Python 3 only.
+        """
+        if asyncio is None:
+            raise RuntimeError('asyncio is not available')
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def set_future(request):
+            if future.cancelled():
+                return
+            if request.error is not None:
+                future.set_exception(request.error)
+            else:
+                future.set_result((request.five_pts_list, request.face_scores))
+
+        def on_done(request):
+            loop.call_soon_threadsafe(set_future, request)
+
+        self.add_done_callback(on_done)
+        return future
+
+    def __await__(self):
+        return self.to_asyncio_future().__await__()
+
+
+class LandmarkBatcher(object):
+    """Coalesce faces of concurrent callers into network batches, see the
+    module docstring. Thread-safe.
+    """
+
+    def __init__(self, aligners, batch_size=None, max_wait=0.005,
+                 max_pending_faces=1024, center_roi_scale=1.0, lanes=LANES,
+                 bulk_share=0.1):
+        """Coalesce faces of concurrent callers into network batches.
+
+            Params:
+                aligners: a list of FaceAlignerCaffe, one model worker each
+                batch_size: max faces per network batch, default is the
+                        batch size of the aligners
+                max_wait: linger time, max seconds the oldest pending face
+                        waits for a batch to fill; or a dict of lane -> seconds
+                max_pending_faces: max pending faces per lane, submit()
+                        raises QueueFullError beyond it; or a dict of
+                        lane -> max faces
+                center_roi_scale: see FaceAlignerCaffe.get_landmarks()
+                lanes: names of the priority lanes, the highest first
+                bulk_share: share of each batch reserved for each lane
+                        below the first one while it has pending faces
+        """
+        self.aligners = list(aligners)
+        self.batch_size = batch_size or self.aligners[0].batch_size
+        self.center_roi_scale = center_roi_scale
+        self.lanes = list(lanes)
+        self.bulk_share = bulk_share
+
+        if not isinstance(max_wait, dict):
+            max_wait = dict((lane, max_wait) for lane in self.lanes)
+        if not isinstance(max_pending_faces, dict):
+            max_pending_faces = dict((lane, max_pending_faces) for lane in self.lanes)
+        self.max_wait = max_wait
+        self.max_pending_faces = max_pending_faces
+
+        self.lock = threading.Lock()
+        # model workers wait on cond, blocked submit() calls on space_cond
+        self.cond = threading.Condition(self.lock)
+        self.space_cond = threading.Condition(self.lock)
+        # lane -> deque of [request, next face index]
+        self.pending = dict((lane, deque()) for lane in self.lanes)
+        self.n_lane_pending = dict((lane, 0) for lane in self.lanes)
+        self.n_pending_faces = 0
+        self.stopped = False
+
+        self.stats = {
+            "requests": 0,
+            "rejected": 0,
+            "faces": 0,
+            "batches": 0,
+            "full_batches": 0,
+            "errors": 0,
+            "retries": 0
+        }
+        # number of batches of each size, index is the batch size
+        self.batch_size_hist = np.zeros(self.batch_size + 1, dtype=np.int64)
+        self.lane_stats = dict((lane, {
+            "requests": 0,
+            "rejected": 0,
+            "faces": 0,
+            "latency": LatencyHistogram()
+        }) for lane in self.lanes)
+
+        self.workers = []
+        for i, aligner in enumerate(self.aligners):
+            thread = threading.Thread(target=self._worker_loop, args=(aligner,),
+                                      name='LandmarkBatcher-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def _has_space(self, lane, n_faces):
+        n_pending = self.n_lane_pending[lane]
+        return not n_pending or n_pending + n_faces <= self.max_pending_faces[lane]
+
+    def submit(self, crops, lane=None, block=False, timeout=None, trace=None):
+        """Submit the cropped faces of one caller.
+
+        Params:
+            crops: a list of cropped face images, as from
+                    FaceAlignerCaffe.rotate_and_crop_faces()
+            lane: priority lane, default is the highest one
+            block: whether to wait while the lane is full, instead of
+                    raising QueueFullError at once
+            timeout: max seconds to wait if block
+            trace: None or a tracing.Trace of the image of crops, to trace
+                    the network batches its faces run in
+        Return:
+            a FaceBatchRequest, a future of the landmarks
+        Raise:
+            QueueFullError if too many faces are pending in the lane
+        """
+        lane = lane or self.lanes[0]
+        if lane not in self.pending:
+            raise ValueError('unknown lane "{}", one of {}'.format(lane, self.lanes))
+        request = FaceBatchRequest(crops, lane, trace)
+        lane_stats = self.lane_stats[lane]
+
+        with self.cond:
+            end_time = None if timeout is None else time.time() + timeout
+            while True:
+                if self.stopped:
+                    raise RuntimeError('LandmarkBatcher is stopped')
+                if self._has_space(lane, request.n_faces):
+                    break
+
+                wait = None if end_time is None else end_time - time.time()
+                if not block or (wait is not None and wait <= 0):
+                    self.stats["rejected"] += 1
+                    lane_stats["rejected"] += 1
+                    raise QueueFullError('{} faces pending in lane {}'.format(
+                        self.n_lane_pending[lane], lane))
+                self.space_cond.wait(wait)
+
+            self.stats["requests"] += 1
+            lane_stats["requests"] += 1
+            if not request.n_faces:
+                request._set_done()
+                lane_stats["latency"].add(0.0)
+                return request
+
+            self.pending[lane].append([request, 0])
+            self.n_lane_pending[lane] += request.n_faces
+            self.n_pending_faces += request.n_faces
+            self.cond.notify()
+
+        return request
+
+    def get_landmarks_and_scores(self, crops, timeout=None, lane=None, trace=None):
+        """Blocking per-call interface: submit crops and wait for them.
+
+        Return:
+            five_pts_list, face_scores: as from
+                    FaceAlignerCaffe.get_landmarks_and_scores()
+        """
+        return self.submit(crops, lane, trace=trace).result(timeout)
+
+    def _get_wait_left(self):
+        """Seconds until the oldest face of some lane waited its max_wait."""
+        now = time.time()
+        return min(lane_queue[0][0].submit_time + self.max_wait[lane] - now
+                   for lane, lane_queue in self.pending.items() if lane_queue)
+
+    def _get_quotas(self):
+        """Split the next batch between the lanes: each lower lane with
+        pending faces gets its bulk_share first, the rest goes by priority.
+
+        Return:
+            a list of the number of faces per lane
+        """
+        n_pending = [self.n_lane_pending[lane] for lane in self.lanes]
+        quotas = [0] * len(self.lanes)
+        n_left = self.batch_size
+
+        if sum(1 for n in n_pending if n) > 1 and self.bulk_share > 0:
+            n_reserved = max(1, int(round(self.bulk_share * self.batch_size)))
+            for i in range(1, len(self.lanes)):
+                quotas[i] = min(n_pending[i], n_reserved, n_left)
+                n_left -= quotas[i]
+
+        for i in range(len(self.lanes)):
+            extra = min(n_pending[i] - quotas[i], n_left)
+            quotas[i] += extra
+            n_left -= extra
+
+        return quotas
+
+    def _drop_done_requests(self):
+        """Drop the pending faces of requests which are done already, i.e.
+        failed by a batch of their other faces. Called under self.cond."""
+        for lane, lane_queue in self.pending.items():
+            if not any(request.done() for request, _ in lane_queue):
+                continue
+            n_faces = 0
+            for entry in list(lane_queue):
+                request, start = entry
+                if request.done():
+                    lane_queue.remove(entry)
+                    n_faces += request.n_faces - start
+            self.n_lane_pending[lane] -= n_faces
+            self.n_pending_faces -= n_faces
+            self.space_cond.notify_all()
+
+    def _take_batch(self):
+        """Wait for a full batch, or for the oldest face of a lane to wait
+        its max_wait, and pop the faces of the batch. Called under self.cond.
+
+        Return:
+            a list of (request, start, end), or None if stopped
+        """
+        while True:
+            if self.stopped:
+                return None
+
+            self._drop_done_requests()
+            if self.n_pending_faces:
+                wait_left = self._get_wait_left()
+                if self.n_pending_faces >= self.batch_size or wait_left <= 0:
+                    break
+                self.cond.wait(wait_left)
+            else:
+                self.cond.wait(0.5)
+
+        batch = []
+        for lane, quota in zip(self.lanes, self._get_quotas()):
+            lane_queue = self.pending[lane]
+            n_faces = 0
+            while lane_queue and n_faces < quota:
+                entry = lane_queue[0]
+                request, start = entry
+                end = min(request.n_faces, start + quota - n_faces)
+                batch.append((request, start, end))
+                n_faces += end - start
+
+                if end >= request.n_faces:
+                    lane_queue.popleft()
+                else:
+                    entry[1] = end
+
+            self.n_lane_pending[lane] -= n_faces
+            self.n_pending_faces -= n_faces
+
+        self.space_cond.notify_all()
+        if self.n_pending_faces:
+            # let another worker take the next batch
+            self.cond.notify()
+
+        return batch
+
+    def _run_batch(self, aligner, batch):
+        """Run a batch, and set the results of its requests. If it fails and
+        holds faces of several requests, the faces of each request are run
+        again on their own, so only the requests with bad faces fail."""
+        # requests failed since the batch was taken
+        batch = [(request, start, end) for request, start, end in batch
+                 if not request.done()]
+        if not batch:
+            return
+
+        crops = [crop for request, start, end in batch
+                 for crop in request.crops[start:end]]
+        face_traces = None
+        if any(request.trace is not None for request, _, _ in batch):
+            face_traces = [(request.trace, i) for request, start, end in batch
+                           for i in range(start, end)]
+
+        try:
+            five_pts_list, face_scores = aligner.get_landmarks_and_scores(
+                crops, self.center_roi_scale, face_traces=face_traces)
+        except Exception as err:
+            with self.cond:
+                self.stats["errors"] += 1
+                if len(batch) > 1:
+                    self.stats["retries"] += len(batch)
+                    done = None
+                else:
+                    done = [request for request, _, _ in batch
+                            if request._set_error(err)]
+            if done is None:
+                for entry in batch:
+                    self._run_batch(aligner, [entry])
+                return
+        else:
+            with self.cond:
+                self.stats["batches"] += 1
+                self.stats["faces"] += len(crops)
+                if len(crops) >= self.batch_size:
+                    self.stats["full_batches"] += 1
+                self.batch_size_hist[len(crops)] += 1
+
+                done = []
+                k = 0
+                for request, start, end in batch:
+                    self.lane_stats[request.lane]["faces"] += end - start
+                    if request._set_results(start, five_pts_list[k:k + end - start],
+                                            face_scores[k:k + end - start]):
+                        done.append(request)
+                    k += end - start
+
+        now = time.time()
+        with self.cond:
+            for request in done:
+                self.lane_stats[request.lane]["latency"].add(now - request.submit_time)
+
+        # outside of the lock, callbacks may submit again
+        for request in done:
+            request._run_callbacks()
+
+    def _worker_loop(self, aligner):
+        while True:
+            with self.cond:
+                batch = self._take_batch()
+            if batch is None:
+                return
+            self._run_batch(aligner, batch)
+
+    def get_stats(self):
+        """Get counters, the achieved batch fill: avg_batch_size, batch_fill
+        (avg_batch_size / batch_size) and batch_size_hist, the number of
+        batches of each size from 0 to batch_size; and per lane counters and
+        latency histograms (submit to done) in "lanes"."""
+        with self.cond:
+            stats = dict(self.stats)
+            stats["pending_faces"] = self.n_pending_faces
+            stats["batch_size_hist"] = self.batch_size_hist.tolist()
+            stats["lanes"] = {}
+            for lane in self.lanes:
+                lane_stats = dict(self.lane_stats[lane])
+                lane_stats["latency"] = lane_stats["latency"].to_dict()
+                lane_stats["pending_faces"] = self.n_lane_pending[lane]
+                stats["lanes"][lane] = lane_stats
+        stats["batch_size"] = self.batch_size
+        stats["max_wait"] = self.max_wait
+        stats["bulk_share"] = self.bulk_share
+        stats["avg_batch_size"] = stats["faces"] / float(max(stats["batches"], 1))
+        stats["batch_fill"] = stats["avg_batch_size"] / self.batch_size
+        return stats
+
+    def close(self):
+        """Stop the model workers, pending requests get an error."""
+        with self.cond:
+            self.stopped = True
+            error = RuntimeError('LandmarkBatcher is stopped')
+            done = [request for lane_queue in self.pending.values()
+                    for request, _ in lane_queue if request._set_error(error)]
+            for lane in self.lanes:
+                self.pending[lane].clear()
+                self.n_lane_pending[lane] = 0
+            self.n_pending_faces = 0
+            self.cond.notify_all()
+            self.space_cond.notify_all()
+
+        for request in done:
+            request._run_callbacks()
+
+        for thread in self.workers:
+            thread.join()
+        self.workers = []
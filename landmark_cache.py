@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of face landmarks, so that repeated images
+(re-uploads, thumbnails of the same photo, ...) skip preprocessing and the
+network forward pass of FaceAlignerCaffe.get_landmarks().
+"""
+import os
+import os.path as osp
+import hashlib
+import threading
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    _hash_func = hashlib.blake2b
+except AttributeError:  # python < 3.6
+    _hash_func = hashlib.md5
+
+# rough per-entry overhead of the dict, key and value objects, in bytes
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def hash_array(arr, extra=None):
+    """Fast content hash of a numpy array (its shape, dtype and pixels).
+
+    Params:
+        arr: numpy array, e.g. an image
+        extra: None or a str/bytes to hash together with arr
+    Return:
+        hex digest, str
+    """
+    arr = np.ascontiguousarray(arr)
+    h = _hash_func()
+    h.update('{}|{}|'.format(arr.shape, arr.dtype.str).encode('utf-8'))
+    h.update(arr.data)
+    if extra is not None:
+        if not isinstance(extra, bytes):
+            extra = str(extra).encode('utf-8')
+        h.update(extra)
+
+    return h.hexdigest()
+
+
+def get_nbytes(value):
+    """Approximate size in bytes of a cached value (numpy arrays, numbers,
+    strings and tuples/lists of them)."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(v) for v in value)
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return 8
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by entry count and by bytes.
+
+    The size of each value is measured by size_func, least recently used
+    entries are evicted until both bounds hold.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, size_func=get_nbytes):
+        """Thread-safe LRU cache bounded by entry count and by bytes.
+
+            Params:
+                max_entries: max number of entries, 0 for no limit
+                max_bytes: max total bytes of entries, 0 for no limit
+                size_func: callable(value) which returns its size in bytes
+        """
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.size_func = size_func
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, nbytes)
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+
+            # re-insert as most recently used
+            self.entries[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        """Insert value, return False if it is larger than the whole cache."""
+        nbytes = self.size_func(value) + len(key) + ENTRY_OVERHEAD_BYTES
+        if self.max_bytes and nbytes > self.max_bytes:
+            return False
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+
+            self.entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            self._evict()
+
+        return True
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                return default
+            self.total_bytes -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _evict(self):
+        while self.entries and (
+                (self.max_entries and len(self.entries) > self.max_entries) or
+                (self.max_bytes and self.total_bytes > self.max_bytes)):
+            _, item = self.entries.popitem(last=False)
+            self.total_bytes -= item[1]
+            self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            n_lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / float(n_lookups) if n_lookups else 0.0
+            }
+
+
+class LandmarkCache(LRUCache):
+    """LRU cache of (five_pts, face_score) for FaceAlignerCaffe.get_landmarks().
+
+    Keys are either a hash of the cropped face pixels (make_crop_key()),
+    or the hash of the source image plus the quantized face rect and angle
+    (make_face_key()), which avoids hashing every crop when the caller
+    already knows the image hash.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=64 * 1024 * 1024,
+                 persist_path=None):
+        """LRU cache of (five_pts, face_score).
+
+            Params:
+                max_entries: max number of entries, 0 for no limit
+                max_bytes: max total bytes of entries, 0 for no limit
+                persist_path: None or a file to load the cache from, and
+                        to save it into by save()
+        """
+        LRUCache.__init__(self, max_entries, max_bytes)
+        self.persist_path = persist_path
+
+        if persist_path and osp.isfile(persist_path):
+            self.load(persist_path)
+
+    @staticmethod
+    def make_crop_key(img_cropped, center_roi_scale=1.0):
+        """Key from the pixels of a cropped face image."""
+        return hash_array(img_cropped, 'crop|{:.6f}'.format(center_roi_scale))
+
+    @staticmethod
+    def make_face_key(image_key, pts, angle, crop_scale=1.0,
+                      center_roi_scale=1.0, pixel_step=2.0, angle_step=1.0):
+        """Key from the hash of the source image and the face rect.
+
+        Params:
+            image_key: content hash of the source image, e.g. hash_array(img)
+                    or a hash of the encoded image file
+            pts: face rect, 4 pts, [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+            angle: float, in degree
+            crop_scale: scale used by FaceAlignerCaffe.rotate_and_crop_faces()
+            center_roi_scale: center_roi_scale used by FaceAlignerCaffe.get_landmarks()
+            pixel_step, angle_step: quantization steps of pts and angle
+        Return:
+            key, str
+        """
+        q_pts = np.round(np.asarray(pts, dtype=np.float64) / pixel_step)
+        q_angle = int(round(float(angle) / angle_step))
+
+        return 'face|{}|{}|{}|{:.6f}|{:.6f}'.format(
+            image_key, ','.join(str(int(v)) for v in q_pts.ravel()),
+            q_angle, crop_scale, center_roi_scale)
+
+    def save(self, path=None):
+        """Save the cache entries (in LRU order) into path or persist_path."""
+        path = path or self.persist_path
+        if not path:
+            return
+
+        with self.lock:
+            items = [(k, v[0]) for k, v in self.entries.items()]
+
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(items, fp, protocol=2)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        """Load cache entries saved by save()."""
+        with open(path, 'rb') as fp:
+            items = pickle.load(fp)
+
+        for key, value in items:
+            self.put(key, value)
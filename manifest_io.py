@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming I/O of detection manifests and alignment results, in constant
+memory: manifests are read one JSON object per line (JSONL), with the same
+schema as the entries of test_imgs_weidong/test_data.json, and results are
+written one JSON object per line, in buffered batches.
+
+Convert an existing manifest (a JSON array) into JSONL:
+
+    python manifest_io.py test_data.json test_data.jsonl
+"""
+import json
+import threading
+
+import numpy as np
+
+from detection_batch import parse_manifest_entries
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_manifest_jsonl(path, skip_lines=0):
+    """Iterate over the entries of a JSONL manifest, one dict per line
+    ({"uri": ..., "detections": [{"pts": ..., "orientation": ...}, ...]}).
+
+    Params:
+        path: path to a .jsonl manifest
+        skip_lines: number of (non-empty) lines to skip, e.g. to resume
+    Return:
+        an iterator of (line_idx, entry), line_idx counts non-empty lines
+    """
+    with open(path, 'r') as fp:
+        line_idx = 0
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if line_idx >= skip_lines:
+                yield line_idx, json.loads(line)
+            line_idx += 1
+
+
+def iter_json_array(fp, chunk_size=READ_CHUNK_SIZE):
+    """Iterate over the items of a JSON array file without loading the
+    whole file, one item at a time.
+
+    Params:
+        fp: file object opened in text mode, its content is a JSON array
+        chunk_size: number of chars to read at a time
+    Return:
+        an iterator of the decoded array items
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # skip whitespaces and separators
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+            if buf[pos] == '[':
+                if started:
+                    break
+                started = True
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # an incomplete item, unless the file ended
+                if eof:
+                    raise
+            else:
+                # a number is complete only if a separator follows it
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,]'):
+                    yield item
+                    pos = end
+                    continue
+
+        if eof:
+            if started:
+                raise ValueError('unterminated JSON array')
+            return
+
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def convert_json_to_jsonl(src_path, dst_path, chunk_size=READ_CHUNK_SIZE):
+    """Convert a manifest in JSON array format (as test_data.json) into
+    JSONL, streaming both files.
+
+    Return:
+        number of entries written
+    """
+    n_entries = 0
+    with open(src_path, 'r') as src_fp:
+        with ResultWriter(dst_path) as writer:
+            for entry in iter_json_array(src_fp, chunk_size):
+                writer.write(entry)
+                n_entries += 1
+
+    return n_entries
+
+
+def iter_manifest(path, skip_lines=0):
+    """iter_manifest_jsonl() for .jsonl manifests, and a streaming read of
+    the items of JSON array manifests (as test_data.json) otherwise."""
+    if path.endswith('.jsonl'):
+        for item in iter_manifest_jsonl(path, skip_lines):
+            yield item
+        return
+
+    with open(path, 'r') as fp:
+        for line_idx, entry in enumerate(iter_json_array(fp)):
+            if line_idx >= skip_lines:
+                yield line_idx, entry
+
+
+def iter_detection_batches(path, batch_size=256, skip_lines=0):
+    """Read a JSONL manifest in batches of entries.
+
+    Params:
+        path: path to a .jsonl (or JSON array) manifest
+        batch_size: number of entries (images) per batch
+        skip_lines: see iter_manifest_jsonl(), entries of JSON arrays
+                count as lines
+    Return:
+        an iterator of (line_indices, uris, detections), detections is a
+                DetectionBatch whose image_idx indexes uris
+    """
+    entries = []
+    line_indices = []
+
+    for line_idx, entry in iter_manifest(path, skip_lines):
+        entries.append(entry)
+        line_indices.append(line_idx)
+
+        if len(entries) >= batch_size:
+            uris, detections = parse_manifest_entries(entries)
+            yield line_indices, uris, detections
+            entries = []
+            line_indices = []
+
+    if entries:
+        uris, detections = parse_manifest_entries(entries)
+        yield line_indices, uris, detections
+
+
+def _to_json_type(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{} is not JSON serializable'.format(type(obj)))
+
+
+class ResultWriter(object):
+    """Buffered, thread-safe JSONL writer, records are written to the file
+    in batches of flush_every lines.
+    """
+
+    def __init__(self, path, flush_every=1000, append=False):
+        """Buffered, thread-safe JSONL writer.
+
+            Params:
+                path: output .jsonl file
+                flush_every: number of buffered records which triggers a write
+                append: whether to append to an existing file
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.fp = open(path, 'a' if append else 'w')
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.n_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, record):
+        """Write a record, a dict of JSON types or numpy arrays/scalars."""
+        line = json.dumps(record, default=_to_json_type, separators=(',', ':'))
+
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.flush_every:
+                self._flush()
+
+    def write_face(self, uri, face_idx, five_pts, chip_path=None, **fields):
+        """Write the result of one face.
+
+        Params:
+            uri: uri of the source image
+            face_idx: index of the face in the manifest entry of uri
+            five_pts: face landmarks, [x1..x5, y1..y5] (or [[x, y]]*5),
+                    as from FaceAlignerCaffe.get_landmarks()
+            chip_path: None or the path (or packed file reference) of the
+                    aligned face chip
+            fields: more fields of the record, e.g. face_score
+        """
+        record = {
+            "uri": uri,
+            "face_idx": face_idx,
+            "five_pts": five_pts
+        }
+        if chip_path is not None:
+            record["chip"] = chip_path
+        record.update(fields)
+
+        self.write(record)
+
+    def _flush(self):
+        if self.buffer:
+            self.fp.write('\n'.join(self.buffer) + '\n')
+            self.n_written += len(self.buffer)
+            self.buffer = []
+        self.fp.flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self._flush()
+                self.fp.close()
+                self.fp = None
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 3:
+        print('Usage: python manifest_io.py <input.json> <output.jsonl>')
+        sys.exit(1)
+
+    n_entries = convert_json_to_jsonl(sys.argv[1], sys.argv[2])
+    print('{} entries written into {}'.format(n_entries, sys.argv[2]))
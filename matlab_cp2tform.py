@@ -6,7 +6,7 @@ Created on Tue Jul 11 06:54:28 2017
 """
 
 import numpy as np
-from numpy.linalg import inv, norm, lstsq
+from numpy.linalg import inv, norm, lstsq, pinv
 from numpy.linalg import matrix_rank as rank
 
 
@@ -404,7 +404,9 @@ def findSimilarity(uv, xy, options=None):
     # Solve for trans2
 
     # manually reflect the xy data across the Y-axis
-    xyR = xy
+    # copy, so that xy stays un-reflected for the norm comparison below
+    # (Matlab assignment copies, numpy assignment does not)
+    xyR = xy.copy()
     xyR[:, 0] = -1 * xyR[:, 0]
 
     trans2r, trans2r_inv = findNonreflectiveSimilarity(uv, xyR, options)
@@ -537,6 +539,223 @@ def get_similarity_transform_for_cv2(src_pts, dst_pts, reflective=True):
     return cv2_trans
 
 
+def _build_nonreflective_system(xy):
+    """
+    Function:
+    ----------
+        Build the (2K)x4 matrix X of findNonreflectiveSimilarity() from the
+        destination points xy, check its rank and factorize it into its
+        pseudo-inverse, so that r = pinv(X) * U for any U.
+
+    Parameters:
+    ----------
+        @xy: Kx2 np.array
+            destination points, each row is a pair of coordinates (x, y)
+
+    Returns:
+    ----------
+        @X_pinv: 4x(2K) np.array
+            pseudo-inverse of X
+    """
+    K = 2
+    M = xy.shape[0]
+    x = xy[:, 0].reshape((-1, 1))
+    y = xy[:, 1].reshape((-1, 1))
+
+    tmp1 = np.hstack((x, y, np.ones((M, 1)), np.zeros((M, 1))))
+    tmp2 = np.hstack((y, -x, np.zeros((M, 1)), np.ones((M, 1))))
+    X = np.vstack((tmp1, tmp2))
+
+    if rank(X) < 2 * K:
+        raise Exception('cp2tform:twoUniquePointsReq')
+
+    return pinv(X)
+
+
+def _params_to_cv2_trans(r):
+    """
+    Function:
+    ----------
+        Convert a batch of nonreflective similarity parameters
+        r = [sc, ss, tx, ty] (which map xy to uv, i.e. Tinv) into cv2 2x3
+        matrices of trans = inv(Tinv), computed in closed form.
+
+    Parameters:
+    ----------
+        @r: Nx4 np.array
+            [sc, ss, tx, ty] for each of the N transforms
+
+    Returns:
+    ----------
+        @cv2_trans: Nx2x3 np.array
+            transform matrices from uv to xy for cv2.warpAffine()
+    """
+    sc, ss, tx, ty = r[:, 0], r[:, 1], r[:, 2], r[:, 3]
+    det = sc * sc + ss * ss
+
+    cv2_trans = np.empty((r.shape[0], 2, 3), dtype=np.float64)
+    cv2_trans[:, 0, 0] = sc / det
+    cv2_trans[:, 0, 1] = -ss / det
+    cv2_trans[:, 0, 2] = -(tx * sc - ty * ss) / det
+    cv2_trans[:, 1, 0] = ss / det
+    cv2_trans[:, 1, 1] = sc / det
+    cv2_trans[:, 1, 2] = -(tx * ss + ty * sc) / det
+
+    return cv2_trans
+
+
+class SimilarityTransformSolver(object):
+    """
+    Solve similarity transforms from many source point sets onto one fixed
+    set of destination points (e.g. the reference facial points).
+
+    The linear system of findNonreflectiveSimilarity() only depends on the
+    destination points, so it is factorized once in __init__(), and the
+    transforms for N faces are solved by a single matrix product in
+    solve_for_cv2().
+    """
+
+    def __init__(self, dst_pts, reflective=True):
+        """
+        Parameters:
+        ----------
+            @dst_pts: Kx2 np.array
+                destination points, each row is a pair of coordinates (x, y)
+            @reflective: True or False
+                if True:
+                    use reflective similarity transform
+                else:
+                    use non-reflective similarity transform
+        """
+        xy = np.array(dst_pts, dtype=np.float64)
+        if xy.ndim != 2 or xy.shape[1] != 2 or xy.shape[0] < 2:
+            raise MatlabCp2tormException('dst_pts.shape must be (K,2), K>=2')
+
+        self.dst_pts = xy
+        self.reflective = reflective
+        self.n_pts = xy.shape[0]
+
+        self.X_pinv = _build_nonreflective_system(xy)
+        self.X_pinv_reflected = None
+
+        if reflective:
+            xyR = xy.copy()
+            xyR[:, 0] = -1 * xyR[:, 0]
+            self.X_pinv_reflected = _build_nonreflective_system(xyR)
+
+    def solve_for_cv2(self, src_pts_batch):
+        """
+        Function:
+        ----------
+            Find the similarity transform matrices 'cv2_trans' from each
+            set of source points onto dst_pts, same results as calling
+            get_similarity_transform_for_cv2() for each set of points.
+
+        Parameters:
+        ----------
+            @src_pts_batch: NxKx2 np.array (or Kx2 for a single face)
+                source points, each row is a pair of coordinates (x, y)
+
+        Returns:
+        ----------
+            @cv2_trans: Nx2x3 np.array
+                transform matrices from src_pts to dst_pts, could be
+                directly used for cv2.warpAffine()
+        """
+        uv = np.asarray(src_pts_batch, dtype=np.float64)
+        if uv.ndim == 2:
+            uv = uv[np.newaxis]
+
+        if uv.shape[1:] != (self.n_pts, 2):
+            raise MatlabCp2tormException(
+                'src_pts_batch.shape must be (N,{},2)'.format(self.n_pts))
+
+        # U = [u; v] for each face, as rows
+        U = np.concatenate((uv[:, :, 0], uv[:, :, 1]), axis=1)
+
+        trans1 = _params_to_cv2_trans(np.dot(U, self.X_pinv.T))
+        if not self.reflective:
+            return trans1
+
+        # undo the reflection across the Y-axis: negate the x output row
+        trans2 = _params_to_cv2_trans(np.dot(U, self.X_pinv_reflected.T))
+        trans2[:, 0, :] *= -1
+
+        # Figure out if trans1 or trans2 is better
+        uv_aug = np.concatenate(
+            (uv, np.ones(uv.shape[:2] + (1,))), axis=2)
+        err1 = np.einsum('nkj,nij->nki', uv_aug, trans1) - self.dst_pts
+        err2 = np.einsum('nkj,nij->nki', uv_aug, trans2) - self.dst_pts
+        norm1 = np.sum(err1 * err1, axis=(1, 2))
+        norm2 = np.sum(err2 * err2, axis=(1, 2))
+
+        use_trans1 = (norm1 <= norm2)
+        return np.where(use_trans1[:, np.newaxis, np.newaxis], trans1, trans2)
+
+
+_similarity_solver_cache = {}
+
+
+def get_similarity_transform_solver(dst_pts, reflective=True):
+    """
+    Function:
+    ----------
+        Get a SimilarityTransformSolver for dst_pts, factorized only once
+        per (dst_pts, reflective) and cached afterwards.
+
+    Parameters:
+    ----------
+        @dst_pts: Kx2 np.array
+            destination points, each row is a pair of coordinates (x, y)
+        @reflective: True or False
+            see SimilarityTransformSolver
+
+    Returns:
+    ----------
+        @solver: SimilarityTransformSolver
+    """
+    xy = np.array(dst_pts, dtype=np.float64)
+    key = (xy.shape, xy.tobytes(), bool(reflective))
+
+    solver = _similarity_solver_cache.get(key)
+    if solver is None:
+        solver = SimilarityTransformSolver(xy, reflective)
+        _similarity_solver_cache[key] = solver
+
+    return solver
+
+
+def get_similarity_transforms_for_cv2(src_pts_batch, dst_pts, reflective=True):
+    """
+    Function:
+    ----------
+        Batched version of get_similarity_transform_for_cv2(): find the
+        similarity transform matrices from N sets of source points onto the
+        same destination points.
+
+    Parameters:
+    ----------
+        @src_pts_batch: NxKx2 np.array
+            source points of N faces, each row is a pair of coordinates (x, y)
+        @dst_pts: Kx2 np.array
+            destination points, each row is a pair of transformed
+            coordinates (x, y)
+        @reflective: True or False
+            if True:
+                use reflective similarity transform
+            else:
+                use non-reflective similarity transform
+
+    Returns:
+    ----------
+        @cv2_trans: Nx2x3 np.array
+            transform matrices from src_pts to dst_pts, could be directly used
+            for cv2.warpAffine()
+    """
+    solver = get_similarity_transform_solver(dst_pts, reflective)
+    return solver.solve_for_cv2(src_pts_batch)
+
+
 if __name__ == '__main__':
     """
     u = [0, 6, -2]
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory budget and instrumentation of the alignment flow.
+
+MemoryBudget bounds the images, faces and bytes in flight: acquire() blocks
+while the budget is used up, so memory stays bounded however large the
+input is, and more workers fit on a host without OOM kills.
+
+MemoryTracker accounts the bytes held by each stage of the flow
+(MEMORY_STAGES: decoded images, face crops, the network input blob, network
+outputs, face chips), keeps the peak of each, and samples the process RSS
+on a background thread. In debug mode it also traces allocations with
+tracemalloc (python 3): the growth of traced memory during each stage, and
+per stage snapshots of the top allocation sites. Debug mode is slow, and
+attribution is only exact with one worker per stage.
+"""
+import os
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+MEMORY_STAGES = ("decode", "crops", "input_blob", "outputs", "chips")
+
+MB = 1024.0 * 1024.0
+
+
+def get_rss_bytes():
+    """Get the resident set size of this process in bytes, None if unknown.
+    Falls back to the peak RSS where /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+        import sys
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KB elsewhere
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+def get_nbytes(arrays):
+    """Get the total bytes of a list of numpy arrays."""
+    return sum(arr.nbytes for arr in arrays)
+
+
+class MemoryBudget(object):
+    """Bound the images, faces and bytes in flight, thread-safe. A limit of
+    0 means no limit. A single item is always admitted when nothing is in
+    flight, however large it is.
+    """
+
+    def __init__(self, max_bytes=0, max_images=0, max_faces=0):
+        self.max_bytes = max_bytes
+        self.max_images = max_images
+        self.max_faces = max_faces
+
+        self.cond = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.cond:
+            self.closed = False
+            self.n_bytes = 0
+            self.n_images = 0
+            self.n_faces = 0
+            self.stats = {
+                "acquired": 0,
+                "waits": 0,
+                "wait_time": 0.0,
+                "peak_bytes": 0,
+                "peak_images": 0,
+                "peak_faces": 0
+            }
+            self.cond.notify_all()
+
+    def close(self):
+        """Stop limiting and admit the waiting threads, e.g. on shutdown.
+        Stats are kept until reset()."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def is_limited(self):
+        return bool(self.max_bytes or self.max_images or self.max_faces)
+
+    def _fits(self, images, faces, nbytes):
+        if self.closed:
+            return True
+        if not self.n_images and not self.n_faces and not self.n_bytes:
+            return True
+        return ((not self.max_images or self.n_images + images <= self.max_images) and
+                (not self.max_faces or self.n_faces + faces <= self.max_faces) and
+                (not self.max_bytes or self.n_bytes + nbytes <= self.max_bytes))
+
+    def _add(self, images, faces, nbytes):
+        self.n_images += images
+        self.n_faces += faces
+        self.n_bytes += nbytes
+        stats = self.stats
+        stats["peak_images"] = max(stats["peak_images"], self.n_images)
+        stats["peak_faces"] = max(stats["peak_faces"], self.n_faces)
+        stats["peak_bytes"] = max(stats["peak_bytes"], self.n_bytes)
+
+    def acquire(self, images=1, faces=0, nbytes=0, timeout=None):
+        """Wait until the budget has room, and take it.
+
+        Return:
+            False on timeout
+        """
+        with self.cond:
+            if not self._fits(images, faces, nbytes):
+                self.stats["waits"] += 1
+                t0 = time.time()
+                end_time = None if timeout is None else t0 + timeout
+                while not self._fits(images, faces, nbytes):
+                    wait = None if end_time is None else end_time - time.time()
+                    if wait is not None and wait <= 0:
+                        self.stats["wait_time"] += time.time() - t0
+                        return False
+                    self.cond.wait(wait)
+                self.stats["wait_time"] += time.time() - t0
+
+            self._add(images, faces, nbytes)
+            self.stats["acquired"] += 1
+            return True
+
+    def charge(self, nbytes):
+        """Add bytes to what is in flight without waiting, e.g. once the
+        size of a decoded item is known; later acquire() calls wait for it."""
+        with self.cond:
+            self._add(0, 0, nbytes)
+
+    def release(self, images=1, faces=0, nbytes=0):
+        with self.cond:
+            self.n_images -= images
+            self.n_faces -= faces
+            self.n_bytes -= nbytes
+            self.cond.notify_all()
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats["images"] = self.n_images
+            stats["faces"] = self.n_faces
+            stats["bytes"] = self.n_bytes
+        stats["max_images"] = self.max_images
+        stats["max_faces"] = self.max_faces
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+class MemoryTracker(object):
+    """Account the bytes held by each stage, sample RSS, and trace
+    allocations in debug mode, see the module docstring. Thread-safe.
+    """
+
+    def __init__(self, stages=MEMORY_STAGES, rss_interval=0.5, debug=False,
+                 snapshot_interval=10.0, top_n=10):
+        """Account the bytes held by each stage.
+
+            Params:
+                stages: stage names
+                rss_interval: seconds between RSS samples, 0 for none
+                debug: whether to trace allocations with tracemalloc
+                snapshot_interval: min seconds between tracemalloc snapshots
+                        of a stage
+                top_n: number of allocation sites kept per snapshot
+        """
+        self.stages = list(stages)
+        self.rss_interval = rss_interval
+        self.debug = debug and tracemalloc is not None
+        self.snapshot_interval = snapshot_interval
+        self.top_n = top_n
+
+        self.lock = threading.Lock()
+        self.current = dict((stage, 0) for stage in self.stages)
+        self.peak = dict((stage, 0) for stage in self.stages)
+        self.peak_total = 0
+        self.peak_rss = 0
+        self.rss = 0
+
+        self.traced_growth = dict((stage, 0) for stage in self.stages)
+        self.snapshots = {}
+        self.snapshot_times = {}
+        self.baseline = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start sampling RSS, and tracing allocations in debug mode."""
+        if self.debug:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.baseline = tracemalloc.take_snapshot()
+
+        self.sample_rss()
+        if self.rss_interval and self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._sample_loop,
+                                           name='MemoryTracker')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.sample_rss()
+        if self.debug and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _sample_loop(self):
+        while not self.stop_event.wait(self.rss_interval):
+            self.sample_rss()
+
+    def sample_rss(self):
+        rss = get_rss_bytes()
+        if rss is None:
+            return
+        with self.lock:
+            self.rss = rss
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def add(self, stage, nbytes):
+        """Account nbytes more held by stage."""
+        with self.lock:
+            self.current[stage] += nbytes
+            self.peak[stage] = max(self.peak[stage], self.current[stage])
+            self.peak_total = max(self.peak_total, sum(self.current.values()))
+
+    def sub(self, stage, nbytes):
+        """Account nbytes released by stage."""
+        with self.lock:
+            self.current[stage] -= nbytes
+
+    def trace(self, stage):
+        """Context manager around the work of a stage: in debug mode, record
+        the growth of traced memory and snapshot the allocations."""
+        return _StageTrace(self, stage)
+
+    def _record_trace(self, stage, growth):
+        take_snapshot = False
+        now = time.time()
+        with self.lock:
+            self.traced_growth[stage] = max(self.traced_growth[stage], growth)
+            if now - self.snapshot_times.get(stage, 0) >= self.snapshot_interval:
+                self.snapshot_times[stage] = now
+                take_snapshot = True
+
+        if take_snapshot:
+            snapshot = tracemalloc.take_snapshot()
+            top = snapshot.compare_to(self.baseline, 'lineno')[:self.top_n]
+            with self.lock:
+                self.snapshots[stage] = [
+                    (str(stat.traceback), stat.size, stat.size_diff) for stat in top]
+
+    def get_stats(self):
+        """Get current and peak bytes by stage, peak of their total, current
+        and peak RSS; in debug mode also the max traced memory growth during
+        each stage and the top allocation sites (site, size, growth since
+        start) of the latest snapshot of each stage."""
+        with self.lock:
+            stats = {
+                "current_bytes": dict(self.current),
+                "peak_bytes": dict(self.peak),
+                "peak_total_bytes": self.peak_total,
+                "rss_bytes": self.rss,
+                "peak_rss_bytes": self.peak_rss
+            }
+            if self.debug:
+                stats["traced_growth_bytes"] = dict(self.traced_growth)
+                stats["top_allocations"] = dict(self.snapshots)
+        return stats
+
+    def format_stats(self):
+        """Format peak bytes by stage and RSS in MB, one line."""
+        stats = self.get_stats()
+        return 'peak MB: {} total={:.1f} rss={:.1f} (peak {:.1f})'.format(
+            ' '.join('{}={:.1f}'.format(stage, stats["peak_bytes"][stage] / MB)
+                     for stage in self.stages),
+            stats["peak_total_bytes"] / MB, stats["rss_bytes"] / MB,
+            stats["peak_rss_bytes"] / MB)
+
+
+class _StageTrace(object):
+
+    def __init__(self, tracker, stage):
+        self.tracker = tracker
+        self.stage = stage
+        self.start = 0
+
+    def __enter__(self):
+        if self.tracker.debug:
+            self.start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *args):
+        if self.tracker.debug:
+            growth = tracemalloc.get_traced_memory()[0] - self.start
+            self.tracker._record_trace(self.stage, growth)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Metrics of the alignment flow: counters, and histograms of the latency of
+each stage (METRIC_STAGES) and of the batch fill ratio. They are queryable
+from python by MetricsRegistry.get_stats(), and exported in the Prometheus
+text format by to_prometheus(), served on /metrics by MetricsServer (or by
+align_service.py).
+
+FaceAlignerCaffe and MxnetFeatureExtractor take a registry by set_metrics(),
+they have none by default; without one, timing a stage costs one test for
+None (see stage_timer()).
+
+Usage:
+    metrics = MetricsRegistry()
+    face_aligner.set_metrics(metrics)
+    server = MetricsServer(metrics, port=9100)
+    server.start()
+    ...
+    print(metrics.get_stats()["stages"]["forward"]["p99_ms"])
+"""
+import bisect
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# transform_solve: similarity transforms of landmarks to the chip template
+METRIC_STAGES = ("decode", "crop", "preprocess", "forward", "harvest",
+                 "transform_solve", "warp")
+
+# in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FILL_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """A monotonic counter, thread-safe."""
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def get_value(self):
+        return self.value
+
+
+class Histogram(object):
+    """A histogram of fixed buckets, thread-safe."""
+
+    def __init__(self, name, help='', bounds=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.bounds = list(bounds)
+        self.lock = threading.Lock()
+        # the last bucket is above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        k = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[k] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def get_percentile(self, percent):
+        """Get the upper bound of the bucket of a percentile (the max for
+        the last bucket)."""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            max_value = self.max
+        if not count:
+            return 0.0
+
+        rank = count * percent / 100.0
+        n = 0
+        for k, bucket_count in enumerate(counts):
+            n += bucket_count
+            if n >= rank and bucket_count:
+                if k < len(self.bounds):
+                    return min(float(self.bounds[k]), max_value)
+                break
+        return max_value
+
+    def to_dict(self, scale=1.0, unit=''):
+        """Get count, mean, max and p50/p90/p99, values multiplied by scale
+        and their keys suffixed by unit, e.g. (1000, '_ms') for seconds."""
+        with self.lock:
+            count, total, max_value = self.count, self.sum, self.max
+        stats = {"count": count}
+        stats["mean" + unit] = total / max(count, 1) * scale
+        stats["max" + unit] = max_value * scale
+        for p in (50, 90, 99):
+            stats["p{}{}".format(p, unit)] = self.get_percentile(p) * scale
+        return stats
+
+    def get_cumulative(self):
+        """Get (upper bounds ending with inf, cumulative counts), sum and
+        count, as exported to Prometheus."""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        n = 0
+        for bucket_count in counts:
+            n += bucket_count
+            cumulative.append(n)
+        return list(zip(self.bounds + [float('inf')], cumulative)), total, n
+
+
+class _StageTimer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def stage_timer(metrics, stage):
+    """Context manager timing a stage into metrics, a MetricsRegistry or
+    None (then it does nothing)."""
+    if metrics is None:
+        return NULL_TIMER
+    return metrics.timer(stage)
+
+
+class MetricsRegistry(object):
+    """Named counters and histograms of one process, thread-safe.
+    Metric names are prefixed by namespace in the Prometheus export.
+    """
+
+    def __init__(self, namespace='face_align'):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        # (name, labels) -> metric, in the order of creation
+        self.metrics = {}
+        self.order = []
+        self.start_time = time.time()
+
+        # stage -> histogram, to skip the label lookup when timing stages
+        self.stage_histograms = {}
+        self.faces = self.counter('faces_total', 'faces through the landmark network')
+        self.images = self.counter('images_total', 'decoded images')
+        self.batches = self.counter('batches_total', 'landmark network batches')
+        self.batch_fill = self.histogram(
+            'batch_fill_ratio', 'faces per network batch / batch size',
+            FILL_BUCKETS)
+        for stage in METRIC_STAGES:
+            self.get_stage_histogram(stage)
+
+    def _get_metric(self, cls, name, help, labels, *args):
+        labels = tuple(sorted(labels.items()))
+        key = (name, labels)
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = cls(name, help, *(args + (labels,)))
+                    self.metrics[key] = metric
+                    self.order.append(key)
+        if not isinstance(metric, cls):
+            raise ValueError('metric {} is not a {}'.format(name, cls.__name__))
+        return metric
+
+    def counter(self, name, help='', **labels):
+        """Get or create a Counter."""
+        return self._get_metric(Counter, name, help, labels)
+
+    def histogram(self, name, help='', bounds=LATENCY_BUCKETS, **labels):
+        """Get or create a Histogram, bounds only apply on creation."""
+        return self._get_metric(Histogram, name, help, labels, bounds)
+
+    def get_stage_histogram(self, stage):
+        histogram = self.stage_histograms.get(stage)
+        if histogram is None:
+            histogram = self.histogram('stage_seconds', 'latency of each stage',
+                                       stage=stage)
+            self.stage_histograms[stage] = histogram
+        return histogram
+
+    def timer(self, stage):
+        """Context manager timing a stage."""
+        return _StageTimer(self.get_stage_histogram(stage))
+
+    def observe_stage(self, stage, seconds):
+        self.get_stage_histogram(stage).observe(seconds)
+
+    def observe_batch(self, n_faces, batch_size):
+        """Count a network batch of n_faces, out of batch_size."""
+        self.batches.inc()
+        self.faces.inc(n_faces)
+        self.batch_fill.observe(float(n_faces) / max(batch_size, 1))
+
+    def get_stats(self):
+        """Get the stats of all metrics.
+
+        Return:
+            a dict of:
+                stages: stage -> latency stats in ms, see Histogram.to_dict()
+                batch_fill: batch fill ratio stats
+                faces_per_sec, images_per_sec: since the registry was created
+                counters: 'name{labels}' -> value
+                histograms: 'name{labels}' -> stats of the other histograms
+        """
+        with self.lock:
+            keys = list(self.order)
+        elapsed = max(time.time() - self.start_time, 1e-9)
+
+        stats = {
+            "uptime": elapsed,
+            "stages": dict((stage, histogram.to_dict(1000, '_ms'))
+                           for stage, histogram in list(self.stage_histograms.items())),
+            "batch_fill": self.batch_fill.to_dict(),
+            "faces_per_sec": self.faces.get_value() / elapsed,
+            "images_per_sec": self.images.get_value() / elapsed,
+            "counters": {},
+            "histograms": {}
+        }
+        stage_keys = set((h.name, h.labels) for h in list(self.stage_histograms.values()))
+        for key in keys:
+            metric = self.metrics[key]
+            name = metric.name + _format_labels(metric.labels)
+            if isinstance(metric, Counter):
+                stats["counters"][name] = metric.get_value()
+            elif key not in stage_keys and metric is not self.batch_fill:
+                stats["histograms"][name] = metric.to_dict()
+        return stats
+
+    def format_stats(self):
+        """Format p50/p99 latency of each stage in ms, faces/s and the mean
+        batch fill ratio, one line."""
+        stats = self.get_stats()
+        return 'p50/p99 ms: {} faces/s={:.1f} batch_fill={:.2f}'.format(
+            ' '.join('{}={:.2f}/{:.2f}'.format(
+                stage, stats["stages"][stage]["p50_ms"], stats["stages"][stage]["p99_ms"])
+                for stage in METRIC_STAGES if stats["stages"][stage]["count"]),
+            stats["faces_per_sec"], stats["batch_fill"]["mean"])
+
+    def to_prometheus(self):
+        """Export all metrics in the Prometheus text format (version 0.0.4)."""
+        with self.lock:
+            keys = list(self.order)
+
+        lines = []
+        families = set()
+        for key in sorted(keys, key=lambda key: key[0]):
+            metric = self.metrics[key]
+            name = '{}_{}'.format(self.namespace, metric.name)
+            if name not in families:
+                families.add(name)
+                if metric.help:
+                    lines.append('# HELP {} {}'.format(name, metric.help))
+                lines.append('# TYPE {} {}'.format(
+                    name, 'counter' if isinstance(metric, Counter) else 'histogram'))
+
+            if isinstance(metric, Counter):
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(metric.labels), metric.get_value()))
+                continue
+
+            buckets, total, count = metric.get_cumulative()
+            for bound, n in buckets:
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(metric.labels + (('le', _format_value(bound)),)), n))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(metric.labels), _format_value(total)))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(metric.labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    # set by MetricsServer
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        data = self.metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # no log line per scrape
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serve a MetricsRegistry on GET /metrics, on a background thread."""
+
+    def __init__(self, metrics, host='127.0.0.1', port=9100):
+        """Serve a MetricsRegistry on GET /metrics.
+
+            Params:
+                metrics: the MetricsRegistry
+                host: address to bind, localhost by default
+                port: port to bind, 0 for any free port (see self.port)
+        """
+        handler = type('BoundMetricsRequestHandler', (MetricsRequestHandler,),
+                       {"metrics": metrics})
+        self.server = _ThreadingHTTPServer((host, port), handler)
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
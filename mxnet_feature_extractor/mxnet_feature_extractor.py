@@ -66,6 +66,10 @@ class MxnetFeatureExtractor(object):
         self.all_layer_names = []
         self.feature_layers = []
         self.loaded_output_layers = []
+        # optional shared cache of decoded images, see set_image_cache()
+        self.image_cache = None
+        # optional metrics.MetricsRegistry, see set_metrics()
+        self.metrics = None
 
         self.config = {
             # "network_symbols": "/path/to/prototxt",
@@ -86,7 +90,9 @@ class MxnetFeatureExtractor(object):
             "mirror_trick": 0,
             "normalize_output": False,
             "cpu_only": 0,
-            "gpu_id": 0
+            "gpu_id": 0,
+            # 0 to turn off the prints of layer names and outputs
+            "verbose": 1
         }
 
         if isinstance(config_json, str):
@@ -188,7 +194,8 @@ class MxnetFeatureExtractor(object):
         net.all_layers = net.sym.get_internals()
 
         self.all_layer_names = net.all_layers.list_outputs()
-        print('\n---> all_layer_names:', self.all_layer_names)
+        if self.config['verbose']:
+            print('\n---> all_layer_names:', self.all_layer_names)
         # print('\n---> net.sym[2].get_children():', net.sym[2].get_children())
 
         self.feature_layers = self.get_feature_layers()
@@ -261,11 +268,25 @@ class MxnetFeatureExtractor(object):
         self.feature_layers = layer_names
         self.setup_network()
 
+    def set_image_cache(self, image_cache):
+        """Read images through a shared cache of decoded images, e.g. a
+        DecodedImageCache, anything with get_image(path, flags); None to
+        read them by cv2.imread() again."""
+        self.image_cache = image_cache
+
+    def set_metrics(self, metrics):
+        """Time preprocess, forward and harvest (outputs to numpy) into a
+        MetricsRegistry of metrics.py, anything with observe_stage(stage,
+        seconds); None to turn it off."""
+        self.metrics = metrics
+
     def read_image(self, img_path):
-        if self.config["image_as_grey"]:
-            img = cv2.imread(img_path, 0)
+        flags = 0 if self.config["image_as_grey"] else 1
+
+        if self.image_cache is not None:
+            img = self.image_cache.get_image(img_path, flags)
         else:
-            img = cv2.imread(img_path, 1)
+            img = cv2.imread(img_path, flags)
 
         # cv2.imshow('image',img)
         # cv2.waitKey(0)
@@ -324,6 +345,95 @@ class MxnetFeatureExtractor(object):
         # print 'net_in after transpose: ', net_in
         return net_in
 
+    def preprocess_batch(self, images, out=None):
+        """
+        Vectorized preprocess() for a batch of images with the same shape,
+        e.g. face chips from FaceAlignerCaffe.get_aligned_face_chips_arena().
+
+        Parameters
+        ----------
+        images : (N x H' x W' x K) ndarray, or a list of (H' x W' x K) ndarray
+        out : None or (N x K x H x W) float32 ndarray to write the results into,
+            e.g. a slice of self.input_blob
+
+        Returns
+        -------
+        net_in : (N x K x H x W) float32 ndarray for input to a Net
+        """
+        n_imgs = len(images)
+        in_shape = (3, self.config["input_height"], self.config["input_width"])
+
+        if out is None:
+            out = np.empty((n_imgs,) + in_shape, dtype=np.float32)
+
+        if not n_imgs:
+            return out
+
+        if (images[0].shape[0] != self.config["input_height"] or
+                images[0].shape[1] != self.config["input_width"]):
+            # need to resize, fall back to preprocess() image by image
+            for i, img in enumerate(images):
+                out[i] = self.preprocess(img)
+            return out
+
+        images = np.asarray(images)
+        channel_swap = self.config.get('channel_swap', None)
+        mean = self.mean_arr
+        input_scale = self.config.get('input_scale', None)
+
+        if channel_swap is not None:
+            images = images[..., channel_swap]
+
+        # NHWC -> NCHW, converted to float32 while copying into out
+        np.copyto(out, images.transpose((0, 3, 1, 2)), casting='unsafe')
+
+        if mean is not None:
+            if mean.ndim == 3:
+                out -= mean.transpose((2, 0, 1))
+            else:
+                out -= mean.reshape((1, -1, 1, 1))
+        if input_scale is not None:
+            out *= input_scale
+
+        return out
+
+    def extract_features_for_tensor(self, net_in, layer_names=None):
+        """
+        Extract features for a batch which is already preprocessed,
+        e.g. by preprocess_batch(). net_in can have more than batch_size
+        images, it is run in chunks of batch_size.
+
+        Parameters
+        ----------
+        net_in : (N x K x H x W) float32 ndarray
+
+        Returns
+        -------
+        features_dict : {layer_name: (N x ...) ndarray}
+        """
+        features_dict = {}
+        n_imgs = len(net_in)
+
+        for k in range(0, n_imgs, self.batch_size):
+            n_batch = min(self.batch_size, n_imgs - k)
+
+            t0 = time.time()
+            self.input_blob[:n_batch] = net_in[k:k + n_batch]
+            if self.config['mirror_trick'] > 0:
+                self.input_blob[self.batch_size:self.batch_size + n_batch] = \
+                    self.input_blob[:n_batch, :, :, ::-1]
+            if self.metrics is not None:
+                self.metrics.observe_stage("preprocess", time.time() - t0)
+
+            _ftrs_dict = self.get_features(n_batch, layer_names)
+            for layer, ftrs in _ftrs_dict.items():
+                features_dict.setdefault(layer, []).append(ftrs)
+
+        for layer in features_dict:
+            features_dict[layer] = np.concatenate(features_dict[layer])
+
+        return features_dict
+
     def load_image_to_data_buffer(self, img, load_idx=0):
         # if img.shape != self.image_shape:
         #     raise LoadDataError('image shape must be : ', self.image_shape)
@@ -373,13 +483,32 @@ class MxnetFeatureExtractor(object):
         # print '---> db.data[0]: ', db.data[0][0]
         # print '---> db.data[batch_size]: ', db.data[0][self.batch_size]
 
+        metrics = self.metrics
+        t0 = time.time()
         self.net.model.forward(db, is_train=False)
         # outputs = self.net.model.get_outputs()[0]
         # print('outputs.shape: ', outputs.shape)
         # print('outputs: ', outputs)
         outputs_list = self.net.model.get_outputs()
-        print('len(outputs_list)=', len(outputs_list))
+        if metrics is not None:
+            # forward() is asynchronous, wait for it so that it is not
+            # timed as harvest
+            for outputs in outputs_list:
+                outputs.wait_to_read()
+            t1 = time.time()
+            metrics.observe_stage("forward", t1 - t0)
+        if self.config['verbose']:
+            print('len(outputs_list)=', len(outputs_list))
+
+        features_dict = self._harvest_features(outputs_list, n_imgs)
+        if metrics is not None:
+            metrics.observe_stage("harvest", time.time() - t1)
+
+        return features_dict
 
+    def _harvest_features(self, outputs_list, n_imgs):
+        """Copy the outputs of get_features() into numpy arrays, with the
+        mirror trick and normalization."""
         features_dict = {}
 
         for i, layer in enumerate(self.feature_layers):
@@ -445,10 +574,13 @@ class MxnetFeatureExtractor(object):
 
         load_idx = 0
 
+        t0 = time.time()
         for img in images:
             self.load_image_to_data_buffer(img, load_idx)
 
             load_idx += 1
+        if self.metrics is not None:
+            self.metrics.observe_stage("preprocess", time.time() - t0)
 
         # cnt_predict = 0
         # time_predict = 0.0
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A small staged pipeline runtime: a chain of stages, each with its own
+worker threads and bounded input queue. A full queue blocks the stage
+before it, so backpressure flows upstream to put(); the number of items in
+the whole pipeline is bounded too (max_inflight). Results come out in input
+order (or as they finish, ordered=False).
+
+An exception in a stage function stops the pipeline, and is raised as a
+PipelineError from put() and from the result iteration; functions that
+should skip bad items must catch their own errors.
+
+Per-stage stats show where the time goes: utilization (busy time over
+worker time), time blocked on a full downstream queue, time starved for
+input, and the average fill of the input queue. The stage with the highest
+utilization is the bottleneck.
+
+Usage:
+    pipeline = Pipeline([
+        Stage('decode', decode, n_workers=8, queue_size=64),
+        Stage('infer', infer_batch, n_workers=1, queue_size=128, batch_size=64,
+              max_wait=0.01),
+        Stage('write', write, n_workers=4, queue_size=64)
+    ])
+    pipeline.feed(items)
+    for result in pipeline:
+        ...
+    print(pipeline.format_stats())
+"""
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+# end of input marker, passed from stage to stage
+_END = object()
+
+# seconds between checks for a stopped pipeline while blocked
+_POLL_INTERVAL = 0.1
+
+
+class PipelineError(Exception):
+    """An exception in a stage function, it stopped the pipeline."""
+
+    def __init__(self, stage_name, error, trace=''):
+        Exception.__init__(self, 'stage "{}" failed: {}: {}'.format(
+            stage_name, type(error).__name__, error))
+        self.stage_name = stage_name
+        self.error = error
+        self.trace = trace
+
+
+class Stage(object):
+    """A stage of a Pipeline."""
+
+    def __init__(self, name, func, n_workers=1, queue_size=None, batch_size=1,
+                 max_wait=0.0, batched=None):
+        """A stage of a Pipeline.
+
+            Params:
+                name: stage name in stats and errors
+                func: func(item) -> result, or if batched,
+                        func(items) -> a list of results of the same length
+                n_workers: number of worker threads
+                queue_size: max items in the input queue, default is
+                        2 * n_workers * batch_size
+                batch_size: max items per func() call
+                max_wait: max seconds to wait for a batch to fill, once its
+                        first item arrived
+                batched: whether func takes a list of items, default is
+                        batch_size > 1; set it for a batch func whose
+                        batch_size may be 1
+        """
+        self.name = name
+        self.func = func
+        self.n_workers = max(1, n_workers)
+        self.batch_size = max(1, batch_size)
+        self.batched = self.batch_size > 1 if batched is None else batched
+        self.max_wait = max_wait
+        self.queue_size = queue_size or 2 * self.n_workers * self.batch_size
+
+        self.queue = None
+        self.lock = threading.Lock()
+        self.n_running = 0
+        self.stats = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            "items": 0,
+            "calls": 0,
+            "busy_time": 0.0,
+            "blocked_time": 0.0,
+            "starved_time": 0.0,
+            "queue_fill_sum": 0.0,
+            "queue_samples": 0
+        }
+
+    def _add_stats(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.stats[key] += value
+
+
+class Pipeline(object):
+    """Run items through a chain of stages, see the module docstring."""
+
+    def __init__(self, stages, ordered=True, max_inflight=None):
+        """Run items through a chain of stages.
+
+            Params:
+                stages: a list of Stage
+                ordered: whether results come out in input order
+                max_inflight: max items in the pipeline, put() blocks beyond
+                        it; default is the total capacity of the stages
+        """
+        self.stages = list(stages)
+        self.ordered = ordered
+        if max_inflight is None:
+            max_inflight = sum(stage.queue_size + stage.n_workers * stage.batch_size
+                               for stage in self.stages)
+        self.max_inflight = max_inflight
+
+        self.inflight_cond = threading.Condition()
+        self.n_inflight = 0
+        self.output = queue.Queue()
+        self.stop_event = threading.Event()
+        self.error = None
+        self.error_lock = threading.Lock()
+
+        self.next_seq = 0
+        self.next_output_seq = 0
+        self.reorder = {}
+        self.input_closed = False
+        self.finished = False
+
+        self.threads = []
+        self.feeder = None
+        self.start_time = None
+
+    def start(self):
+        """Start the worker threads, called by put() and feed() if needed."""
+        if self.threads:
+            return
+
+        self.start_time = time.time()
+        for stage in self.stages:
+            stage.queue = queue.Queue(maxsize=stage.queue_size)
+            stage.n_running = stage.n_workers
+            stage.reset_stats()
+
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for k in range(stage.n_workers):
+                thread = threading.Thread(target=self._worker_loop,
+                                          args=(stage, next_stage),
+                                          name='{}-{}'.format(stage.name, k))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _fail(self, stage_name, error, trace=''):
+        with self.error_lock:
+            if self.error is None:
+                self.error = PipelineError(stage_name, error, trace)
+        self.stop_event.set()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+        if self.stop_event.is_set():
+            raise RuntimeError('pipeline is stopped')
+
+    def _put(self, q, entry):
+        """Put into a bounded queue, unless the pipeline is stopped.
+
+        Return:
+            False if stopped
+        """
+        while not self.stop_event.is_set():
+            try:
+                q.put(entry, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q, timeout=None):
+        """Get from a queue, unless the pipeline is stopped or timeout.
+
+        Return:
+            the entry, or None if stopped or timeout
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        while not self.stop_event.is_set():
+            wait = _POLL_INTERVAL
+            if end_time is not None:
+                wait = min(wait, end_time - time.time())
+                if wait <= 0:
+                    return None
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                pass
+        return None
+
+    def _take_batch(self, stage):
+        """Take up to batch_size entries of stage's queue.
+
+        Return:
+            a list of (seq, item), and whether the end marker was taken
+        """
+        t0 = time.time()
+        entry = self._get(stage.queue)
+        t1 = time.time()
+        fill = stage.queue.qsize() / float(stage.queue_size)
+        stage._add_stats(starved_time=t1 - t0, queue_fill_sum=fill, queue_samples=1)
+
+        if entry is None or entry is _END:
+            return [], True
+
+        batch = [entry]
+        if stage.batch_size > 1:
+            end_time = t1 + stage.max_wait
+            while len(batch) < stage.batch_size:
+                try:
+                    entry = stage.queue.get_nowait()
+                except queue.Empty:
+                    wait = end_time - time.time()
+                    if wait <= 0:
+                        break
+                    entry = self._get(stage.queue, wait)
+                    if entry is None:
+                        break
+                if entry is _END:
+                    return batch, True
+                batch.append(entry)
+
+        return batch, False
+
+    def _worker_loop(self, stage, next_stage):
+        out_queue = next_stage.queue if next_stage is not None else self.output
+
+        while True:
+            batch, end = self._take_batch(stage)
+
+            if batch:
+                t0 = time.time()
+                try:
+                    if stage.batched:
+                        results = stage.func([item for _, item in batch])
+                        if len(results) != len(batch):
+                            raise ValueError('{} results of {} items'.format(
+                                len(results), len(batch)))
+                    else:
+                        results = [stage.func(batch[0][1])]
+                except Exception as err:
+                    self._fail(stage.name, err, traceback.format_exc())
+                    return
+                t1 = time.time()
+
+                for (seq, _), result in zip(batch, results):
+                    if not self._put(out_queue, (seq, result)):
+                        return
+                stage._add_stats(items=len(batch), calls=1, busy_time=t1 - t0,
+                                 blocked_time=time.time() - t1)
+
+            if end:
+                break
+
+        if self.stop_event.is_set():
+            return
+
+        # the last worker of a stage passes the end on
+        with stage.lock:
+            stage.n_running -= 1
+            last = stage.n_running == 0
+        if last:
+            n_markers = next_stage.n_workers if next_stage is not None else 1
+            for _ in range(n_markers):
+                if not self._put(out_queue, _END):
+                    return
+
+    def put(self, item, timeout=None):
+        """Put an item into the pipeline, blocks while it is full: results
+        must be taken on another thread meanwhile, or use feed().
+
+        Raise:
+            PipelineError if a stage failed
+        """
+        if self.input_closed:
+            raise RuntimeError('pipeline input is closed')
+        self.start()
+
+        end_time = None if timeout is None else time.time() + timeout
+        with self.inflight_cond:
+            while self.n_inflight >= self.max_inflight:
+                self._check_error()
+                wait = _POLL_INTERVAL
+                if end_time is not None:
+                    wait = min(wait, end_time - time.time())
+                    if wait <= 0:
+                        raise RuntimeError('timeout putting into the pipeline')
+                self.inflight_cond.wait(wait)
+            self.n_inflight += 1
+
+        seq = self.next_seq
+        self.next_seq += 1
+        if not self._put(self.stages[0].queue, (seq, item)):
+            self._check_error()
+
+    def _release_inflight(self):
+        with self.inflight_cond:
+            self.n_inflight -= 1
+            self.inflight_cond.notify()
+
+    def close_input(self):
+        """No more items, the pipeline finishes once they are through."""
+        if self.input_closed:
+            return
+        self.start()
+        self.input_closed = True
+        for _ in range(self.stages[0].n_workers):
+            if not self._put(self.stages[0].queue, _END):
+                break
+
+    def feed(self, items):
+        """Put the items of an iterable on a feeder thread, then close the
+        input; errors of the iterable stop the pipeline."""
+        self.start()
+
+        def feed_loop():
+            try:
+                for item in items:
+                    if self.stop_event.is_set():
+                        return
+                    self.put(item)
+                self.close_input()
+            except PipelineError:
+                pass
+            except Exception as err:
+                self._fail('feed', err, traceback.format_exc())
+
+        self.feeder = threading.Thread(target=feed_loop, name='pipeline-feed')
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def get(self, timeout=None):
+        """Get the next result.
+
+        Return:
+            the result
+        Raise:
+            StopIteration when all results are out, PipelineError if a
+            stage failed, RuntimeError on timeout
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        while True:
+            if self.ordered and self.next_output_seq in self.reorder:
+                result = self.reorder.pop(self.next_output_seq)
+                self.next_output_seq += 1
+                self._release_inflight()
+                return result
+            if self.finished:
+                self._check_error()
+                raise StopIteration()
+
+            wait = None
+            if end_time is not None:
+                wait = end_time - time.time()
+                if wait <= 0:
+                    raise RuntimeError('timeout waiting for pipeline results')
+            entry = self._get(self.output, wait)
+            if entry is None:
+                if self.stop_event.is_set():
+                    self._check_error()
+                continue
+
+            if entry is _END:
+                self.finished = True
+                continue
+
+            seq, result = entry
+            if not self.ordered:
+                self._release_inflight()
+                return result
+            self.reorder[seq] = result
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+    def stop(self):
+        """Stop the workers without finishing the items in flight."""
+        self.stop_event.set()
+        self.join()
+
+    def join(self):
+        """Wait for the worker threads to exit."""
+        for thread in self.threads:
+            thread.join()
+        if self.feeder is not None:
+            self.feeder.join()
+
+    def get_stats(self):
+        """Get the stats of each stage, a list of dicts in stage order, see
+        the module docstring."""
+        elapsed = max(time.time() - (self.start_time or time.time()), 1e-9)
+        stats_list = []
+        for stage in self.stages:
+            with stage.lock:
+                stats = dict(stage.stats)
+            worker_time = elapsed * stage.n_workers
+            stats_list.append({
+                "name": stage.name,
+                "workers": stage.n_workers,
+                "items": stats["items"],
+                "items_per_sec": stats["items"] / elapsed,
+                "avg_batch_size": stats["items"] / float(max(stats["calls"], 1)),
+                "utilization": stats["busy_time"] / worker_time,
+                "blocked": stats["blocked_time"] / worker_time,
+                "starved": stats["starved_time"] / worker_time,
+                "queue_fill": stats["queue_fill_sum"] / max(stats["queue_samples"], 1)
+            })
+        return stats_list
+
+    def get_bottleneck(self):
+        """Get the name of the stage with the highest utilization."""
+        stats_list = self.get_stats()
+        if not stats_list:
+            return None
+        return max(stats_list, key=lambda stats: stats["utilization"])["name"]
+
+    def format_stats(self):
+        """Format the stage stats as a table."""
+        lines = ['{:<12}{:>8}{:>10}{:>10}{:>8}{:>8}{:>8}{:>8}'.format(
+            'stage', 'workers', 'items/s', 'batch', 'util', 'blocked', 'starved',
+            'queue')]
+        for stats in self.get_stats():
+            lines.append('{:<12}{:>8}{:>10.1f}{:>10.1f}{:>8.0%}{:>8.0%}{:>8.0%}{:>8.0%}'.format(
+                stats["name"], stats["workers"], stats["items_per_sec"],
+                stats["avg_batch_size"], stats["utilization"], stats["blocked"],
+                stats["starved"], stats["queue_fill"]))
+        lines.append('bottleneck: {}'.format(self.get_bottleneck()))
+        return '\n'.join(lines)
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Multi-node batch face alignment without a central scheduler: workers on any
+node share a work dir (e.g. on NFS), and claim chunks of the manifest through
+lease files in it.
+
+    1. the manifest is split once into --n-chunks chunk manifests, each line
+       goes to the chunk given by a hash of its uri
+    2. every worker claims unfinished chunks by creating lease files, renews
+       its leases while it works, and aligns each chunk by BatchAligner; a
+       lease not renewed within --lease-timeout (dead worker) is re-claimed
+       by another worker, which resumes the chunk from its checkpoint
+    3. when all chunks are done, one worker merges the per-chunk results into
+       <work-dir>/results.jsonl
+
+Run the same command on every node (clocks of the nodes must be roughly in
+sync, well within --lease-timeout), or use --local-workers to run several
+worker processes on one node:
+
+    python shard_align.py --manifest test_imgs_weidong/test_data.json \\
+        --config face_aligner_config.json --work-dir /nfs/align_job \\
+        --n-chunks 64 --local-workers 2
+
+Layout of the work dir:
+    chunks/chunk-<id>.jsonl: chunk manifests, entries have the original
+            manifest line in "line"
+    leases/<name>.lease: lease files
+    done/chunk-<id>.done: done markers, with the chunk's stats
+    output/chunk-<id>/: BatchAligner outputs of each chunk
+    results.jsonl: merged results, "line" is the original manifest line and
+            "chip" is relative to the work dir
+"""
+import argparse
+import errno
+import json
+import os
+import os.path as osp
+import shutil
+import socket
+import threading
+import time
+import uuid
+import zlib
+from multiprocessing import Process
+
+from manifest_io import iter_manifest, iter_manifest_jsonl, ResultWriter
+from batch_align import BatchAligner, add_batch_args, get_batch_kwargs
+
+
+def get_chunk_id(uri, n_chunks):
+    """Get the chunk of a manifest line by a (stable) hash of its uri."""
+    if not isinstance(uri, bytes):
+        uri = str(uri).encode('utf-8')
+    return (zlib.crc32(uri) & 0xffffffff) % n_chunks
+
+
+def get_chunk_name(chunk_id):
+    return 'chunk-{:05d}'.format(chunk_id)
+
+
+class FileLease(object):
+    """A lease on a shared filesystem: a file holding its owner and expiry
+    time, created exclusively, renewed by its owner and re-claimable by
+    others after it expires.
+    """
+
+    def __init__(self, path, owner, timeout=300.0):
+        """A lease file.
+
+            Params:
+                path: lease file
+                owner: unique id of this worker
+                timeout: seconds a lease is valid without renewal
+        """
+        self.path = path
+        self.owner = owner
+        self.timeout = timeout
+
+    def _read(self, path=None):
+        try:
+            with open(path or self.path, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            # missing, or being replaced
+            return None
+
+    def _make_content(self):
+        return json.dumps({
+            "owner": self.owner,
+            "expires": time.time() + self.timeout
+        })
+
+    def _is_old(self, path):
+        """Whether path was last written more than timeout ago."""
+        try:
+            return osp.getmtime(path) < time.time() - self.timeout
+        except OSError:
+            return False
+
+    def _create(self):
+        """Create the lease file, complete or not at all: the content is
+        written to a temp file which is then linked to the lease path."""
+        tmp_path = '{}.tmp.{}'.format(self.path, self.owner)
+        with open(tmp_path, 'w') as fp:
+            fp.write(self._make_content())
+        try:
+            os.link(tmp_path, self.path)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    def _move_away(self, kind):
+        """Rename the lease file away, only one worker can win the rename,
+        so the lease cannot change while it is checked.
+
+        Return:
+            the path it was moved to (None if the lease file is gone), and
+            its content (None if unreadable)
+        """
+        away_path = '{}.{}.{}'.format(self.path, kind, self.owner)
+        try:
+            os.rename(self.path, away_path)
+        except OSError:
+            return None, None
+        return away_path, self._read(away_path)
+
+    def _put_back(self, away_path):
+        """Put a lease moved away by _move_away() back, unless another one
+        was created since (link fails on EEXIST)."""
+        try:
+            os.link(away_path, self.path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        os.remove(away_path)
+
+    def try_acquire(self):
+        """Acquire the lease if it is free or expired. An unreadable lease
+        file (e.g. of a legacy worker which died while writing it) is
+        expired once it is older than timeout.
+
+        Return:
+            True if this worker holds the lease now
+        """
+        if self._create():
+            return True
+
+        info = self._read()
+        if info is None:
+            if not self._is_old(self.path):
+                return False
+        elif info["expires"] > time.time():
+            return info["owner"] == self.owner
+
+        # expired: move it away and check it again
+        stale_path, stale_info = self._move_away('stale')
+        if stale_path is None:
+            return False
+
+        if stale_info is None:
+            expired = self._is_old(stale_path)
+        else:
+            expired = stale_info["expires"] <= time.time()
+        if not expired:
+            # renewed or re-created in the meantime
+            self._put_back(stale_path)
+            return False
+        os.remove(stale_path)
+
+        return self._create()
+
+    def renew(self):
+        """Extend the lease: move it away, check it is still ours and create
+        it again, so a lease re-claimed by another worker is never
+        overwritten.
+
+        Return:
+            False if the lease was lost (expired and claimed by another worker)
+        """
+        away_path, info = self._move_away('renew')
+        if away_path is None:
+            return False
+
+        if info is None or info["owner"] != self.owner:
+            self._put_back(away_path)
+            return False
+        os.remove(away_path)
+
+        # fails if another worker claimed it while it was moved away
+        return self._create()
+
+    def release(self):
+        away_path, info = self._move_away('release')
+        if away_path is None:
+            return
+
+        if info is None or info["owner"] != self.owner:
+            self._put_back(away_path)
+            return
+        os.remove(away_path)
+
+
+class LeaseKeeper(object):
+    """Renew a lease on a background thread, and call on_lost() if it is lost."""
+
+    def __init__(self, lease, on_lost=None):
+        self.lease = lease
+        self.on_lost = on_lost
+        self.lost = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name='LeaseKeeper')
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _loop(self):
+        interval = self.lease.timeout / 3.0
+        while not self.stop_event.wait(interval):
+            if self.lost or not self.lease.renew():
+                self.lost = True
+                if self.on_lost is not None:
+                    self.on_lost()
+
+
+def split_manifest(manifest, chunks_dir, n_chunks):
+    """Split a manifest into n_chunks JSONL chunk manifests by the hash of
+    their uris, streaming it. The original line of each entry is added as
+    "line". chunks_dir is created atomically, when all chunks are written.
+    """
+    tmp_dir = '{}.tmp.{}'.format(chunks_dir, os.getpid())
+    if osp.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    writers = [ResultWriter(osp.join(tmp_dir, get_chunk_name(i) + '.jsonl'))
+               for i in range(n_chunks)]
+    try:
+        for line_idx, entry in iter_manifest(manifest):
+            entry["line"] = line_idx
+            writers[get_chunk_id(entry.get('uri'), n_chunks)].write(entry)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    os.rename(tmp_dir, chunks_dir)
+
+
+class ShardWorker(object):
+    """One worker of a sharded job, see the module docstring."""
+
+    def __init__(self, work_dir, manifest, n_chunks, lease_timeout=300.0,
+                 poll_interval=5.0, worker_id=None):
+        self.work_dir = work_dir
+        self.manifest = manifest
+        self.n_chunks = n_chunks
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or '{}-{}-{}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self.chunks_dir = osp.join(work_dir, 'chunks')
+        self.leases_dir = osp.join(work_dir, 'leases')
+        self.done_dir = osp.join(work_dir, 'done')
+        self.output_dir = osp.join(work_dir, 'output')
+        self.results_path = osp.join(work_dir, 'results.jsonl')
+
+        for path in (work_dir, self.leases_dir, self.done_dir, self.output_dir):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by another worker
+                pass
+
+    def _get_lease(self, name):
+        return FileLease(osp.join(self.leases_dir, name + '.lease'),
+                         self.worker_id, self.lease_timeout)
+
+    def _get_done_path(self, chunk_id):
+        return osp.join(self.done_dir, get_chunk_name(chunk_id) + '.done')
+
+    def _run_once(self, name, func, is_done):
+        """Run func() on exactly one worker, under a lease named name, and
+        wait until is_done() on the others."""
+        while not is_done():
+            lease = self._get_lease(name)
+            if lease.try_acquire():
+                try:
+                    with LeaseKeeper(lease):
+                        if not is_done():
+                            func()
+                finally:
+                    lease.release()
+            else:
+                time.sleep(self.poll_interval)
+
+    def _get_pending_chunks(self):
+        return [i for i in range(self.n_chunks)
+                if not osp.isfile(self._get_done_path(i))]
+
+    def run(self, batch_aligner):
+        """Split the manifest (once), align chunks until all are done, and
+        merge the results (once).
+
+        Params:
+            batch_aligner: a BatchAligner, its output dir is set per chunk
+        """
+        self._run_once(
+            'split', lambda: split_manifest(self.manifest, self.chunks_dir, self.n_chunks),
+            lambda: osp.isdir(self.chunks_dir))
+
+        # start at a worker-specific chunk, to spread the first claims
+        start = zlib.crc32(self.worker_id.encode('utf-8')) & 0xffffffff
+
+        while True:
+            pending = self._get_pending_chunks()
+            if not pending:
+                break
+
+            n_processed = 0
+            for k in range(len(pending)):
+                chunk_id = pending[(start + k) % len(pending)]
+                if self._process_chunk(batch_aligner, chunk_id):
+                    n_processed += 1
+
+            if not n_processed:
+                # the rest are leased by other live workers
+                time.sleep(self.poll_interval)
+
+        self._run_once('merge', self.merge, lambda: osp.isfile(self.results_path))
+
+    def _process_chunk(self, batch_aligner, chunk_id):
+        """Claim and align one chunk, return True if it got done."""
+        name = get_chunk_name(chunk_id)
+        done_path = self._get_done_path(chunk_id)
+
+        lease = self._get_lease(name)
+        if not lease.try_acquire():
+            return False
+
+        try:
+            # stop writing at once, the chunk is another worker's now
+            with LeaseKeeper(lease, on_lost=batch_aligner.abort) as keeper:
+                # done by another worker between listing and claiming
+                if osp.isfile(done_path):
+                    return False
+
+                print('[shard_align] {} processing {}'.format(self.worker_id, name))
+                batch_aligner.set_output_dir(osp.join(self.output_dir, name))
+                # resumes from the checkpoint of a dead worker, if any
+                state = batch_aligner.run(
+                    osp.join(self.chunks_dir, name + '.jsonl'), resume=True)
+
+                if not state["done"] or keeper.lost:
+                    return False
+
+                tmp_path = '{}.tmp.{}'.format(done_path, self.worker_id)
+                with open(tmp_path, 'w') as fp:
+                    json.dump(dict(state, worker=self.worker_id), fp)
+                os.rename(tmp_path, done_path)
+                return True
+        finally:
+            lease.release()
+
+    def merge(self):
+        """Merge the per-chunk results into results.jsonl, with original
+        manifest lines and chip paths relative to the work dir."""
+        tmp_path = '{}.tmp.{}'.format(self.results_path, self.worker_id)
+
+        with ResultWriter(tmp_path) as writer:
+            for chunk_id in range(self.n_chunks):
+                name = get_chunk_name(chunk_id)
+                lines = [entry["line"] for _, entry in iter_manifest_jsonl(
+                    osp.join(self.chunks_dir, name + '.jsonl'))]
+
+                chunk_results = osp.join(self.output_dir, name, 'results.jsonl')
+                if not osp.isfile(chunk_results):
+                    continue
+
+                for _, record in iter_manifest_jsonl(chunk_results):
+                    record["line"] = lines[record["line"]]
+                    if "chip" in record:
+                        record["chip"] = osp.join('output', name, record["chip"])
+                    writer.write(record)
+
+        os.rename(tmp_path, self.results_path)
+
+
+def run_worker(args, worker_id=None, local_idx=0):
+    with open(args.config, 'r') as fp:
+        config_json = json.load(fp)
+
+    worker = ShardWorker(args.work_dir, args.manifest, args.n_chunks,
+                         args.lease_timeout, args.poll_interval, worker_id)
+    batch_kwargs = get_batch_kwargs(args)
+    if batch_kwargs["metrics_port"]:
+        # one port per local worker
+        batch_kwargs["metrics_port"] += local_idx
+    batch_aligner = BatchAligner(config_json, worker.output_dir, **batch_kwargs)
+    try:
+        worker.run(batch_aligner)
+    finally:
+        batch_aligner.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Align all faces of a detection manifest on many nodes')
+    parser.add_argument('--manifest', required=True,
+                        help='detection manifest, .json (as test_data.json) or .jsonl')
+    parser.add_argument('--config', default='face_aligner_config.json',
+                        help='config of FaceAlignerCaffe')
+    parser.add_argument('--work-dir', required=True,
+                        help='work dir shared by all workers')
+    parser.add_argument('--n-chunks', type=int, default=64,
+                        help='number of chunks, the same for all workers')
+    parser.add_argument('--lease-timeout', type=float, default=300.0,
+                        help='seconds until a lease of a dead worker expires')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='seconds between polls for claimable chunks')
+    parser.add_argument('--local-workers', type=int, default=1,
+                        help='number of worker processes on this node')
+    add_batch_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.local_workers <= 1:
+        run_worker(args)
+        return
+
+    procs = [Process(target=run_worker, args=(args, None, k))
+             for k in range(args.local_workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+if __name__ == '__main__':
+    main()
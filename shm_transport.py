@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared-memory transport between producer processes (decoders, detectors)
+and an alignment server on the same host. Frames are not serialized:
+
+    - for each producer (ShmAlignClient), the server creates a frame ring
+      and a response ring, fixed-size slots in files under /dev/shm mapped
+      by both sides; the files are unlinked as soon as both mapped them
+    - the producer writes a frame into a free slot of its frame ring and
+      sends only (seq, slot, shape, dtype, detections) over a unix socket
+    - the server (ShmAlignServer) reads the frame as a numpy view of the
+      slot (no copy), aligns its faces, writes the landmarks into the same
+      slot of the response ring and sends back (seq, slot, n_faces)
+
+A slot is reused by the producer only after its response arrived; every
+slot carries the seq of its frame, so a stale or reused slot is detected by
+the server. A producer that crashes drops its socket, then the server
+releases its rings; a server that goes away fails the pending calls of its
+producers.
+
+The socket is created with mode 0600 and connections are authenticated by
+a key, by default a random one the server writes into <address>.key (mode
+0600) and producers read from there; producers must run as the same user
+as the server.
+
+To avoid even the copy into the slot, render or decode the frame into the
+view from acquire_frame() directly, e.g. with np.copyto() or cv2 functions
+taking dst=.
+
+Server (see also align_service.py --shm-address):
+    service = AlignService(config_json)
+    server = ShmAlignServer(service, '/tmp/align.sock')
+    server.serve_forever()
+
+Producer:
+    client = ShmAlignClient('/tmp/align.sock', n_slots=4, max_frame_bytes=3840 * 2160 * 3)
+    faces_pts, face_scores = client.align(img, detections)
+"""
+import mmap
+import multiprocessing
+import os
+import os.path as osp
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Client, Listener
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+SLOT_ALIGN = 64
+# slot header: seq of the frame, nbytes of the frame / n_faces of the response
+SLOT_HEADER_FORMAT = '<Qq'
+SLOT_HEADER_SIZE = SLOT_ALIGN
+
+# per face of a response: 5 landmarks in the image, face score
+RESPONSE_FACE_SIZE = 11
+
+
+def get_default_shm_dir():
+    if osp.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def get_authkey_path(address):
+    """Get the path of the key file of a ShmAlignServer listening on address."""
+    return address + '.key'
+
+
+def read_authkey(address):
+    """Read the key written by the ShmAlignServer listening on address."""
+    with open(get_authkey_path(address), 'rb') as fp:
+        return fp.read()
+
+
+def write_authkey(address, authkey):
+    """Write authkey into the key file of address, readable by this user only."""
+    path = get_authkey_path(address)
+    if osp.exists(path):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(authkey)
+
+
+class ShmRing(object):
+    """n_slots fixed-size slots in a shared memory mapped file, each with a
+    small header (seq, size)."""
+
+    def __init__(self, path, n_slots, slot_bytes, create=False):
+        """n_slots fixed-size slots in a shared memory mapped file.
+
+            Params:
+                path: path of the file, best under /dev/shm
+                n_slots: number of slots
+                slot_bytes: max payload bytes per slot
+                create: whether to create the file (it must not exist), or
+                        to open an existing one
+        """
+        self.path = path
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        self.stride = SLOT_HEADER_SIZE + (slot_bytes + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+        size = self.stride * n_slots
+
+        if create:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.ftruncate(fd, size)
+            except OSError:
+                os.close(fd)
+                os.unlink(path)
+                raise
+        else:
+            fd = os.open(path, os.O_RDWR)
+            if os.fstat(fd).st_size < size:
+                os.close(fd)
+                raise ValueError('{} is smaller than {} bytes'.format(path, size))
+
+        try:
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def set_header(self, slot, seq, size):
+        struct.pack_into(SLOT_HEADER_FORMAT, self.mm, slot * self.stride, seq, size)
+
+    def get_header(self, slot):
+        """Return: seq, size"""
+        return struct.unpack_from(SLOT_HEADER_FORMAT, self.mm, slot * self.stride)
+
+    def get_array(self, slot, shape, dtype):
+        """Get a numpy view of the payload of a slot, no copy."""
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count * dtype.itemsize > self.slot_bytes:
+            raise ValueError('{} x {} does not fit into a slot of {} bytes'.format(
+                shape, dtype, self.slot_bytes))
+
+        offset = slot * self.stride + SLOT_HEADER_SIZE
+        return np.frombuffer(self.mm, dtype, count, offset).reshape(shape)
+
+    def close(self):
+        if self.mm is None:
+            return
+        try:
+            self.mm.close()
+        except BufferError:
+            # numpy views are still alive, the mapping goes with them
+            pass
+        self.mm = None
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class ShmFrame(object):
+    """A frame slot acquired by ShmAlignClient.acquire_frame()."""
+
+    def __init__(self, slot, array):
+        self.slot = slot
+        self.array = array
+
+
+class ShmAlignClient(object):
+    """Producer side of the transport, see the module docstring. Not
+    thread-safe: one client per producer thread.
+    """
+
+    def __init__(self, address, n_slots=4, max_frame_bytes=3840 * 2160 * 3,
+                 max_faces=64, timeout=10.0, authkey=None):
+        """Producer side of the transport.
+
+            Params:
+                address: unix socket path of the ShmAlignServer
+                n_slots: number of frames in flight
+                max_frame_bytes: max bytes of a frame
+                max_faces: max faces per frame whose landmarks fit into the
+                        response ring, more are sent inline over the socket
+                timeout: default seconds to wait for the server
+                authkey: key of the server, default is read from its key file
+        """
+        if authkey is None:
+            authkey = read_authkey(address)
+        self.timeout = timeout
+        self.max_faces = max_faces
+
+        self.frames = None
+        self.responses = None
+        self.conn = None
+        try:
+            self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+            self.conn.send(('hello', {
+                "n_slots": n_slots,
+                "max_frame_bytes": max_frame_bytes,
+                "max_faces": max_faces
+            }))
+            if not self.conn.poll(timeout):
+                raise RuntimeError('timeout waiting for the server')
+            msg = self.conn.recv()
+            if msg[0] != 'ready':
+                raise RuntimeError('server refused: {}'.format(msg[1:]))
+
+            # rings created by the server, unlinked by it once mapped here
+            self.frames = ShmRing(msg[1]["frames"], n_slots, max_frame_bytes)
+            self.responses = ShmRing(msg[1]["responses"], n_slots,
+                                     max_faces * RESPONSE_FACE_SIZE * 4)
+            self.conn.send(('mapped',))
+        except Exception:
+            self.close()
+            raise
+
+        self.free_slots = deque(range(n_slots))
+        self.inflight = {}  # seq -> slot
+        self.results = {}  # seq -> (faces_pts, face_scores) or an error
+        self.abandoned = set()
+        self.next_seq = 1
+
+        self.stats = {
+            "frames": 0,
+            "send_time": 0.0,
+            "copy_time": 0.0,
+            "timeouts": 0,
+            "errors": 0
+        }
+
+    def _receive(self, timeout):
+        """Receive one message from the server.
+
+        Return:
+            False on timeout
+        """
+        if not self.conn.poll(timeout):
+            return False
+        try:
+            msg = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            raise RuntimeError('connection to the server is lost')
+
+        kind, seq, slot = msg[:3]
+        if kind == 'result':
+            n_faces, inline = msg[3:5]
+            if inline is not None:
+                faces_pts, face_scores = inline
+            else:
+                data = np.array(self.responses.get_array(
+                    slot, (n_faces, RESPONSE_FACE_SIZE), np.float32))
+                faces_pts = [pts.reshape(5, 2) for pts in data[:, :10]]
+                face_scores = data[:, 10]
+            result = (faces_pts, face_scores)
+        else:
+            self.stats["errors"] += 1
+            result = RuntimeError(msg[3])
+
+        # the slot is free again once its response is read
+        if self.inflight.pop(seq, None) is not None:
+            self.free_slots.append(slot)
+        if seq in self.abandoned:
+            self.abandoned.discard(seq)
+        else:
+            self.results[seq] = result
+        return True
+
+    def _wait(self, done, timeout):
+        """Receive messages until done() or timeout.
+
+        Return:
+            done()
+        """
+        if timeout is None:
+            timeout = self.timeout
+        end_time = time.time() + timeout
+        while not done():
+            wait_left = end_time - time.time()
+            if wait_left <= 0 or not self._receive(wait_left):
+                return done()
+        return True
+
+    def acquire_frame(self, shape, dtype=np.uint8, timeout=None):
+        """Acquire a free frame slot, waiting for results to free one.
+
+        Return:
+            a ShmFrame, fill frame.array and submit_frame() it
+        """
+        if not self._wait(lambda: len(self.free_slots) > 0, timeout):
+            raise RuntimeError('timeout waiting for a free frame slot')
+        slot = self.free_slots.popleft()
+        try:
+            return ShmFrame(slot, self.frames.get_array(slot, shape, dtype))
+        except ValueError:
+            self.free_slots.appendleft(slot)
+            raise
+
+    def submit_frame(self, frame, detections):
+        """Send a frame acquired by acquire_frame() to the server.
+
+        Params:
+            frame: ShmFrame
+            detections: detections of the frame in the manifest schema
+        Return:
+            a ticket of get_result()
+        """
+        t0 = time.time()
+        seq = self.next_seq
+        self.next_seq += 1
+
+        array = frame.array
+        self.frames.set_header(frame.slot, seq, array.nbytes)
+        self.inflight[seq] = frame.slot
+        self.conn.send(('frame', seq, frame.slot, array.shape, array.dtype.str, detections))
+        frame.array = None
+
+        self.stats["frames"] += 1
+        self.stats["send_time"] += time.time() - t0
+        return seq
+
+    def submit(self, img, detections, timeout=None):
+        """Copy img into a frame slot and send it, see submit_frame()."""
+        frame = self.acquire_frame(img.shape, img.dtype, timeout)
+        t0 = time.time()
+        np.copyto(frame.array, img)
+        self.stats["copy_time"] += time.time() - t0
+        return self.submit_frame(frame, detections)
+
+    def get_result(self, ticket, timeout=None):
+        """Wait for the result of a submitted frame.
+
+        Return:
+            faces_pts: a list of 5x2 landmarks in the frame
+            face_scores: numpy array, NaN if not available
+        """
+        if not self._wait(lambda: ticket in self.results, timeout):
+            # its slot stays in flight until the late response arrives
+            self.abandoned.add(ticket)
+            self.stats["timeouts"] += 1
+            raise RuntimeError('timeout waiting for the result of frame {}'.format(ticket))
+
+        result = self.results.pop(ticket)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def align(self, img, detections, timeout=None):
+        """Align the faces of a frame, see submit() and get_result()."""
+        return self.get_result(self.submit(img, detections, timeout), timeout)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        n_frames = max(stats["frames"], 1)
+        stats["avg_send_us"] = stats["send_time"] / n_frames * 1e6
+        stats["avg_copy_us"] = stats["copy_time"] / n_frames * 1e6
+        stats["frames_in_flight"] = len(self.inflight)
+        return stats
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.send(('bye',))
+            except (IOError, OSError):
+                pass
+            self.conn.close()
+            self.conn = None
+
+        for ring in (self.frames, self.responses):
+            if ring is not None:
+                ring.close()
+
+
+class ShmSession(object):
+    """Server side state of one connected producer, owns its rings."""
+
+    def __init__(self, conn, hello, prefix):
+        """Server side state of one connected producer.
+
+            Params:
+                conn: connection of the producer
+                hello: ring sizes requested by the producer
+                prefix: path prefix of the ring files, created here
+        """
+        for key in ("n_slots", "max_frame_bytes", "max_faces"):
+            if not isinstance(hello.get(key), int) or hello[key] <= 0:
+                raise ValueError('{} must be a positive int'.format(key))
+
+        self.conn = conn
+        self.max_faces = hello["max_faces"]
+        self.frames = ShmRing(prefix + '-frames', hello["n_slots"],
+                              hello["max_frame_bytes"], create=True)
+        try:
+            self.responses = ShmRing(prefix + '-responses', hello["n_slots"],
+                                     self.max_faces * RESPONSE_FACE_SIZE * 4,
+                                     create=True)
+        except Exception:
+            self.frames.close()
+            self.frames.unlink()
+            raise
+
+        self.lock = threading.Lock()
+        self.n_tasks = 0
+        self.closed = False
+
+    def send(self, msg):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.conn.send(msg)
+            except (IOError, OSError):
+                # the producer is gone, the receive loop cleans up
+                pass
+
+    def begin_task(self):
+        with self.lock:
+            self.n_tasks += 1
+
+    def end_task(self):
+        with self.lock:
+            self.n_tasks -= 1
+            release = self.closed and self.n_tasks == 0
+        if release:
+            self._release()
+
+    def get_ring_paths(self):
+        return {"frames": self.frames.path, "responses": self.responses.path}
+
+    def unlink(self):
+        """Unlink the ring files, the mappings stay valid."""
+        self.frames.unlink()
+        self.responses.unlink()
+
+    def close(self):
+        """Called when the producer disconnects, the rings are released
+        once the frames being aligned are done."""
+        with self.lock:
+            self.closed = True
+            release = self.n_tasks == 0
+        self.conn.close()
+        # in case the producer never mapped them
+        self.unlink()
+        if release:
+            self._release()
+
+    def _release(self):
+        self.frames.close()
+        self.responses.close()
+
+
+class ShmAlignServer(object):
+    """Alignment server side of the transport, see the module docstring."""
+
+    def __init__(self, service, address, n_threads=16, shm_dir=None, authkey=None):
+        """Alignment server side of the transport.
+
+            Params:
+                service: an align_service.AlignService
+                address: unix socket path to listen on
+                n_threads: max frames aligned concurrently, their faces are
+                        batched together by the service
+                shm_dir: dir of the ring files, default is /dev/shm
+                authkey: key producers must know, default is a random one
+                        written into get_authkey_path(address)
+        """
+        self.service = service
+        self.address = address
+        self.shm_dir = shm_dir or get_default_shm_dir()
+        self.key_path = None
+        if authkey is None:
+            authkey = os.urandom(32)
+            write_authkey(address, authkey)
+            self.key_path = get_authkey_path(address)
+        self.authkey = authkey
+
+        if osp.exists(address):
+            os.unlink(address)
+        # the socket is created with mode 0600
+        umask = os.umask(0o177)
+        try:
+            self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        finally:
+            os.umask(umask)
+        os.chmod(address, 0o600)
+        self.pool = ThreadPool(n_threads)
+        self.stopped = False
+        self.next_session_id = 0
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "connections": 0,
+            "disconnects": 0,
+            "frames": 0,
+            "stale_frames": 0,
+            "errors": 0
+        }
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def serve_forever(self):
+        while not self.stopped:
+            try:
+                conn = self.listener.accept()
+            except (IOError, OSError, EOFError, multiprocessing.AuthenticationError):
+                if self.stopped:
+                    return
+                continue
+            if self.stopped:
+                conn.close()
+                return
+
+            thread = threading.Thread(target=self._serve_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """serve_forever() on a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name='ShmAlignServer')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _new_ring_prefix(self):
+        with self.lock:
+            session_id = self.next_session_id
+            self.next_session_id += 1
+        return osp.join(self.shm_dir, 'align-{}-{}'.format(os.getpid(), session_id))
+
+    def _serve_connection(self, conn):
+        session = None
+        try:
+            if not conn.poll(10.0):
+                raise RuntimeError('no hello from the producer')
+            msg = conn.recv()
+            if msg[0] != 'hello':
+                raise RuntimeError('expected hello, got {}'.format(msg[0]))
+            session = ShmSession(conn, msg[1], self._new_ring_prefix())
+
+            conn.send(('ready', session.get_ring_paths()))
+            if not conn.poll(10.0) or conn.recv()[0] != 'mapped':
+                raise RuntimeError('the producer did not map its rings')
+            # mapped by both sides, nothing is left behind if either crashes
+            session.unlink()
+        except Exception as err:
+            try:
+                conn.send(('refused', '{}: {}'.format(type(err).__name__, err)))
+            except (IOError, OSError):
+                pass
+            if session is not None:
+                session.close()
+            else:
+                conn.close()
+            return
+
+        self._count("connections")
+
+        clean_exit = False
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+
+            if msg[0] == 'frame':
+                session.begin_task()
+                self.pool.apply_async(self._process_frame, (session, msg))
+            elif msg[0] == 'bye':
+                clean_exit = True
+                break
+
+        if not clean_exit:
+            self._count("disconnects")
+        session.close()
+
+    def _process_frame(self, session, msg):
+        _, seq, slot, shape, dtype, detections = msg
+        trace = self.service.start_trace('shm_frame', seq=seq)
+        try:
+            if session.closed:
+                return
+            if session.frames.get_header(slot)[0] != seq:
+                raise RuntimeError('slot {} does not hold frame {}'.format(slot, seq))
+
+            img = session.frames.get_array(slot, shape, dtype)
+            faces_pts, face_scores, _, timing = self.service.align_image(
+                img, detections, trace=trace)
+            del img
+
+            if session.frames.get_header(slot)[0] != seq:
+                # reused by the producer in the meantime, results are invalid
+                self._count("stale_frames")
+                raise RuntimeError('slot {} was reused during frame {}'.format(slot, seq))
+
+            n_faces = len(faces_pts)
+            inline = None
+            if n_faces > session.max_faces:
+                inline = (faces_pts, face_scores)
+            elif n_faces:
+                data = session.responses.get_array(slot, (n_faces, RESPONSE_FACE_SIZE),
+                                                   np.float32)
+                data[:, :10] = np.reshape(faces_pts, (n_faces, 10))
+                data[:, 10] = face_scores
+                del data
+            session.responses.set_header(slot, seq, n_faces)
+
+            self._count("frames")
+            session.send(('result', seq, slot, n_faces, inline, timing))
+        except Exception as err:
+            self._count("errors")
+            session.send(('error', seq, slot, '{}: {}'.format(type(err).__name__, err)))
+        finally:
+            session.end_task()
+            if trace is not None:
+                trace.finish()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        self.stopped = True
+        try:
+            # wake up accept()
+            Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+        except (IOError, OSError, EOFError, multiprocessing.AuthenticationError):
+            pass
+        self.listener.close()
+        self.pool.close()
+        if self.key_path is not None and osp.exists(self.key_path):
+            os.unlink(self.key_path)
+        self.pool.join()
+        if osp.exists(self.address):
+            os.unlink(self.address)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of detection_batch.py: the vectorized crop transforms agree face by
+face with get_upright_face_transform() of face_aligner_mxnet on
+test_data.json.
+
+    python -m unittest discover tests
+"""
+import json
+import os.path as osp
+import sys
+import unittest
+
+import numpy as np
+
+ROOT_DIR = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from detection_batch import parse_manifest_entries, get_upright_face_transforms
+
+try:
+    from face_aligner_mxnet import get_upright_face_transform
+except ImportError:  # mxnet is not installed
+    get_upright_face_transform = None
+
+TEST_DATA = osp.join(ROOT_DIR, 'test_imgs_weidong', 'test_data.json')
+
+
+@unittest.skipIf(get_upright_face_transform is None, 'face_aligner_mxnet needs mxnet')
+class UprightFaceTransformsTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(TEST_DATA, 'r') as fp:
+            entries = json.load(fp)
+        _, self.detections = parse_manifest_entries(entries)
+        # pts as in the manifest (ints), as the per-face path got them
+        self.raw_pts = [data['pts'] for body in entries
+                        for data in body.get('detections', []) if 'pts' in data]
+
+    def _check_scale(self, scale):
+        M, crop_sizes, roi_rects, use_roi = get_upright_face_transforms(
+            self.detections.pts, self.detections.angles, scale)
+
+        self.assertEqual(len(self.raw_pts), len(crop_sizes))
+        for i, pts in enumerate(self.raw_pts):
+            angle = float(self.detections.angles[i])
+            face_M, crop_size, roi_pts = get_upright_face_transform(pts, angle, scale)
+
+            self.assertEqual(int(crop_sizes[i]), crop_size)
+            self.assertEqual(bool(use_roi[i]), roi_pts is not None)
+            if roi_pts is not None:
+                np.testing.assert_array_equal(
+                    roi_rects[i], np.ravel(roi_pts), 'face {}'.format(i))
+            # the per-face path solves in float32
+            np.testing.assert_allclose(M[i], face_M, rtol=1e-5, atol=1e-2,
+                                       err_msg='face {}'.format(i))
+
+    def test_scale_1(self):
+        self._check_scale(1.0)
+
+    def test_crop_scale(self):
+        self._check_scale(1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
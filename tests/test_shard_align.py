@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of shard_align.py: FileLease, and local worker processes standing in
+for nodes, one of which is killed while it holds a chunk lease.
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import os.path as osp
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+try:
+    from shard_align import FileLease
+except ImportError:  # mxnet is not installed
+    FileLease = None
+
+
+@unittest.skipIf(FileLease is None, 'shard_align needs mxnet')
+class FileLeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = osp.join(self.tmp_dir, 'chunk-0000.lease')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read_owner(self):
+        with open(self.path, 'r') as fp:
+            return json.load(fp)["owner"]
+
+    def test_acquire_renew_release(self):
+        lease = FileLease(self.path, 'a', timeout=10.0)
+        self.assertTrue(lease.try_acquire())
+        self.assertFalse(FileLease(self.path, 'b', timeout=10.0).try_acquire())
+        self.assertTrue(lease.renew())
+        self.assertEqual(self._read_owner(), 'a')
+        lease.release()
+        self.assertFalse(osp.exists(self.path))
+
+    def test_unreadable_lease_expires(self):
+        # left by a worker which died between creating and writing it
+        open(self.path, 'w').close()
+        lease = FileLease(self.path, 'a', timeout=10.0)
+        self.assertFalse(lease.try_acquire())
+
+        old = time.time() - 20.0
+        os.utime(self.path, (old, old))
+        self.assertTrue(lease.try_acquire())
+        self.assertEqual(self._read_owner(), 'a')
+
+    def test_renew_keeps_reclaimed_lease(self):
+        lease_a = FileLease(self.path, 'a', timeout=0.1)
+        self.assertTrue(lease_a.try_acquire())
+        time.sleep(0.2)
+
+        lease_b = FileLease(self.path, 'b', timeout=10.0)
+        self.assertTrue(lease_b.try_acquire())
+        self.assertFalse(lease_a.renew())
+        self.assertEqual(self._read_owner(), 'b')
+
+        lease_a.release()
+        self.assertEqual(self._read_owner(), 'b')
+        self.assertEqual(os.listdir(self.tmp_dir), ['chunk-0000.lease'])
+
+
+@unittest.skipIf(FileLease is None, 'shard_align needs mxnet')
+class LocalWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _find_running_chunk(self, leases_dir, done_dir):
+        """Get the owner of a chunk lease whose chunk is not done yet."""
+        for name in sorted(os.listdir(leases_dir)):
+            if not name.startswith('chunk-') or not name.endswith('.lease'):
+                continue
+            chunk_name = name[:-len('.lease')]
+            try:
+                with open(osp.join(leases_dir, name), 'r') as fp:
+                    owner = json.load(fp)["owner"]
+            except (IOError, OSError, ValueError):
+                continue
+            if not osp.exists(osp.join(done_dir, chunk_name + '.done')):
+                return chunk_name, owner
+        return None, None
+
+    def test_killed_worker_lease_is_reclaimed(self):
+        leases_dir = osp.join(self.work_dir, 'leases')
+        done_dir = osp.join(self.work_dir, 'done')
+        proc = subprocess.Popen([
+            sys.executable, osp.join(ROOT_DIR, 'shard_align.py'),
+            '--manifest', osp.join(ROOT_DIR, 'test_imgs_weidong', 'test_data.json'),
+            '--config', osp.join(ROOT_DIR, 'face_aligner_config.json'),
+            '--image-root', ROOT_DIR,
+            '--work-dir', self.work_dir,
+            '--n-chunks', '4',
+            '--local-workers', '2',
+            '--lease-timeout', '2',
+            '--poll-interval', '0.2',
+            '--chunk-size', '1',
+            '--decode-workers', '1',
+            '--progress-interval', '0'
+        ], cwd=ROOT_DIR)
+
+        # freeze the first worker seen holding the lease of an unfinished
+        # chunk, then kill it
+        killed = None
+        deadline = time.time() + 300
+        while killed is None and time.time() < deadline and proc.poll() is None:
+            if osp.isdir(leases_dir):
+                chunk_name, owner = self._find_running_chunk(leases_dir, done_dir)
+                if owner is not None:
+                    pid = int(owner.rsplit('-', 2)[1])
+                    os.kill(pid, signal.SIGSTOP)
+                    if osp.exists(osp.join(done_dir, chunk_name + '.done')):
+                        # finished before it was frozen, try another
+                        os.kill(pid, signal.SIGCONT)
+                        continue
+                    os.kill(pid, signal.SIGKILL)
+                    killed = (chunk_name, owner)
+                    continue
+            time.sleep(0.005)
+
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() is None:
+            proc.kill()
+            self.fail('workers did not finish')
+        if killed is None:
+            self.skipTest('no chunk lease was caught before the job ended')
+
+        chunk_name, owner = killed
+        with open(osp.join(done_dir, chunk_name + '.done'), 'r') as fp:
+            done = json.load(fp)
+        self.assertNotEqual(done["worker"], owner)
+        self.assertTrue(osp.isfile(osp.join(self.work_dir, 'results.jsonl')))
+        self.assertEqual(len(os.listdir(done_dir)), 4)
+        self.assertFalse([name for name in os.listdir(leases_dir)
+                          if name.startswith('chunk-') and name.endswith('.lease')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of video_ingest.py on local video files written by cv2.VideoWriter.
+
+    python -m unittest discover tests
+"""
+import os.path as osp
+import shutil
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+ROOT_DIR = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from video_ingest import MultiStreamAligner
+
+FACE_PTS = [[8, 8], [40, 8], [40, 40], [8, 40]]
+
+
+class CropAligner(object):
+    """Stands in for FaceAlignerCaffe, which needs mxnet: crops the face
+    rects, landmarks are zeros."""
+
+    batch_size = 4
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def rotate_and_crop_faces(self, img, pts_with_angles, scale=1.0):
+        return [img[8:40, 8:40] for _ in pts_with_angles]
+
+    def get_landmarks(self, im_list, center_roi_scale=1.0):
+        self.batch_sizes.append(len(im_list))
+        return [np.zeros(10, dtype=np.float32) for _ in im_list]
+
+
+def detect_two_faces(frame, stream_id, frame_idx):
+    return [(FACE_PTS, 0.0), (FACE_PTS, 0.0)]
+
+
+def write_video(path, n_frames, fps=25.0):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (64, 48))
+    if not writer.isOpened():
+        return False
+    for k in range(n_frames):
+        frame = np.full((48, 64, 3), k * 10 % 256, dtype=np.uint8)
+        writer.write(frame)
+    writer.release()
+    return True
+
+
+class MultiStreamAlignerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.videos = {}
+        for stream_id, n_frames in (('a', 20), ('b', 10)):
+            path = osp.join(self.tmp_dir, stream_id + '.avi')
+            if not write_video(path, n_frames):
+                self.skipTest('cv2.VideoWriter cannot write MJPG')
+            self.videos[stream_id] = path
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all_frames_of_files(self):
+        aligner = CropAligner()
+        multi = MultiStreamAligner(aligner, detect_two_faces, max_pending_frames=100)
+        for stream_id in sorted(self.videos):
+            multi.add_stream(stream_id, self.videos[stream_id], realtime=False)
+
+        results = {'a': [], 'b': []}
+
+        def on_result(stream_id, frame_idx, frame, crops, five_pts_list):
+            self.assertEqual(len(five_pts_list), 2)
+            results[stream_id].append(frame_idx)
+
+        stats = multi.run(on_result, timeout=60)
+
+        self.assertEqual(results['a'], list(range(20)))
+        self.assertEqual(results['b'], list(range(10)))
+        for stream_id, n_frames in (('a', 20), ('b', 10)):
+            stream_stats = stats["streams"][stream_id]
+            self.assertEqual(stream_stats["decoded"], n_frames)
+            self.assertEqual(stream_stats["sampled"], n_frames)
+            self.assertEqual(stream_stats["processed"], n_frames)
+            self.assertEqual(stream_stats["dropped"], 0)
+            self.assertEqual(stream_stats["faces"], 2 * n_frames)
+        self.assertEqual(sum(aligner.batch_sizes), 60)
+        self.assertTrue(max(aligner.batch_sizes) <= aligner.batch_size)
+
+    def test_sample_fps(self):
+        multi = MultiStreamAligner(CropAligner(), detect_two_faces, max_pending_frames=100)
+        multi.add_stream('a', self.videos['a'], sample_fps=5, realtime=False)
+
+        stats = multi.run(timeout=60)
+
+        stream_stats = stats["streams"]['a']
+        self.assertEqual(stream_stats["decoded"], 20)
+        # frames 0, 5, 10, 15 of the 25 fps video
+        self.assertEqual(stream_stats["sampled"], 4)
+        self.assertEqual(stream_stats["processed"], 4)
+
+    def test_overflow_keeps_started_frames(self):
+        multi = MultiStreamAligner(CropAligner(), detect_two_faces, max_pending_frames=3)
+        multi.add_stream('a', self.videos['a'])
+        queue = multi.pending['a']
+        for frame_idx, next_face in ((0, 1), (1, 0), (2, 0)):
+            queue.append({"frame_idx": frame_idx, "crops": [None, None],
+                          "next_face": next_face})
+
+        # the newest frame with no face in the network goes first
+        self.assertTrue(multi._make_room('a'))
+        self.assertEqual([rec["frame_idx"] for rec in queue], [0, 1])
+
+        queue[1]["next_face"] = 1
+        queue.append({"frame_idx": 3, "crops": [None], "next_face": 1})
+        self.assertFalse(multi._make_room('a'))
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(multi.get_stats()["streams"]['a']["dropped"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
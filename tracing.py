@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sampled per-image request tracing, exported in the Chrome trace event
+format (open the JSON in chrome://tracing or https://ui.perfetto.dev).
+
+Tracer.start_trace() starts the trace of one image, or returns None when
+the image is not sampled (sample_rate), so tracing can stay on in
+production: components take an optional trace and only test it for None.
+A trace records:
+    the image, an async span from start_trace() to Trace.finish()
+    spans on the threads doing the work (Trace.span()), e.g. decode,
+        rotate_and_crop_faces and one crop_face per face, the similarity
+        solve of the chips and one warp_and_crop_face per face
+    landmark network batches (Tracer.batch_span()): the batch_id, and the
+        trace_id:face_idx of the sampled faces in it, with flow arrows
+        from the crop of each face to the batch it ran in
+
+Usage:
+    tracer = Tracer(sample_rate=0.01)
+    trace = tracer.start_trace('image', uri=uri)
+    with trace.span('decode'):
+        img = cv2.imread(uri)
+    crops = face_aligner.rotate_and_crop_faces(img, faces, trace=trace)
+    five_pts_list, _ = face_aligner.get_landmarks_and_scores(
+        crops, face_traces=[(trace, i) for i in range(len(crops))])
+    trace.finish()
+    tracer.save('trace.json')
+"""
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+
+def _now_us():
+    return time.time() * 1e6
+
+
+def _get_tid():
+    return threading.current_thread().ident
+
+
+class _Span(object):
+    """A complete ("X") event on the current thread, a context manager."""
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0.0
+        self.tid = None
+
+    def __enter__(self):
+        self.start = _now_us()
+        self.tid = _get_tid()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.add_event({
+            "name": self.name,
+            "cat": self.tracer.category,
+            "ph": "X",
+            "ts": self.start,
+            "dur": _now_us() - self.start,
+            "pid": self.tracer.pid,
+            "tid": self.tid,
+            "args": self.args
+        })
+
+
+class Trace(object):
+    """The trace of one sampled image, see the module docstring."""
+
+    def __init__(self, tracer, trace_id, name, args):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.name = name
+        self.args = args
+        # face_idx -> first face_span() of the face, where its flows start
+        self.face_anchors = {}
+        self.finished = False
+
+        args = dict(args)
+        args["trace_id"] = trace_id
+        tracer.add_event(self._make_async_event("b", args))
+
+    def _make_async_event(self, phase, args=None):
+        event = {
+            "name": self.name,
+            "cat": self.tracer.category,
+            "ph": phase,
+            "id": self.trace_id,
+            "ts": _now_us(),
+            "pid": self.tracer.pid,
+            "tid": _get_tid()
+        }
+        if args:
+            event["args"] = args
+        return event
+
+    def span(self, name, **args):
+        """Context manager recording a span of this trace on the current
+        thread."""
+        args["trace_id"] = self.trace_id
+        return _Span(self.tracer, name, args)
+
+    def face_span(self, name, face_idx, **args):
+        """span() of one face, the first one of a face is where its flow to
+        the network batch starts."""
+        args["face_idx"] = face_idx
+        span = self.span(name, **args)
+        if face_idx not in self.face_anchors:
+            self.face_anchors[face_idx] = span
+        return span
+
+    def get_face_anchor(self, face_idx):
+        span = self.face_anchors.get(face_idx)
+        if span is None or span.tid is None:
+            return None
+        # 1 us into the span, so the flow binds to it
+        return span.tid, span.start + 1
+
+    def finish(self, **args):
+        """End the image span, once."""
+        if self.finished:
+            return
+        self.finished = True
+        self.tracer.add_event(self._make_async_event("e", args))
+
+
+class _BatchSpan(_Span):
+    """A span of a network batch, linked to the sampled faces in it."""
+
+    def __init__(self, tracer, name, batch_id, face_refs, args):
+        args["batch_id"] = batch_id
+        args["faces"] = ['{}:{}'.format(trace.trace_id, face_idx)
+                         for trace, face_idx in face_refs]
+        _Span.__init__(self, tracer, name, args)
+        self.face_refs = face_refs
+
+    def __enter__(self):
+        _Span.__enter__(self)
+        for trace, face_idx in self.face_refs:
+            anchor = trace.get_face_anchor(face_idx)
+            if anchor is None:
+                continue
+            flow_id = self.tracer.new_id()
+            common = {"name": "face_to_batch", "cat": self.tracer.category,
+                      "id": flow_id, "pid": self.tracer.pid}
+            start = dict(common, ph="s", tid=anchor[0], ts=anchor[1])
+            # bound to the enclosing slice, i.e. this batch span
+            end = dict(common, ph="f", bp="e", tid=self.tid, ts=self.start + 1)
+            self.tracer.add_event(start)
+            self.tracer.add_event(end)
+        return self
+
+    def span(self, name, **args):
+        """Context manager recording a step of this batch, e.g. nested in it."""
+        args["batch_id"] = self.args["batch_id"]
+        return _Span(self.tracer, name, args)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def span(self, name, **args):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def trace_span(trace, name, **args):
+    """trace.span(name, **args), or a span doing nothing if trace is None
+    (not sampled)."""
+    if trace is None:
+        return NULL_SPAN
+    return trace.span(name, **args)
+
+
+def trace_face_span(trace, name, face_idx, **args):
+    """trace.face_span(), or a span doing nothing if trace is None."""
+    if trace is None:
+        return NULL_SPAN
+    return trace.face_span(name, face_idx, **args)
+
+
+def get_sampled_faces(face_traces):
+    """Get the (Trace, face_idx) of the sampled faces in face_traces, a list
+    of (Trace or None, face_idx) or None, or None."""
+    if not face_traces:
+        return []
+    return [ref for ref in face_traces if ref is not None and ref[0] is not None]
+
+
+def trace_batch_span(name, face_traces, **args):
+    """Tracer.batch_span() of the tracer of the sampled faces in
+    face_traces (see get_sampled_faces()), or a span doing nothing if none
+    is sampled."""
+    face_refs = get_sampled_faces(face_traces)
+    if not face_refs:
+        return NULL_SPAN
+    return face_refs[0][0].tracer.batch_span(name, face_refs, **args)
+
+
+class Tracer(object):
+    """Sample traces of images and buffer their events, thread-safe."""
+
+    def __init__(self, sample_rate=1.0, max_events=1000000, category='align'):
+        """Sample traces of images and buffer their events.
+
+            Params:
+                sample_rate: fraction of start_trace() calls traced, 0 to 1
+                max_events: max buffered events, the oldest are dropped
+                category: "cat" of the events
+        """
+        self.sample_rate = sample_rate
+        self.category = category
+        self.pid = os.getpid()
+
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+        self.thread_names = {}
+        self.ids = itertools.count(1)
+        self.stats = {
+            "started": 0,
+            "sampled": 0,
+            "events": 0
+        }
+
+    def new_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    def start_trace(self, name='image', **args):
+        """Start the trace of an image, if it is sampled.
+
+        Return:
+            a Trace, or None if not sampled
+        """
+        sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+        with self.lock:
+            self.stats["started"] += 1
+            if not sampled:
+                return None
+            self.stats["sampled"] += 1
+            trace_id = next(self.ids)
+
+        return Trace(self, trace_id, name, args)
+
+    def batch_span(self, name, face_refs, **args):
+        """Context manager recording a network batch on the current thread,
+        linked to its sampled faces.
+
+            Params:
+                name: span name
+                face_refs: a list of (Trace, face_idx) of the sampled faces
+                        in the batch
+        Return:
+            the span, or a span doing nothing if face_refs is empty
+        """
+        if not face_refs:
+            return NULL_SPAN
+        return _BatchSpan(self, name, self.new_id(), face_refs, args)
+
+    def add_event(self, event):
+        tid = _get_tid()
+        with self.lock:
+            self.events.append(event)
+            self.stats["events"] += 1
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["buffered_events"] = len(self.events)
+        stats["sample_rate"] = self.sample_rate
+        return stats
+
+    def to_chrome_trace(self):
+        """Get the buffered events in the Chrome trace event format, a dict
+        to dump as JSON."""
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+
+        # thread names, as shown by the viewer
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                     "args": {"name": thread_name}}
+                    for tid, thread_name in thread_names.items()]
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms"
+        }
+
+    def save(self, path):
+        """Save the buffered events in the Chrome trace event format,
+        atomically."""
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.to_chrome_trace(), fp)
+        os.rename(tmp_path, path)
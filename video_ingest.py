@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Multi-stream video ingestion for FaceAlignerCaffe: decode N video streams
+(files, cameras, or anything cv2.VideoCapture can open) on background
+threads, sample frames at a per-stream rate, and fill each landmark network
+batch with faces from several streams in round-robin order.
+"""
+import time
+import threading
+from collections import deque
+
+import cv2
+
+
+class VideoStreamReader(threading.Thread):
+    """Decode one video stream on a background thread.
+
+    Only the latest sampled frame is kept: when the consumer falls behind,
+    a new frame replaces the one that has not been taken yet, and the stale
+    one is counted as dropped. With realtime=False the reader waits for the
+    consumer instead, so that no frame of a video file is dropped.
+    """
+
+    def __init__(self, stream_id, source, sample_fps=None, realtime=True):
+        """Decode one video stream on a background thread.
+
+            Params:
+                stream_id: name of the stream
+                source: video file path, camera index or stream url,
+                        anything cv2.VideoCapture() accepts
+                sample_fps: frames per second to sample from the stream,
+                        None to sample every frame
+                realtime: if True, play video files at their own fps and
+                        drop stale frames (camera stand-in), if False,
+                        decode as fast as the consumer takes frames
+        """
+        threading.Thread.__init__(self, name='VideoStreamReader-{}'.format(stream_id))
+        self.daemon = True
+
+        self.stream_id = stream_id
+        self.source = source
+        self.sample_fps = sample_fps
+        self.realtime = realtime
+
+        self.cond = threading.Condition()
+        self.latest = None  # (frame_idx, capture_time, frame)
+        self.finished = False
+        self.stopped = False
+        self.error = None
+
+        self.stats = {
+            "decoded": 0,
+            "sampled": 0,
+            "dropped": 0
+        }
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def take_frame(self):
+        """Take the latest sampled frame.
+
+        Return:
+            (frame_idx, capture_time, frame), or None if there is no new frame
+        """
+        with self.cond:
+            item = self.latest
+            self.latest = None
+            self.cond.notify_all()
+        return item
+
+    def is_done(self):
+        """True if the stream has ended and its last frame was taken."""
+        with self.cond:
+            return self.finished and self.latest is None
+
+    def run(self):
+        cap = cv2.VideoCapture(self.source)
+        try:
+            if not cap.isOpened():
+                raise IOError('Cannot open video source: {}'.format(self.source))
+            self._read_loop(cap)
+        except Exception as err:
+            self.error = err
+        finally:
+            cap.release()
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+    def _read_loop(self, cap):
+        video_fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+        sample_interval = 1.0 / self.sample_fps if self.sample_fps else 0.0
+        next_sample_ts = 0.0
+        start_time = time.time()
+        frame_idx = -1
+
+        while not self.stopped:
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            frame_idx += 1
+            self.stats["decoded"] += 1
+
+            # stream time of this frame, from the video fps if known
+            if video_fps > 0:
+                stream_ts = frame_idx / video_fps
+            else:
+                stream_ts = time.time() - start_time
+
+            if self.realtime and video_fps > 0:
+                wait = start_time + stream_ts - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+            if stream_ts + 1e-6 < next_sample_ts:
+                continue
+            next_sample_ts = max(next_sample_ts + sample_interval, stream_ts)
+
+            with self.cond:
+                if not self.realtime:
+                    while self.latest is not None and not self.stopped:
+                        self.cond.wait(0.1)
+                if self.latest is not None:
+                    self.stats["dropped"] += 1
+                self.latest = (frame_idx, time.time(), frame)
+                self.stats["sampled"] += 1
+
+
+class MultiStreamAligner(object):
+    """Run FaceAlignerCaffe over many video streams at once.
+
+    Each loop iteration takes the latest frame from every stream, crops its
+    faces, and runs the landmark network on batches that are filled with
+    faces from all streams in round-robin order, so that no stream can
+    starve the others. Frames which wait too long for a batch are dropped
+    instead of letting the streams fall behind, only ones with no face in
+    the network yet.
+    """
+
+    def __init__(self, face_aligner, detector,
+                 crop_scale=1.5,
+                 center_roi_scale=1/1.5*0.9,
+                 max_pending_frames=2):
+        """Run FaceAlignerCaffe over many video streams at once.
+
+            Params:
+                face_aligner: a FaceAlignerCaffe
+                detector: callable(frame, stream_id, frame_idx) which
+                        returns the list of (pts, angle) pairs of the frame,
+                        see FaceAlignerCaffe.rotate_and_crop_faces()
+                crop_scale: scale for FaceAlignerCaffe.rotate_and_crop_faces()
+                center_roi_scale: center_roi_scale for FaceAlignerCaffe.get_landmarks()
+                max_pending_frames: max frames per stream which wait for
+                        landmarks, when exceeded the newest frame with no
+                        face in the network yet is dropped (or the new one)
+        """
+        self.face_aligner = face_aligner
+        self.detector = detector
+        self.crop_scale = crop_scale
+        self.center_roi_scale = center_roi_scale
+        self.max_pending_frames = max_pending_frames
+        self.batch_size = face_aligner.batch_size
+
+        self.readers = []
+        # stream_id -> deque of pending frames
+        self.pending = {}
+        # index in self.readers of the stream the next batch starts at
+        self.next_stream = 0
+        self.stream_stats = {}
+        self.n_batches = 0
+        self.n_batch_faces = 0
+
+    def add_stream(self, stream_id, source, sample_fps=None, realtime=True):
+        """Add a video stream, see VideoStreamReader for the params."""
+        reader = VideoStreamReader(stream_id, source, sample_fps, realtime)
+        self.readers.append(reader)
+        self.pending[stream_id] = deque()
+        self.stream_stats[stream_id] = {
+            "processed": 0,
+            "dropped_pending": 0,
+            "faces": 0,
+            "lag_sum": 0.0,
+            "lag_max": 0.0,
+            "start_time": None
+        }
+
+        return reader
+
+    def get_stats(self):
+        """Get per-stream stats: decoded/sampled/dropped/processed frames,
+        faces, processed frames per second and lag (seconds from decode to
+        landmarks) average/max; plus the average batch fill ratio.
+        """
+        stats = {"streams": {}}
+        now = time.time()
+
+        for reader in self.readers:
+            s = dict(reader.stats)
+            ss = self.stream_stats[reader.stream_id]
+            s["processed"] = ss["processed"]
+            s["dropped"] += ss["dropped_pending"]
+            s["faces"] = ss["faces"]
+            s["lag_avg"] = ss["lag_sum"] / max(ss["processed"], 1)
+            s["lag_max"] = ss["lag_max"]
+            elapsed = now - ss["start_time"] if ss["start_time"] else 0.0
+            s["fps"] = ss["processed"] / elapsed if elapsed > 0 else 0.0
+            stats["streams"][reader.stream_id] = s
+
+        stats["batches"] = self.n_batches
+        stats["batch_fill"] = (self.n_batch_faces /
+                               float(max(self.n_batches * self.batch_size, 1)))
+
+        return stats
+
+    def _ingest_frames(self):
+        """Take the latest frame of every stream, detect and crop its faces."""
+        n_new = 0
+
+        for reader in self.readers:
+            item = reader.take_frame()
+            if item is None:
+                continue
+
+            frame_idx, capture_time, frame = item
+            stream_id = reader.stream_id
+            queue = self.pending[stream_id]
+            if not self._make_room(stream_id):
+                # all pending frames are in the network already, drop the
+                # new one before detecting and cropping its faces
+                self.stream_stats[stream_id]["dropped_pending"] += 1
+                continue
+
+            pts_with_angles = self.detector(frame, stream_id, frame_idx)
+            img_cropped_list = self.face_aligner.rotate_and_crop_faces(
+                frame, pts_with_angles, scale=self.crop_scale)
+
+            queue.append({
+                "frame_idx": frame_idx,
+                "capture_time": capture_time,
+                "frame": frame,
+                "crops": img_cropped_list,
+                "five_pts": [None] * len(img_cropped_list),
+                "next_face": 0,
+                "n_done": 0
+            })
+            n_new += 1
+
+        return n_new
+
+    def _make_room(self, stream_id):
+        """Drop pending frames of a stream until a new one fits, newest
+        first among those with no face in the network yet, so that no
+        landmark work is thrown away.
+
+        Return:
+            False if there is no room, as all pending frames are started
+        """
+        queue = self.pending[stream_id]
+        while len(queue) >= self.max_pending_frames:
+            for idx in range(len(queue) - 1, -1, -1):
+                rec = queue[idx]
+                if rec["next_face"] == 0 and rec["crops"]:
+                    break
+            else:
+                return False
+
+            del queue[idx]
+            self.stream_stats[stream_id]["dropped_pending"] += 1
+
+        return True
+
+    def _next_batch(self):
+        """Fill one batch with faces from all streams in round-robin order,
+        starting at the stream after the last one served by the previous
+        batch, so no stream starves when there are more than batch_size.
+
+        Return:
+            a list of (frame_record, face_idx)
+        """
+        batch = []
+        cursors = dict((sid, 0) for sid in self.pending)
+        n_streams = len(self.readers)
+
+        while len(batch) < self.batch_size:
+            added = False
+            for k in range(n_streams):
+                if len(batch) >= self.batch_size:
+                    break
+
+                idx = (self.next_stream + k) % n_streams
+                stream_id = self.readers[idx].stream_id
+                queue = self.pending[stream_id]
+
+                # first frame of the stream which still has faces to run
+                while cursors[stream_id] < len(queue):
+                    rec = queue[cursors[stream_id]]
+                    if rec["next_face"] < len(rec["crops"]):
+                        break
+                    cursors[stream_id] += 1
+                else:
+                    continue
+
+                batch.append((rec, rec["next_face"]))
+                rec["next_face"] += 1
+                added = True
+                last_idx = idx
+
+            if not added:
+                break
+            self.next_stream = (last_idx + 1) % n_streams
+
+        return batch
+
+    def _emit_done_frames(self, on_result):
+        now = time.time()
+
+        for stream_id, queue in self.pending.items():
+            ss = self.stream_stats[stream_id]
+            while queue and queue[0]["n_done"] == len(queue[0]["crops"]):
+                rec = queue.popleft()
+                lag = now - rec["capture_time"]
+                ss["processed"] += 1
+                ss["faces"] += len(rec["crops"])
+                ss["lag_sum"] += lag
+                ss["lag_max"] = max(ss["lag_max"], lag)
+
+                if on_result is not None:
+                    on_result(stream_id, rec["frame_idx"], rec["frame"],
+                              rec["crops"], rec["five_pts"])
+
+    def run(self, on_result=None, timeout=None, idle_sleep=0.002):
+        """Start all streams and process them until they have all ended
+        (or timeout seconds have passed).
+
+        Params:
+            on_result: None or callable(stream_id, frame_idx, frame,
+                    img_cropped_list, five_pts_list), called in the order
+                    of frames for each stream
+            timeout: None or max seconds to run
+            idle_sleep: seconds to sleep when no stream has a new frame
+        Return:
+            stats, see get_stats()
+        """
+        start_time = time.time()
+        for reader in self.readers:
+            self.stream_stats[reader.stream_id]["start_time"] = start_time
+            reader.start()
+
+        try:
+            while True:
+                n_new = self._ingest_frames()
+
+                batch = self._next_batch()
+                if batch:
+                    five_pts_list = self.face_aligner.get_landmarks(
+                        [rec["crops"][i] for rec, i in batch], self.center_roi_scale)
+                    for (rec, i), five_pts in zip(batch, five_pts_list):
+                        rec["five_pts"][i] = five_pts
+                        rec["n_done"] += 1
+                    self.n_batches += 1
+                    self.n_batch_faces += len(batch)
+
+                self._emit_done_frames(on_result)
+
+                if not batch and not n_new:
+                    if all(r.is_done() for r in self.readers):
+                        break
+                    time.sleep(idle_sleep)
+
+                if timeout is not None and time.time() - start_time > timeout:
+                    break
+        finally:
+            for reader in self.readers:
+                reader.stop()
+            for reader in self.readers:
+                reader.join()
+
+        for reader in self.readers:
+            if reader.error is not None:
+                print('stream {} failed: {}'.format(reader.stream_id, reader.error))
+
+        return self.get_stats()